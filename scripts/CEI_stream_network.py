@@ -1,4 +1,10 @@
 import arcpy
+import numpy as np
+import hydro_cache
+import numpy_hydrology
+import order_report
+import raster_io
+from stream_network import write_stream_segments
 
 
 def CEI_extraction(DEM_input,
@@ -12,7 +18,8 @@ def CEI_extraction(DEM_input,
                    out_CEI,
                    out_stream_links,
                    out_stream_orders,
-                   out_watersheds):
+                   out_watersheds,
+                   cache_dir=None):
     # Prepare environments
     arcpy.env.overwriteOutput = True
     arcpy.env.extent = DEM_input
@@ -29,20 +36,30 @@ def CEI_extraction(DEM_input,
     else:
         output_format = 'GDB'
 
-    # Calculate slope
-    arcpy.AddMessage('Calculating slope')
-    slope_percent = arcpy.sa.Slope(DEM_input, "PERCENT_RISE")
-    slope_tangent = arcpy.sa.Times(slope_percent, 0.01)
-    arcpy.Delete_management('slope_percent')
-    # slope_tangent.save('slope')  # left for debugging purposes
-        
-    # DEM Hydro-processing
-    # Fill in sinks
-    arcpy.AddMessage('Fill in sinks')
-    DEM_fill = arcpy.sa.Fill(DEM_input)
-    # Calculate flow directions
-    arcpy.AddMessage('Calculating flow directions')
-    flow_directions = arcpy.sa.FlowDirection(DEM_fill, "NORMAL", 'slope_percent')
+    # Optional cache of hydro-conditioned DEM products (see hydro_cache)
+    cache = hydro_cache.open_cache(cache_dir)
+    if cache is not None:
+        arcpy.AddMessage('Reading hydro-conditioned DEM from cache')
+        products, info = hydro_cache.conditioned_rasters(DEM_input, cache)
+        slope_percent = raster_io.to_raster(products['slope_percent'], info)
+        slope_tangent = arcpy.sa.Times(slope_percent, 0.01)
+        raster_io.to_raster(products['flow_drop'], info).save('flow_drop')
+        flow_directions = raster_io.to_raster(products['flow_directions'], info, numpy_hydrology.FLOW_DIR_NODATA)
+    else:
+        # Calculate slope
+        arcpy.AddMessage('Calculating slope')
+        slope_percent = arcpy.sa.Slope(DEM_input, "PERCENT_RISE")
+        slope_tangent = arcpy.sa.Times(slope_percent, 0.01)
+        arcpy.Delete_management('slope_percent')
+        # slope_tangent.save('slope')  # left for debugging purposes
+
+        # DEM Hydro-processing
+        # Fill in sinks
+        arcpy.AddMessage('Fill in sinks')
+        DEM_fill = arcpy.sa.Fill(DEM_input)
+        # Calculate flow directions
+        arcpy.AddMessage('Calculating flow directions')
+        flow_directions = arcpy.sa.FlowDirection(DEM_fill, "NORMAL", 'flow_drop')
     # Save output flow direction as optional parameter
     if out_flow_dir and out_flow_dir != "#":
         arcpy.AddMessage('Saving flow directions')
@@ -105,116 +122,29 @@ def CEI_extraction(DEM_input,
     else:
         out_stream_orders = 'stream_order'
         stream_orders.save(out_stream_orders)
-    arcpy.sa.StreamToFeature(stream_orders, flow_directions, 'streams_output', "SIMPLIFY")
-    # Changing field name to a meaningful string
-    arcpy.AlterField_management('streams_output', 'grid_code', 'strahler_order', "Strahler order")
-    arcpy.AddMessage('Delineating watersheds')
-    outWatersheds_raster = arcpy.sa.Watershed(flow_directions, stream_links)
     # outWatersheds_raster.save(out_watersheds)  # DEBUG
     if out_watersheds and out_watersheds != '#':
+        arcpy.AddMessage('Delineating watersheds')
+        outWatersheds_raster = arcpy.sa.Watershed(flow_directions, stream_links)
         arcpy.RasterToPolygon_conversion(outWatersheds_raster, out_watersheds, "NO_SIMPLIFY", "", "MULTIPLE_OUTER_PART")
 
-    # Join streams with equal Strahler order
-    arcpy.AddMessage('Dissolving streams')
-    # Working with Stream order raster attribute table
-    # Build attribute table
-    arcpy.BuildRasterAttributeTable_management(out_stream_orders)
-    # Extract values
-    values = [i[0] for i in arcpy.da.SearchCursor(out_stream_orders, "Value")]
+    # Trace streams into segments of equal Strahler order, split at confluences
+    arcpy.AddMessage('Tracing stream segments')
+    # Slope and elevation statistics of every segment are written with it
+    # (slope along the flow: the drop raster of FlowDirection)
+    segments = write_stream_segments(stream_orders, flow_directions, rivers_output, 'flow_drop', DEM_input)
+    values = sorted(int(i) for i in np.unique(segments['order']))
     arcpy.AddMessage("Strahler orders are: " + str(values))
-    # Dissolve streams by Strahler order
-    arcpy.Dissolve_management('streams_output', 'streams_output_dissolve', 'strahler_order', "", "SINGLE_PART", "DISSOLVE_LINES")
-    # Extract both ends from dissolved streams
-    arcpy.FeatureVerticesToPoints_management('streams_output_dissolve', 'streams_output_end', "BOTH_ENDS")
-    # Split 'V-shaped' dissolved streams at end points
-    fc_list = []
-    # Set radius for splitting
-    split_radius = '1 Meters'
-    # Processing each order separately
-    for i in values:
-        # Selecting streams to split
-        expr = "strahler_order = " + str(i)
-        arcpy.MakeFeatureLayer_management('streams_output_dissolve', "streams_selection", expr)
-        # Selecting points to split. They have i+1 order
-        expr = "strahler_order = " + str(i + 1)
-        arcpy.MakeFeatureLayer_management('streams_output_end', "points_selection", expr)
-        # Split selected streams at selected points
-        rivers_temp = 'rivers_%s_order' % (i)  # Set dataset name
-        fc_list.append(rivers_temp)
-        arcpy.SplitLineAtPoint_management("streams_selection", "points_selection", rivers_temp, split_radius)
-    # Merging streams
-    arcpy.Merge_management(fc_list, rivers_output)
-    # Deleting temporary feature classes
-    arcpy.Delete_management('streams_output_dissolve')
-    arcpy.Delete_management('streams_output_end')
-    for fc in fc_list:
-        arcpy.Delete_management(fc)
-
-    # Calculate mean slope within streams
-    # TODO: добавить вычисление средней высоты
-    arcpy.AddMessage('Calculate mean slope')
-    # Extract drop values by mask
-    drop_raster_streams = arcpy.sa.ExtractByMask('slope_percent', stream_orders)
-    # Perform zonal statistics; result is saved as raster
-    drop_raster_mean = arcpy.sa.ZonalStatistics(outWatersheds_raster, 'Value', drop_raster_streams, "MEAN")
-    # Extract rivers startpoints
-    arcpy.FeatureVerticesToPoints_management(rivers_output, 'rivers_startpoints', "START")
-    # Extract zonal statistics raster values to rivers' startpoints
-    arcpy.sa.ExtractValuesToPoints('rivers_startpoints', drop_raster_mean, 'rivers_startpoints_stat')
-    arcpy.Delete_management('rivers_startpoints')
-    # Join point attribute table to rivers, transfer attributes
-    arcpy.AddField_management(rivers_output, 'Mean_slope', "FLOAT")
-    arcpy.MakeFeatureLayer_management(rivers_output, 'rivers_layer')
-    if output_format == 'SHAPE':
-        target_field = 'FID'
-    else:
-        target_field = 'OBJECTID'
-    arcpy.AddJoin_management('rivers_layer', target_field, 'rivers_startpoints_stat', "ORIG_FID")
-    arcpy.CalculateField_management('rivers_layer', "Mean_slope", "!rivers_startpoints_stat.RASTERVALU!", "PYTHON_9.3")
-    # Remove join
-    arcpy.RemoveJoin_management('rivers_layer')
-    # Delete temporary file
-    arcpy.Delete_management('rivers_startpoints_stat')
-
-    # Compute number of streams and total length
-    # Computation is performed over simplified streams to reduce error
-    # Compute total river length
-    arcpy.AddMessage('Compute river length and number of segments')
-    total_length = float(sum(row[0] for row in arcpy.da.SearchCursor(rivers_output, 'SHAPE@LENGTH')))
-    total_count = arcpy.GetCount_management(rivers_output)
-    
-    # Compute statistics by order   
-    # Count number and total length for every order
-    order_length = []
-    order_count = []
-    for i in values:
-        if output_format == 'SHAPE':
-            expr = "strahler_o = " + str(i)
-        else:
-            expr = "strahler_order = " + str(i)
-        arcpy.MakeFeatureLayer_management(rivers_output, "rivers_selection", expr)
-        order_length.append(float(sum(row[0] for row in arcpy.da.SearchCursor("rivers_selection", 'SHAPE@LENGTH'))))
-        order_count.append(arcpy.GetCount_management("rivers_selection"))
+    arcpy.Delete_management('flow_drop')
 
     # Delete Strahler order raster if not saved explicitly
     if out_stream_orders and out_stream_orders != '#':
         arcpy.Delete_management('stream_order')
 
-    # Write parameters to the output text file
+    # Number of streams, total length and statistics by order from the
+    # per-segment values collected while the segments were written
     arcpy.AddMessage('Save statistics to the text file')
-    with open(text_output, 'w') as out:
-        out.write('Total river length: ' + str(total_length) + ' m\n')
-        out.write('Total count: ' + str(total_count) + '\n')
-        for i in values:  # array starts at 0, but orders start from 1, so [i-1]
-            if i == 1:
-                suffix = "nd "
-            elif i == 2:
-                suffix = 'rd '
-            else:
-                suffix = 'st '
-            out.write(str(i) + suffix + 'order length: '+ str(order_length[i-1]) + 'm \n')
-            out.write(str(i) + suffix + 'order count: ' + str(order_count[i-1]) + '\n')
-    #TODO: средняя длина, средний уклон, средняя площадь водосбора
+    order_report.write_stream_statistics(text_output, segments)
     return
 
 
@@ -0,0 +1,72 @@
+import numpy as np
+try:
+    import arcpy
+except ImportError:  # NumPy backend on machines without ArcGIS
+    arcpy = None
+
+
+# Whole-column attribute I/O for feature classes and tables. Reads go
+# through arcpy.da.FeatureClassToNumPyArray / TableToNumPyArray, new fields
+# are written through arcpy.da.ExtendTable joined on the object ID. Only
+# fields that already exist and NaN values (written as null, which
+# ExtendTable cannot do) go through an update cursor. Nulls are read as NaN
+# (floating point fields), 0 (integer fields) or '' (text fields)
+
+NULL_VALUES = {'Double': np.nan,
+               'Single': np.nan,
+               'Integer': 0,
+               'SmallInteger': 0,
+               'String': ''}
+
+
+def read_columns(table, fields, where=None):
+    # Dict of field name (or geometry token such as 'SHAPE@LENGTH') -> array
+    field_types = dict((f.name, f.type) for f in arcpy.ListFields(table))
+    null_value = dict((name, NULL_VALUES[field_types[name]]) for name in fields
+                      if field_types.get(name) in NULL_VALUES)
+    description = arcpy.Describe(table)
+    if hasattr(description, 'shapeType'):
+        array = arcpy.da.FeatureClassToNumPyArray(table, fields, where, null_value=null_value)
+    else:
+        array = arcpy.da.TableToNumPyArray(table, fields, where, null_value=null_value)
+    return dict((name, array[name]) for name in fields)
+
+
+def object_ids(table, where=None):
+    return read_columns(table, ['OID@'], where)['OID@']
+
+
+def write_columns(table, ids, columns):
+    # Add or update fields of table from arrays aligned with the object IDs
+    # in ids; columns is a list of (field name, array) pairs. NaN is written
+    # as null
+    ids = np.asarray(ids)
+    columns = [(str(name), np.asarray(values)) for name, values in columns]
+    existing = set(f.name.lower() for f in arcpy.ListFields(table))
+    new = [(name, values) for name, values in columns if name.lower() not in existing]
+    if new:
+        dtype = [('join_id', np.int32)] + [(name, values.dtype) for name, values in new]
+        array = np.empty(len(ids), dtype=dtype)
+        array['join_id'] = ids
+        for name, values in new:
+            array[name] = values
+        oid_field = arcpy.Describe(table).OIDFieldName
+        arcpy.da.ExtendTable(table, oid_field, array, 'join_id', False)
+    # Existing fields (ExtendTable only appends) and new fields with NaN
+    updates = [(name, values) for name, values in columns
+               if name.lower() in existing or (values.dtype.kind == 'f' and np.isnan(values).any())]
+    if not updates:
+        return
+    rows = dict(zip(ids.tolist(), zip(*[values.tolist() for _, values in updates])))
+    with arcpy.da.UpdateCursor(table, ['OID@'] + [name for name, _ in updates]) as cursor:
+        for row in cursor:
+            values = rows.get(row[0])
+            if values is not None:
+                cursor.updateRow([row[0]] + [None if value != value else value for value in values])
+
+
+def group_sums(groups, values, n_groups):
+    # Sum and count of values for every integer group 0..n_groups - 1
+    groups = np.asarray(groups, dtype=np.int64)
+    sums = np.bincount(groups, weights=np.asarray(values, dtype=np.float64), minlength=n_groups)
+    return sums, np.bincount(groups, minlength=n_groups)
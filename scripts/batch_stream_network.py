@@ -0,0 +1,146 @@
+import csv
+import multiprocessing
+import os
+import traceback
+import order_report
+import parallel_hydrology
+
+
+# Batch runner for stream_network.CEI_extraction. The manifest is a CSV file
+# with one job per row and a column per CEI_extraction parameter (missing
+# columns and empty cells are '#', i.e. not set) plus an optional 'job'
+# column with a job name. Every job runs in its own worker process with its
+# own scratch file geodatabase as the workspace, so the fixed scratch names
+# of the tool ('slope_percent', 'FlowAcc', ...) never collide. Relative
+# outputs go to the job geodatabase, the text output defaults to
+# <job>_statistics.txt in the job directory. A failed job is reported and
+# does not stop the batch; all statistics are collected in one CSV table.
+
+PARAMETERS = ('DEM_input',
+              'precipitation',
+              'evapotranspiration',
+              'initiation_function_type',
+              'initiation_threshold',
+              'min_segment_length',
+              'rivers_output',
+              'text_output',
+              'out_flow_dir',
+              'out_flow_acc',
+              'out_initiation_raster',
+              'out_stream_links',
+              'out_stream_orders',
+              'out_watersheds',
+              'backend',
+              'cache_dir',
+              'iterative_pruning',
+              'incremental')
+
+
+def read_manifest(manifest):
+    # List of job dicts; 'job' defaults to the row number
+    jobs = []
+    with open(manifest) as f:
+        for number, row in enumerate(csv.DictReader(f), 1):
+            job = dict((name, (row.get(name) or '').strip() or '#') for name in PARAMETERS)
+            job['job'] = (row.get('job') or '').strip() or 'job_%d' % number
+            jobs.append(job)
+    return jobs
+
+
+def _init_worker():
+    # No nested process pools inside batch workers
+    os.environ['STREAMSCAPE_PROCESSES'] = '1'
+
+
+def run_job(job, output_dir):
+    # Run one job in an isolated workspace; returns a result dict with
+    # 'status' ('OK' or 'FAILED') and the statistics or the error
+    import arcpy
+    import stream_network
+    result = {'job': job['job'], 'status': 'FAILED', 'error': ''}
+    try:
+        job_dir = os.path.join(output_dir, job['job'])
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+        workspace = os.path.join(job_dir, 'scratch.gdb')
+        if not arcpy.Exists(workspace):
+            arcpy.CreateFileGDB_management(job_dir, 'scratch.gdb')
+        arcpy.env.workspace = workspace
+        arcpy.env.scratchWorkspace = workspace
+        if job['rivers_output'] == '#':
+            job['rivers_output'] = 'rivers'
+        if job['text_output'] == '#':
+            job['text_output'] = os.path.join(job_dir, job['job'] + '_statistics.txt')
+        if job['backend'] == '#':
+            job['backend'] = 'ARCGIS'
+        arcpy.CheckOutExtension('Spatial')
+        stream_network.CEI_extraction(*[job[name] for name in PARAMETERS])
+        result.update(order_report.read_statistics(job['text_output']))
+        result['status'] = 'OK'
+    except Exception:
+        result['error'] = traceback.format_exc()
+    return result
+
+
+def _run_job(arguments):
+    return run_job(*arguments)
+
+
+def write_summary(results, summary_table):
+    # One row per job: status, totals and length and count for every order
+    orders = sorted(set(order for result in results for order in result.get('order_length', {})))
+    header = ['job', 'status', 'total_length', 'total_count']
+    for order in orders:
+        header += ['order_%d_length' % order, 'order_%d_count' % order]
+    header.append('error')
+    with open(summary_table, 'w') as out:
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(header)
+        for result in results:
+            row = [result['job'], result['status'],
+                   result.get('total_length', ''), result.get('total_count', '')]
+            for order in orders:
+                row += [result.get('order_length', {}).get(order, ''),
+                        result.get('order_count', {}).get(order, '')]
+            # Last line of the traceback is enough for the table
+            row.append(result['error'].strip().splitlines()[-1] if result['error'] else '')
+            writer.writerow(row)
+
+
+def run_batch(manifest, output_dir, processes=None, summary_table=None):
+    # Run all jobs of the manifest on a process pool and write the summary
+    # table (default: summary.csv in output_dir); returns the results
+    jobs = read_manifest(manifest)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if not processes or processes == '#':
+        processes = multiprocessing.cpu_count()
+    processes = max(min(int(processes), len(jobs)), 1)
+    parallel_hydrology.set_python_executable()
+    pool = multiprocessing.Pool(processes, _init_worker, maxtasksperchild=1)
+    try:
+        results = pool.map(_run_job, [(job, output_dir) for job in jobs], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    if not summary_table or summary_table == '#':
+        summary_table = os.path.join(output_dir, 'summary.csv')
+    write_summary(results, summary_table)
+    # Full tracebacks of failed jobs next to the summary
+    for result in results:
+        if result['status'] != 'OK':
+            with open(os.path.join(output_dir, result['job'] + '_error.txt'), 'w') as out:
+                out.write(result['error'])
+    return results
+
+
+if __name__ == '__main__':
+    import arcpy
+    # Arguments are optional
+    args = tuple(arcpy.GetParameterAsText(i)
+                 for i in range(arcpy.GetArgumentCount()))
+    results = run_batch(*args)
+    failed = [result['job'] for result in results if result['status'] != 'OK']
+    arcpy.AddMessage('Jobs done: %d, failed: %d' % (len(results) - len(failed), len(failed)))
+    for job in failed:
+        arcpy.AddWarning('Job failed: ' + job)
@@ -0,0 +1,391 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import numpy_hydrology as nh
+import order_report
+import parallel_hydrology as ph
+import profiling
+import ridgeline_numpy
+import stream_network_numpy
+import watershed_thickness_numpy
+
+
+# Reference benchmark of the three tools on synthetic terrain. For every
+# size a DEM is generated from octaves of value noise on a regional tilt,
+# then eroded along its own drainage (incision growing with the logarithm of
+# the catchment area), so it has valleys and a branching network; the
+# precipitation and evapotranspiration rasters depend on elevation. All
+# inputs are reproducible from the seed.
+#
+# Cases:
+#   streams/<initiation type> - stream_network_numpy.CEI_extraction;
+#   ridgelines - ordered ridgelines and their classification as in
+#     ordered_ridgelines, on the CATCHMENT_AREA network;
+#   thickness - watershed thickness metrics as in watershed_thickness_metrics
+#     (areas are cell counts here, not polygon areas);
+#   tools/... - with --tools, the ArcGIS tools themselves (NUMPY backend for
+#     the stream network, needs arcpy and Spatial Analyst).
+# Every case runs in a fresh worker process, so the reported peak memory is
+# the high-water mark of that case alone (including its loaded inputs).
+# Throughput is DEM cells per second of wall time.
+#
+# The outputs of every case (stream cell mask digest, cells and segments by
+# order, ridgeline classes, thickness numbers) are compared with the golden
+# results in benchmark_golden.json, keyed by case and size; --update stores
+# the current outputs instead. Golden results are only valid for the same
+# seed.
+#
+# Golden results exist for all SIZES with seed 0. They were stored with
+#   python benchmark.py --sizes 1024,2048,4096 --update
+# and cross-checked at every size against independent runs of the first
+# NumPy backend (numpy_hydrology and stream_network_numpy as introduced, before
+# the fused, parallel and cached code paths): the stream cell masks and the
+# cells by order of all ten initiation types are identical, and the thickness
+# numbers agree to RELATIVE_TOLERANCE with per-zone loops over its watersheds
+# and divide lines. Ridgelines have no such reference; on a machine with
+# arcpy, run with --tools and compare the tools/ outputs with the NumPy ones.
+# Peak memory is about 160 bytes per cell (2.7 GB at 4096), so 16384 cells
+# square needs some 45 GB; larger sizes can still be run with --sizes and are
+# reported as NO GOLDEN until stored with --update.
+#
+# Example: python benchmark.py --sizes 1024,4096 --report timings.json
+
+SIZES = (1024, 2048, 4096)
+CELL_SIZE = 30.0
+MIN_SEGMENT_LENGTH = '3'
+# Initiation thresholds for the synthetic terrain at CELL_SIZE, about 1-2 %
+# of the cells for the types that take initial cells as the network and a
+# few tenths of a percent for the others
+THRESHOLDS = {'CATCHMENT_AREA': '1000000',
+              'CLIMATIC_RUNOFF': '500000',
+              'DRAINAGE_NETWORK_STRAHLER_ORDER': '5',
+              'SLOPE_POWER_INDEX': '1000000',
+              'SHEAR_STRESS_INDEX': '400',
+              'COMPLEX_ENERGY_INDEX': '500000',
+              'SHEAR_STRESS_ENERGY': '300',
+              'MEAN_EROSION_CUT': '90',
+              'RESILIENCE': '20000',
+              'CEI_TO_MEAN_EROSION_CUT': '20000'}
+INITIATION_TYPES = ('CATCHMENT_AREA', 'SLOPE_POWER_INDEX', 'SHEAR_STRESS_INDEX',
+                    'CLIMATIC_RUNOFF', 'COMPLEX_ENERGY_INDEX', 'SHEAR_STRESS_ENERGY',
+                    'MEAN_EROSION_CUT', 'RESILIENCE', 'CEI_TO_MEAN_EROSION_CUT',
+                    'DRAINAGE_NETWORK_STRAHLER_ORDER')
+CASES = ('streams', 'ridgelines', 'thickness')
+REFERENCE_TYPE = 'CATCHMENT_AREA'
+RELATIVE_TOLERANCE = 1e-6
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_golden.json')
+
+
+def fractal_surface(size, seed, persistence=0.5):
+    # Sum of bilinearly interpolated random grids of 3, 5, 9, ... nodes,
+    # each octave with persistence times the amplitude of the previous one;
+    # values in [0, 1]
+    rng = np.random.RandomState(seed)
+    surface = np.zeros((size, size))
+    amplitude = 1.0
+    total = 0.0
+    n = 2
+    while n <= size // 2:
+        grid = rng.rand(n + 1, n + 1)
+        position = np.linspace(0, n, size)
+        i = np.minimum(position.astype(np.intp), n - 1)
+        w = position - i
+        rows = grid[i] * (1 - w)[:, None] + grid[i + 1] * w[:, None]
+        surface += amplitude * (rows[:, i] * (1 - w) + rows[:, i + 1] * w)
+        total += amplitude
+        amplitude *= persistence
+        n *= 2
+    return surface / total
+
+
+def synthetic_dem(size, seed=0, relief=600.0, tilt=300.0, incision=60.0):
+    # Fractal relief on a north-south tilt, eroded along its drainage
+    DEM = relief * fractal_surface(size, seed) + tilt * np.linspace(1, 0, size)[:, None]
+    flow_directions = nh.condition(DEM, CELL_SIZE, CELL_SIZE)[1]
+    area = np.log1p(ph.flow_accumulation(flow_directions))
+    return DEM - incision * area / area.max()
+
+
+def synthetic_climate(DEM):
+    # Precipitation and evapotranspiration in mm: wetter and cooler uphill
+    precipitation = 600.0 + 0.4 * DEM
+    evapotranspiration = np.clip(450.0 - 0.2 * DEM, 150.0, None)
+    return precipitation, evapotranspiration
+
+
+def digest(array):
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+def histogram(values):
+    # Counts of the positive integer values as {value: count}
+    values = np.asarray(values).ravel().astype(np.int64)
+    counts = np.bincount(values[values > 0])
+    return dict((str(value), int(counts[value])) for value in np.flatnonzero(counts))
+
+
+def stream_case(inputs, initiation_function_type):
+    precipitation, evapotranspiration = synthetic_climate(inputs['DEM'])
+    start = time.time()
+    results = stream_network_numpy.CEI_extraction(inputs['DEM'],
+                                                  CELL_SIZE,
+                                                  CELL_SIZE,
+                                                  precipitation,
+                                                  evapotranspiration,
+                                                  initiation_function_type,
+                                                  THRESHOLDS[initiation_function_type],
+                                                  MIN_SEGMENT_LENGTH)
+    elapsed = time.time() - start
+    stream_cells = nh.as_mask(results['stream_orders'])
+    statistics = stream_network_numpy.network_statistics(results['stream_orders'], results['flow_directions'],
+                                                         CELL_SIZE, CELL_SIZE)
+    return elapsed, {'threshold': THRESHOLDS[initiation_function_type],
+                     'stream_cells': int(stream_cells.sum()),
+                     'stream_digest': digest(np.packbits(stream_cells)),
+                     'order_cells': histogram(results['stream_orders']),
+                     'total_length': statistics['total_length'],
+                     'total_count': statistics['total_count'],
+                     'order_count': dict((str(order), count) for order, count in
+                                         zip(statistics['values'], statistics['order_count']))}
+
+
+def ridgeline_case(inputs):
+    start = time.time()
+    lines, values = ridgeline_numpy.ridgelines(inputs['stream_orders'], inputs['flow_directions'])
+    masks = np.array([mask for mask, _, _ in lines], dtype=np.int64)
+    filosofov, full_sequence, highest_triplet = ridgeline_numpy.classify(masks, len(values))
+    lengths = np.array([np.hypot(np.diff(rows), np.diff(cols)).sum() for _, rows, cols in lines]) * CELL_SIZE
+    elapsed = time.time() - start
+    return elapsed, {'count': len(lines),
+                     'total_length': float(lengths.sum()),
+                     'filosofov': histogram(filosofov),
+                     'full_sequence': histogram(full_sequence),
+                     'highest_triplet': histogram(highest_triplet)}
+
+
+def thickness_case(inputs):
+    DEM = inputs['DEM']
+    start = time.time()
+    flow = nh.FlowGraph(inputs['flow_directions'])
+    DEM_fill = nh.fill(DEM, CELL_SIZE, CELL_SIZE)
+    zones = nh.watershed(flow, inputs['stream_links'])
+    columns, metrics = watershed_thickness_numpy.thickness_metrics(DEM, zones, inputs['stream_links'] > 0,
+                                                                   CELL_SIZE * CELL_SIZE)
+    mean_erosion_cut = watershed_thickness_numpy.erosion_cut(DEM_fill, flow)[1]
+    metrics['max_erosion_cut'] = float(np.nanmax(mean_erosion_cut))
+    elapsed = time.time() - start
+    metrics['watersheds'] = int(np.count_nonzero(~np.isnan(columns['deltaH_extr'])))
+    return elapsed, metrics
+
+
+def tool_case(inputs, tool, workspace, initiation_function_type=None):
+    # The ArcGIS tools on rasters saved in workspace; outputs are read back
+    # from the text and JSON reports
+    import arcpy
+    import ordered_ridgelines
+    import stream_network
+    import watershed_thickness_metrics
+    arcpy.CheckOutExtension('Spatial')
+    arcpy.env.workspace = workspace
+    arcpy.env.overwriteOutput = True
+    text_output = os.path.join(os.path.dirname(workspace), tool + '.txt')
+    start = time.time()
+    if tool == 'streams':
+        stream_network.CEI_extraction('DEM', 'precipitation', 'evapotranspiration',
+                                      initiation_function_type,
+                                      THRESHOLDS[initiation_function_type],
+                                      MIN_SEGMENT_LENGTH,
+                                      'rivers', text_output,
+                                      'flow_dir', '#', '#', 'stream_links', 'stream_orders', '#',
+                                      'NUMPY')
+        elapsed = time.time() - start
+        statistics = order_report.read_statistics(text_output)
+        return elapsed, {'total_length': statistics['total_length'],
+                         'total_count': statistics['total_count'],
+                         'order_count': dict((str(order), count) for order, count in
+                                             statistics['order_count'].items())}
+    elif tool == 'ridgelines':
+        ordered_ridgelines.Watershed_extraction('flow_dir', 'stream_orders', 'ridgelines', text_output)
+        elapsed = time.time() - start
+        with open(os.path.splitext(text_output)[0] + '_orders.json') as report:
+            report = json.load(report)
+        return elapsed, {'count': report['total_count'], 'total_length': report['total_length']}
+    watershed_thickness_metrics.Basin_parameters('DEM', 'stream_links', '#', 'flow_dir', 'watersheds',
+                                                 'mean_watershed_elevation', 'mean_erosion_cut', text_output)
+    elapsed = time.time() - start
+    metrics = {}
+    with open(text_output) as report:
+        for line in report:
+            name, value = line.rsplit(':', 1)
+            try:
+                metrics[name.strip()] = float(value.split()[0].strip('[]\''))
+            except ValueError:
+                continue
+    return elapsed, metrics
+
+
+def run_case(arguments):
+    # Worker: load the inputs, run one case and measure it
+    case, input_dir, options = arguments
+    inputs = dict((os.path.splitext(name)[0], np.load(os.path.join(input_dir, name)))
+                  for name in os.listdir(input_dir) if name.endswith('.npy'))
+    cpu = profiling.cpu_time()
+    kind, _, detail = case.partition('/')
+    if kind == 'streams':
+        elapsed, outputs = stream_case(inputs, detail)
+    elif kind == 'ridgelines':
+        elapsed, outputs = ridgeline_case(inputs)
+    elif kind == 'thickness':
+        elapsed, outputs = thickness_case(inputs)
+    else:
+        tool, _, initiation_function_type = detail.partition('/')
+        elapsed, outputs = tool_case(inputs, tool, options['workspace'], initiation_function_type or None)
+    return {'seconds': elapsed,
+            'cpu_seconds': profiling.cpu_time() - cpu,
+            'peak_rss': profiling.peak_rss(),
+            'outputs': outputs}
+
+
+def prepare_inputs(size, seed, input_dir, tools=False):
+    # Synthetic rasters and the reference network as .npy files; with tools
+    # also as rasters in a file geodatabase. Returns the workspace (or None)
+    DEM = synthetic_dem(size, seed)
+    np.save(os.path.join(input_dir, 'DEM.npy'), DEM)
+    precipitation, evapotranspiration = synthetic_climate(DEM)
+    results = stream_network_numpy.CEI_extraction(DEM, CELL_SIZE, CELL_SIZE,
+                                                  precipitation, evapotranspiration,
+                                                  REFERENCE_TYPE, THRESHOLDS[REFERENCE_TYPE],
+                                                  MIN_SEGMENT_LENGTH)
+    for name in ('flow_directions', 'stream_orders', 'stream_links'):
+        np.save(os.path.join(input_dir, name + '.npy'), results[name])
+    if not tools:
+        return None
+    import arcpy
+    import raster_io
+    arcpy.CreateFileGDB_management(input_dir, 'benchmark.gdb')
+    workspace = os.path.join(input_dir, 'benchmark.gdb')
+    info = raster_io.RasterInfo(0.0, 0.0, CELL_SIZE, CELL_SIZE, size, size)
+    for name, array, nodata in (('DEM', DEM, None),
+                                ('precipitation', precipitation, None),
+                                ('evapotranspiration', evapotranspiration, None),
+                                ('flow_dir', results['flow_directions'], nh.FLOW_DIR_NODATA),
+                                ('stream_orders', results['stream_orders'], 0),
+                                ('stream_links', results['stream_links'], 0)):
+        raster_io.to_raster(array, info, nodata).save(os.path.join(workspace, name))
+    return workspace
+
+
+def compare(expected, actual, path=''):
+    # Differences between golden and current outputs as a list of messages
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        differences = []
+        for key in sorted(set(expected) | set(actual)):
+            if key not in actual or key not in expected:
+                differences.append('%s/%s: %r != %r' % (path, key, expected.get(key), actual.get(key)))
+            else:
+                differences += compare(expected[key], actual[key], path + '/' + key)
+        return differences
+    if isinstance(expected, float) or isinstance(actual, float):
+        if np.isclose(actual, expected, rtol=RELATIVE_TOLERANCE, atol=0.0, equal_nan=True):
+            return []
+    elif expected == actual:
+        return []
+    return ['%s: %r != %r' % (path, expected, actual)]
+
+
+def case_names(cases, initiation_types, tools=False):
+    names = []
+    for case in cases:
+        if case == 'streams':
+            names += ['streams/' + t for t in initiation_types]
+        else:
+            names.append(case)
+    if tools:
+        names += ['tools/streams/' + REFERENCE_TYPE, 'tools/ridgelines', 'tools/thickness']
+    return names
+
+
+def run_benchmark(sizes=(SIZES[0],), cases=CASES, initiation_types=INITIATION_TYPES,
+                  golden=GOLDEN, update=False, tools=False, seed=0):
+    # Run all cases for all sizes; returns (records, number of failed checks)
+    stored = {}
+    if os.path.exists(golden):
+        with open(golden) as f:
+            stored = json.load(f)
+    stored_seed = stored.get('seed', seed)
+    results = stored.setdefault('results', {})
+    records = []
+    failed = 0
+    ph.set_python_executable()
+    for size in sizes:
+        input_dir = tempfile.mkdtemp(prefix='streamscape_benchmark_')
+        try:
+            workspace = prepare_inputs(size, seed, input_dir, tools)
+            for case in case_names(cases, initiation_types, tools):
+                pool = multiprocessing.Pool(1, maxtasksperchild=1)
+                try:
+                    record = pool.apply(run_case, ((case, input_dir, {'workspace': workspace}),))
+                finally:
+                    pool.close()
+                    pool.join()
+                key = '%s/%d' % (case, size)
+                record.update({'case': case, 'size': size, 'cells_per_second': size * size / record['seconds']})
+                if update:
+                    results[key] = record['outputs']
+                    record['check'] = 'UPDATED'
+                elif key not in results or stored_seed != seed:
+                    record['check'] = 'NO GOLDEN'
+                else:
+                    record['differences'] = compare(results[key], record['outputs'])
+                    record['check'] = 'FAILED' if record['differences'] else 'OK'
+                    failed += bool(record['differences'])
+                records.append(record)
+                print_record(record)
+        finally:
+            shutil.rmtree(input_dir, ignore_errors=True)
+    if update:
+        stored['seed'] = seed
+        with open(golden, 'w') as f:
+            json.dump(stored, f, indent=1, sort_keys=True)
+    return records, failed
+
+
+def print_record(record):
+    peak = record['peak_rss'] / 1024.0 ** 2 if record['peak_rss'] else float('nan')
+    print('%-45s %6d %9.2f s %9.3f Mcells/s %9.1f MB  %s' % (record['case'], record['size'], record['seconds'],
+                                                             record['cells_per_second'] / 1e6, peak, record['check']))
+    for difference in record.get('differences', []):
+        print('    ' + difference)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the tools on synthetic DEMs')
+    parser.add_argument('--sizes', default=str(SIZES[0]),
+                        help='comma separated DEM sizes in cells, e.g. %s' % ','.join(str(s) for s in SIZES))
+    parser.add_argument('--cases', default=','.join(CASES))
+    parser.add_argument('--types', default=','.join(INITIATION_TYPES), help='initiation function types')
+    parser.add_argument('--golden', default=GOLDEN)
+    parser.add_argument('--update', action='store_true', help='store the outputs as golden results')
+    parser.add_argument('--tools', action='store_true', help='also run the ArcGIS tools')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--report', help='JSON file for the timings and outputs')
+    options = parser.parse_args()
+    records, failed = run_benchmark([int(s) for s in options.sizes.split(',')],
+                                    options.cases.split(','),
+                                    options.types.split(','),
+                                    options.golden,
+                                    options.update,
+                                    options.tools,
+                                    options.seed)
+    if options.report:
+        with open(options.report, 'w') as f:
+            json.dump(records, f, indent=1, sort_keys=True)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+import numpy_hydrology as nh
+import parallel_hydrology as ph
+import raster_io
+try:
+    import arcpy
+except ImportError:  # NumPy backend on machines without ArcGIS
+    arcpy = None
+
+
+# Persistent cache of hydro-conditioned DEM products (filled DEM, flow
+# directions, slope and flow accumulation) shared by all the tools.
+# Entries are keyed by a hash of the DEM content and the processing
+# parameters and stored as .npy files, one directory per entry. The
+# modification time of an entry directory is its last use; the least
+# recently used entries are evicted when the cache grows over its size limit.
+#
+# The cache is off unless a directory is given explicitly or set in the
+# STREAMSCAPE_CACHE_DIR environment variable (size limit in megabytes in
+# STREAMSCAPE_CACHE_SIZE_MB).
+#
+# A cached run gives the same rasters as an uncached run of the same
+# backend: the NumPy backend stores numpy_hydrology products
+# (conditioned_dem), the ArcGIS tools store what arcpy.sa computes on their
+# uncached path (conditioned_rasters), including the drop raster of
+# FlowDirection. Both are keyed separately, slope_percent is the Slope
+# (Horn) raster in either.
+
+CACHE_VERSION = 1
+PRODUCTS = ('DEM_fill', 'flow_directions', 'slope_percent', 'flow_accumulation')
+ARCGIS_PRODUCTS = PRODUCTS + ('flow_drop',)
+DEFAULT_SIZE_MB = 4096
+
+
+class HydroCache(object):
+
+    def __init__(self, directory, max_bytes=DEFAULT_SIZE_MB * 1024 ** 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(DEM, **parameters):
+        # Hash of the DEM values, its shape and the processing parameters
+        DEM = np.ascontiguousarray(DEM, dtype=np.float64)
+        digest = hashlib.sha1()
+        digest.update(str((CACHE_VERSION, DEM.shape, sorted(parameters.items()))).encode('utf-8'))
+        digest.update(DEM.data)
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, names=PRODUCTS):
+        # Arrays of a cached entry (memory-mapped, read-only) or None
+        entry = self._entry(key)
+        paths = [os.path.join(entry, name + '.npy') for name in names]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        try:
+            os.utime(entry, None)  # mark as recently used
+            return dict((name, np.load(path, mmap_mode='r')) for name, path in zip(names, paths))
+        except (IOError, OSError):
+            return None  # evicted by a concurrent run
+
+    def put(self, key, arrays):
+        # Store arrays under key (written to a temporary directory first, so
+        # a concurrent reader never sees a partial entry) and evict old entries
+        size = sum(np.asarray(array).nbytes for array in arrays.values())
+        if size > self.max_bytes:
+            return
+        temp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp_')
+        for name, array in arrays.items():
+            np.save(os.path.join(temp, name + '.npy'), np.asarray(array))
+        entry = self._entry(key)
+        try:
+            os.rename(temp, entry)
+        except OSError:
+            # Another run stored the same entry first (rename does not
+            # replace an existing directory, on Windows any existing target)
+            shutil.rmtree(temp, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+        self.evict()
+
+    def evict(self):
+        # Remove least recently used entries until the cache fits its limit
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue  # evicted by a concurrent run
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def open_cache(directory=None):
+    # Cache from an explicit directory or the environment, None if not configured
+    if not directory or directory == '#':
+        directory = os.environ.get('STREAMSCAPE_CACHE_DIR')
+    if not directory:
+        return None
+    size_mb = float(os.environ.get('STREAMSCAPE_CACHE_SIZE_MB', DEFAULT_SIZE_MB))
+    return HydroCache(directory, int(size_mb * 1024 ** 2))
+
+
+def conditioned_dem(DEM, cell_x, cell_y, cache=None):
+    # Filled DEM, flow directions, slope (percent) and unweighted flow
+    # accumulation, read from the cache when the same DEM was processed before
+    DEM = np.asarray(DEM, dtype=np.float64)
+    if cache is not None:
+        key = cache.key(DEM, cell_x=float(cell_x), cell_y=float(cell_y))
+        products = cache.get(key)
+        if products is not None:
+            return products
+    DEM_fill, flow_directions = nh.condition(DEM, cell_x, cell_y)
+    products = {'DEM_fill': DEM_fill,
+                'flow_directions': flow_directions,
+                'slope_percent': nh.slope(DEM, cell_x, cell_y),
+                'flow_accumulation': ph.flow_accumulation(flow_directions)}
+    if cache is not None:
+        cache.put(key, products)
+    return products
+
+
+def conditioned_rasters(DEM_input, cache):
+    # ARCGIS_PRODUCTS of an ArcGIS raster, computed with arcpy.sa when the
+    # same DEM was not processed before, with the RasterInfo needed to
+    # convert them back (see raster_io.to_raster)
+    DEM, info = raster_io.read_raster(DEM_input)
+    key = cache.key(DEM, cell_x=float(info.cell_x), cell_y=float(info.cell_y), backend='ARCGIS')
+    products = cache.get(key, ARCGIS_PRODUCTS)
+    if products is None:
+        products = _arcgis_products(DEM_input, info)
+        cache.put(key, products)
+    return products, info
+
+
+def _arcgis_products(DEM_input, info):
+    # Slope, Fill, FlowDirection (with its drop raster) and FlowAccumulation
+    # as the uncached path of the tools runs them
+    drop = arcpy.CreateScratchName('flow_drop', '', 'RasterDataset')
+    slope_percent = arcpy.sa.Slope(DEM_input, "PERCENT_RISE")
+    DEM_fill = arcpy.sa.Fill(DEM_input)
+    flow_directions = arcpy.sa.FlowDirection(DEM_fill, "NORMAL", drop)
+    flow_accumulation = arcpy.sa.FlowAccumulation(flow_directions)
+    try:
+        return {'DEM_fill': raster_io.read_raster(DEM_fill, info)[0],
+                'flow_directions': raster_io.read_flow_directions(flow_directions, info)[0],
+                'slope_percent': raster_io.read_raster(slope_percent, info)[0],
+                'flow_accumulation': raster_io.read_raster(flow_accumulation, info)[0],
+                'flow_drop': raster_io.read_raster(drop, info)[0]}
+    finally:
+        arcpy.Delete_management(drop)
@@ -0,0 +1,180 @@
+import json
+import os
+import numpy as np
+import numpy_hydrology
+import raster_io
+try:
+    import rasterio
+    import rasterio.features
+    import rasterio.transform
+except ImportError:  # GeoTIFF support is optional, .npy rasters always work
+    rasterio = None
+try:
+    import fiona
+except ImportError:  # GeoPackage output is optional
+    fiona = None
+try:
+    import geopandas
+    import shapely.geometry
+except ImportError:  # GeoParquet output is optional
+    geopandas = None
+
+
+# Raster and vector files without ArcGIS for the command line tools.
+# Rasters are GeoTIFF (.tif, .tiff, through rasterio) or NumPy .npy arrays
+# with the georeference in a <name>.npy.json sidecar ({"x_min", "y_min",
+# "cell_x", "cell_y", "crs", "nodata"}; without a sidecar the grid starts at
+# 0, 0 with the cell size given by the caller). Arrays come back as float64
+# with NaN for NoData on a raster_io.RasterInfo grid (spatial_reference is
+# the CRS as WKT), so the NumPy backend functions work on them unchanged.
+# Vectors are written as GeoJSON (.geojson, .json), GeoPackage (.gpkg,
+# through fiona) or GeoParquet (.parquet, through geopandas).
+
+RASTER_EXTENSIONS = ('.npy', '.tif', '.tiff')
+VECTOR_EXTENSIONS = ('.geojson', '.json', '.gpkg', '.parquet')
+
+
+def _extension(path):
+    return os.path.splitext(path)[1].lower()
+
+
+def _need(module, name, path):
+    if module is None:
+        raise ImportError('%s needs the %s package' % (path, name))
+
+
+def is_raster(path):
+    return _extension(path) in RASTER_EXTENSIONS
+
+
+def sidecar(path):
+    return path + '.json'
+
+
+def read_raster(path, like=None, cell_size=1.0):
+    # Read a raster as float64 with NaN for NoData; like is the RasterInfo of
+    # the grid the raster has to be on (there is no resampling)
+    extension = _extension(path)
+    if extension == '.npy':
+        array = np.load(path).astype(np.float64)
+        georeference = {}
+        if os.path.exists(sidecar(path)):
+            with open(sidecar(path)) as f:
+                georeference = json.load(f)
+        cell_x = georeference.get('cell_x', cell_size)
+        info = raster_io.RasterInfo(georeference.get('x_min', 0.0), georeference.get('y_min', 0.0),
+                                    cell_x, georeference.get('cell_y', cell_x),
+                                    array.shape[0], array.shape[1], georeference.get('crs'))
+        nodata = georeference.get('nodata')
+    elif extension in ('.tif', '.tiff'):
+        _need(rasterio, 'rasterio', path)
+        with rasterio.open(path) as dataset:
+            array = dataset.read(1).astype(np.float64)
+            info = raster_io.RasterInfo(dataset.bounds.left, dataset.bounds.bottom,
+                                        dataset.transform.a, -dataset.transform.e,
+                                        dataset.height, dataset.width,
+                                        dataset.crs.to_wkt() if dataset.crs else None)
+            nodata = dataset.nodata
+    else:
+        raise ValueError('Unsupported raster format: %s' % path)
+    if nodata is not None:
+        array[array == nodata] = np.nan
+    if like is not None:
+        if (info.rows, info.cols) != (like.rows, like.cols):
+            raise ValueError('%s is not on the grid of the DEM' % path)
+        info = like
+    return array, info
+
+
+def read_flow_directions(path, like=None, cell_size=1.0):
+    # D8 flow directions as uint8 codes, NoData is numpy_hydrology.FLOW_DIR_NODATA
+    array, info = read_raster(path, like, cell_size)
+    array = np.where(np.isnan(array), numpy_hydrology.FLOW_DIR_NODATA, array)
+    return array.astype(np.uint8), info
+
+
+def write_raster(path, array, info, nodata=None):
+    # Write an array on the grid of info; NaN is NoData of float rasters
+    array = np.asarray(array)
+    if array.dtype == bool:
+        array = array.astype(np.uint8)
+    if array.dtype.kind == 'f' and nodata is None:
+        nodata = np.nan
+    extension = _extension(path)
+    if extension == '.npy':
+        np.save(path, array)
+        georeference = {'x_min': info.x_min, 'y_min': info.y_min,
+                        'cell_x': info.cell_x, 'cell_y': info.cell_y,
+                        'crs': info.spatial_reference if isinstance(info.spatial_reference, str) else None,
+                        'nodata': None if nodata is None or np.isnan(nodata) else nodata}
+        with open(sidecar(path), 'w') as f:
+            json.dump(georeference, f, indent=1, sort_keys=True)
+    elif extension in ('.tif', '.tiff'):
+        _need(rasterio, 'rasterio', path)
+        transform = rasterio.transform.from_origin(info.x_min, info.y_min + info.rows * info.cell_y,
+                                                   info.cell_x, info.cell_y)
+        crs = info.spatial_reference if isinstance(info.spatial_reference, str) else None
+        with rasterio.open(path, 'w', driver='GTiff', height=info.rows, width=info.cols, count=1,
+                           dtype=array.dtype, crs=crs, transform=transform, nodata=nodata,
+                           compress='deflate', tiled=True) as dataset:
+            dataset.write(array, 1)
+    else:
+        raise ValueError('Unsupported raster format: %s' % path)
+
+
+def zone_polygons(zones, info):
+    # (rings, zone value) for every polygon of a zone raster, 0 is NoData
+    _need(rasterio, 'rasterio', 'Polygon output')
+    zones = np.nan_to_num(np.asarray(zones)).astype(np.int32)
+    transform = rasterio.transform.from_origin(info.x_min, info.y_min + info.rows * info.cell_y,
+                                               info.cell_x, info.cell_y)
+    return [(geometry['coordinates'], int(value))
+            for geometry, value in rasterio.features.shapes(zones, zones > 0, transform=transform)]
+
+
+def _field_type(values):
+    values = np.asarray(values)
+    if values.dtype.kind == 'O':  # Python values with nulls
+        values = np.asarray([value for value in values if value is not None][:1] or [''])
+    kind = values.dtype.kind
+    return 'int' if kind in 'iub' else 'float' if kind == 'f' else 'str'
+
+
+def _value(value):
+    # Plain Python value for the writers, NaN is null
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def write_features(path, geometry_type, geometries, columns, info=None):
+    # Write 'LineString' or 'Polygon' features; geometries are coordinate
+    # lists in GeoJSON nesting, columns a list of (field name, values) pairs
+    # aligned with them
+    names = [name for name, _ in columns]
+    rows = [dict((name, _value(values[n])) for name, values in columns) for n in range(len(geometries))]
+    crs = info.spatial_reference if info is not None and isinstance(info.spatial_reference, str) else None
+    extension = _extension(path)
+    if extension in ('.geojson', '.json'):
+        features = [{'type': 'Feature',
+                     'geometry': {'type': geometry_type, 'coordinates': geometry},
+                     'properties': row} for geometry, row in zip(geometries, rows)]
+        with open(path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    elif extension == '.gpkg':
+        _need(fiona, 'fiona', path)
+        schema = {'geometry': geometry_type,
+                  'properties': dict((name, _field_type(values)) for name, values in columns)}
+        with fiona.open(path, 'w', driver='GPKG', schema=schema, crs_wkt=crs) as layer:
+            layer.writerecords({'geometry': {'type': geometry_type, 'coordinates': geometry},
+                                'properties': row} for geometry, row in zip(geometries, rows))
+    elif extension == '.parquet':
+        _need(geopandas, 'geopandas', path)
+        shapes = [shapely.geometry.shape({'type': geometry_type, 'coordinates': geometry})
+                  for geometry in geometries]
+        frame = geopandas.GeoDataFrame(rows, columns=names, geometry=shapes, crs=crs)
+        frame.to_parquet(path)
+    else:
+        raise ValueError('Unsupported vector format: %s' % path)
@@ -0,0 +1,580 @@
+import heapq
+import numpy as np
+
+
+# D8 engine working on in-memory NumPy arrays.
+# Conventions follow arcpy.sa so the outputs can replace Fill, FlowDirection,
+# FlowAccumulation, StreamLink, StreamOrder and Watershed one by one:
+# * elevation rasters are float arrays, NoData is NaN;
+# * flow directions use ESRI codes (1 = E, 2 = SE, 4 = S, ... 128 = NE),
+#   0 marks an undefined direction (sink) and 255 marks NoData;
+# * stream links, stream orders and watersheds use 0 as NoData.
+
+FLOW_DIR_NODATA = 255
+DIRECTION_CODES = (1, 2, 4, 8, 16, 32, 64, 128)
+ROW_OFFSETS = (0, 1, 1, 1, 0, -1, -1, -1)
+COL_OFFSETS = (1, 1, 0, -1, -1, -1, 0, 1)
+
+
+def _index_dtype(size):
+    # Cell indices fit int32 up to ~46k x 46k cells, which halves memory
+    if size < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
+def _shifted(array, dr, dc, fill_value):
+    # Value of the neighbour at (row + dr, col + dc); fill_value outside the grid
+    rows, cols = array.shape
+    out = np.empty_like(array)
+    out[...] = fill_value
+    dst_r = slice(max(-dr, 0), rows - max(dr, 0))
+    dst_c = slice(max(-dc, 0), cols - max(dc, 0))
+    src_r = slice(max(dr, 0), rows - max(-dr, 0))
+    src_c = slice(max(dc, 0), cols - max(-dc, 0))
+    out[dst_r, dst_c] = array[src_r, src_c]
+    return out
+
+
+def _neighbour(index, k, shape):
+    # Flat index of the k-th D8 neighbour and a mask of neighbours inside the grid
+    rows, cols = shape
+    r = index // cols + ROW_OFFSETS[k]
+    c = index % cols + COL_OFFSETS[k]
+    inside = (r >= 0) & (r < rows) & (c >= 0) & (c < cols)
+    return r * cols + c, inside
+
+
+def as_mask(raster):
+    # Boolean stream mask from 0/1 (or NaN) rasters
+    raster = np.asarray(raster)
+    if raster.dtype == bool:
+        return raster
+    if raster.dtype.kind == 'f':
+        return np.nan_to_num(raster) > 0
+    return raster > 0
+
+
+def slope(DEM, cell_x=1.0, cell_y=1.0):
+    # Slope in percent rise (Horn's 3x3 method, same as arcpy.sa.Slope).
+    # NoData and off-grid neighbours are replaced by the centre cell value
+    z = np.asarray(DEM, dtype=np.float64)
+
+    def nb(dr, dc):
+        values = _shifted(z, dr, dc, np.nan)
+        return np.where(np.isnan(values), z, values)
+
+    a, b, c = nb(-1, -1), nb(-1, 0), nb(-1, 1)
+    d, f = nb(0, -1), nb(0, 1)
+    g, h, i = nb(1, -1), nb(1, 0), nb(1, 1)
+    dz_dx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8.0 * cell_x)
+    dz_dy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8.0 * cell_y)
+    return np.sqrt(dz_dx ** 2 + dz_dy ** 2) * 100.0
+
+
+def _steepest_descent(z, cell_x, cell_y):
+    # Direction of the steepest strictly positive drop (0 if there is none)
+    # and the first direction pointing outside the grid or into NoData
+    valid = ~np.isnan(z)
+    flow_dir = np.zeros(z.shape, dtype=np.uint8)
+    edge_dir = np.zeros(z.shape, dtype=np.uint8)
+    best = np.zeros(z.shape, dtype=np.float64)
+    for k in range(8):
+        neighbour = _shifted(z, ROW_OFFSETS[k], COL_OFFSETS[k], np.nan)
+        distance = np.hypot(ROW_OFFSETS[k] * cell_y, COL_OFFSETS[k] * cell_x)
+        outside = valid & np.isnan(neighbour) & (edge_dir == 0)
+        edge_dir[outside] = DIRECTION_CODES[k]
+        with np.errstate(invalid='ignore'):
+            drop = (z - neighbour) / distance
+            better = drop > best
+        best[better] = drop[better]
+        flow_dir[better] = DIRECTION_CODES[k]
+    flow_dir[~valid] = FLOW_DIR_NODATA
+    return flow_dir, edge_dir
+
+
+FLAT_UNKNOWN = np.iinfo(np.int32).max
+
+
+def _flat_distances(z, codes, distance):
+    # Breadth-first distance of flat cells (code 0) to the nearest draining
+    # cell of the same elevation. distance holds 0 for draining cells,
+    # FLAT_UNKNOWN or an upper bound for flat cells and -2 for NoData; known
+    # values act as seeds, so windows of a larger raster can be relaxed one
+    # after another. Updates distance in place, returns True if it changed
+    shape = z.shape
+    z = z.ravel()
+    codes = codes.ravel()
+    distance = distance.ravel()
+    seeds = np.flatnonzero((distance >= 0) & (distance < FLAT_UNKNOWN))
+    seeds = seeds[np.argsort(distance[seeds], kind='mergesort')]
+    seed_values = distance[seeds]
+    changed = False
+    frontier = np.zeros(0, dtype=seeds.dtype)
+    step = seed_values[0] if seeds.size else 0
+    position = 0
+    while frontier.size or position < seeds.size:
+        # Seeds enter the frontier when the sweep reaches their distance
+        end = np.searchsorted(seed_values, step, side='right')
+        fresh = seeds[position:end]
+        position = end
+        frontier = np.concatenate([frontier, fresh[distance[fresh] == step]])
+        if not frontier.size:
+            if position == seeds.size:
+                break
+            step = seed_values[position]
+            continue
+        reached = []
+        for k in range(8):
+            nb, inside = _neighbour(frontier, k, shape)
+            nb, src = nb[inside], frontier[inside]
+            sel = (codes[nb] == 0) & (distance[nb] > step + 1) & (z[nb] == z[src])
+            reached.append(nb[sel])
+        frontier = np.unique(np.concatenate(reached))
+        step += 1
+        if frontier.size:
+            distance[frontier] = step
+            changed = True
+    return changed
+
+
+def _drain_flats(z, codes, distance):
+    # Flat cells flow to the first neighbour (in code order) of the same
+    # elevation that is one step closer to the outlet of the flat
+    shape = z.shape
+    z = z.ravel()
+    codes = codes.ravel()
+    distance = distance.ravel()
+    flats = np.flatnonzero((codes == 0) & (distance > 0) & (distance < FLAT_UNKNOWN))
+    for k in range(8):
+        pending = flats[codes[flats] == 0]
+        if not pending.size:
+            break
+        nb, inside = _neighbour(pending, k, shape)
+        nb, pending = nb[inside], pending[inside]
+        sel = (distance[nb] == distance[pending] - 1) & (z[nb] == z[pending])
+        codes[pending[sel]] = DIRECTION_CODES[k]
+
+
+def _flat_seeds(codes):
+    # Initial distances for _flat_distances
+    distance = np.where(codes == 0, FLAT_UNKNOWN, 0).astype(np.int32)
+    distance[codes == FLOW_DIR_NODATA] = -2
+    return distance
+
+
+def _resolve_flats(z, flow_dir):
+    # Drain flat areas towards their outlets. Every flat cell gets its
+    # breadth-first distance to the nearest draining cell of the same elevation
+    # and flows to a neighbour that is one step closer
+    if not (flow_dir == 0).any():
+        return
+    distance = _flat_seeds(flow_dir)
+    _flat_distances(z, flow_dir, distance)
+    _drain_flats(z, flow_dir, distance)
+
+
+def flow_direction(DEM_fill, cell_x=1.0, cell_y=1.0):
+    # D8 flow directions in the "NORMAL" mode of arcpy.sa.FlowDirection:
+    # edge cells without an inner downslope neighbour flow outward
+    z = np.asarray(DEM_fill, dtype=np.float64)
+    flow_dir, edge_dir = _steepest_descent(z, cell_x, cell_y)
+    outward = (flow_dir == 0) & (edge_dir > 0)
+    flow_dir[outward] = edge_dir[outward]
+    _resolve_flats(z, flow_dir)
+    return flow_dir
+
+
+def receivers(flow_dir):
+    # Flat index of the downstream cell, -1 for outlets, sinks and NoData
+    codes = np.asarray(flow_dir).ravel()
+    shape = np.shape(flow_dir)
+    out = np.full(codes.size, -1, dtype=_index_dtype(codes.size))
+    for k in range(8):
+        index = np.flatnonzero(codes == DIRECTION_CODES[k])
+        nb, inside = _neighbour(index, k, shape)
+        index, nb = index[inside], nb[inside]
+        sel = codes[nb] != FLOW_DIR_NODATA
+        out[index[sel]] = nb[sel]
+    return out
+
+
+def _flow_levels(rcv, donors=None):
+    # Topological levels of the flow graph (Kahn's algorithm): every cell is
+    # placed one level below the last of its donors, so a level only depends
+    # on the levels before it
+    if donors is None:
+        remaining = np.bincount(rcv[rcv >= 0], minlength=rcv.size)
+    else:
+        remaining = donors.copy()
+    frontier = np.flatnonzero(remaining == 0)
+    levels = []
+    while frontier.size:
+        levels.append(frontier)
+        downstream = rcv[frontier]
+        downstream, counts = np.unique(downstream[downstream >= 0], return_counts=True)
+        remaining[downstream] -= counts
+        frontier = downstream[remaining[downstream] == 0]
+    return levels
+
+
+class FlowGraph(object):
+    # Receivers of a flow direction raster, the number of donors of every
+    # cell and a topological order of the cells (every cell after all of its
+    # donors), computed on first use and shared by all passes over the same
+    # flow directions. The order is one permutation of the cells; its levels
+    # (see _flow_levels) are consecutive slices of it, so a pass is a sweep
+    # along a single array. Functions below that take flow_dir take a
+    # FlowGraph as well
+
+    def __init__(self, flow_dir):
+        self.codes = np.asarray(flow_dir)
+        self.shape = self.codes.shape
+        self._rcv = None
+        self._donors = None
+        self._order = None
+        self._bounds = None
+
+    @property
+    def nodata(self):
+        return self.codes.ravel() == FLOW_DIR_NODATA
+
+    @property
+    def rcv(self):
+        if self._rcv is None:
+            self._rcv = receivers(self.codes)
+        return self._rcv
+
+    @property
+    def donors(self):
+        if self._donors is None:
+            rcv = self.rcv
+            self._donors = np.bincount(rcv[rcv >= 0], minlength=rcv.size).astype(np.int32)
+        return self._donors
+
+    @property
+    def order(self):
+        if self._order is None:
+            levels = _flow_levels(self.rcv, self.donors)
+            dtype = _index_dtype(self.rcv.size)
+            self._order = np.concatenate(levels).astype(dtype) if levels else np.zeros(0, dtype=dtype)
+            self._bounds = np.cumsum([0] + [level.size for level in levels])
+        return self._order
+
+    def levels(self):
+        order = self.order
+        return [order[start:end] for start, end in zip(self._bounds[:-1], self._bounds[1:])]
+
+
+def flow_graph(flow_dir):
+    # FlowGraph of a flow direction raster (the graph itself if it is one)
+    if isinstance(flow_dir, FlowGraph):
+        return flow_dir
+    return FlowGraph(flow_dir)
+
+
+def _accumulate(rcv, stack, levels=None):
+    # Exclusive upstream sums of the columns of stack (cells x weights)
+    acc = np.zeros_like(stack)
+    if levels is None:
+        levels = _flow_levels(rcv)
+    for level in levels:
+        downstream = rcv[level]
+        sel = downstream >= 0
+        level = level[sel]
+        np.add.at(acc, downstream[sel], acc[level] + stack[level])
+    return acc
+
+
+def _weight_stack(size, weights):
+    # Cells x weights array; None stands for the unweighted accumulation
+    stack = np.empty((size, len(weights)), dtype=np.float64)
+    for j, weight in enumerate(weights):
+        if weight is None:
+            stack[:, j] = 1.0
+        else:
+            stack[:, j] = np.nan_to_num(np.asarray(weight, dtype=np.float64).ravel())
+    return stack
+
+
+def multi_flow_accumulation(flow_dir, weights):
+    # Accumulate a stack of weight rasters in a single traversal of the flow
+    # graph. None in the stack stands for the unweighted accumulation.
+    # Values of one cell are stored next to each other, so every level reads
+    # the receivers once and moves all the weights together
+    graph = flow_graph(flow_dir)
+    acc = _accumulate(graph.rcv, _weight_stack(graph.rcv.size, weights), graph.levels())
+    acc[graph.nodata] = np.nan
+    return [acc[:, j].reshape(graph.shape) for j in range(len(weights))]
+
+
+def flow_accumulation(flow_dir, weights=None):
+    # Accumulated weight of all upstream cells (the cell itself is excluded)
+    return multi_flow_accumulation(flow_dir, [weights])[0]
+
+
+def upstream_maximum(flow_dir, values):
+    # Maximum of the cell value and all values upstream of it (NaN is ignored)
+    graph = flow_graph(flow_dir)
+    rcv = graph.rcv
+    values = np.asarray(values, dtype=np.float64).ravel()
+    out = np.where(np.isnan(values), -np.inf, values)
+    for level in graph.levels():
+        downstream = rcv[level]
+        sel = downstream >= 0
+        np.maximum.at(out, downstream[sel], out[level[sel]])
+    out[graph.nodata] = np.nan
+    return out.reshape(graph.shape)
+
+
+def flow_drop(DEM_fill, flow_dir, cell_x=1.0, cell_y=1.0):
+    # Drop raster of arcpy.sa.FlowDirection: percent rise from every cell to
+    # the first lower cell on its flow path over the length of that path
+    # (one step off flats, the path across them on flats), 0 where the path
+    # leaves the grid or ends in a sink before a lower cell, NaN on NoData
+    graph = flow_graph(flow_dir)
+    rcv = graph.rcv
+    z = np.asarray(DEM_fill, dtype=np.float64).ravel()
+    step_length = np.zeros(256, dtype=np.float64)
+    for k in range(8):
+        step_length[DIRECTION_CODES[k]] = np.hypot(ROW_OFFSETS[k] * cell_y, COL_OFFSETS[k] * cell_x)
+    step = step_length[graph.codes.ravel()]
+    downstream = np.where(rcv >= 0, rcv, 0)
+    with np.errstate(invalid='ignore'):
+        lower = (rcv >= 0) & (z[downstream] < z)
+    target = np.where(lower, rcv, -1)
+    length = np.where(lower, step, 0.0)
+    # Flat cells take the first lower cell of their receiver, downstream first
+    flat = (rcv >= 0) & ~lower
+    if flat.any():
+        for level in reversed(graph.levels()):
+            level = level[flat[level]]
+            target[level] = target[rcv[level]]
+            length[level] = step[level] + length[rcv[level]]
+    drop = np.zeros(z.size, dtype=np.float64)
+    found = target >= 0
+    drop[found] = (z[found] - z[target[found]]) / length[found] * 100.0
+    drop[graph.nodata] = np.nan
+    return drop.reshape(graph.shape)
+
+
+def stream_receivers(stream, rcv):
+    # Receivers restricted to stream-to-stream connections
+    srcv = np.where(rcv >= 0, rcv, 0)
+    return np.where(stream & (rcv >= 0) & stream[srcv], rcv, -1).astype(rcv.dtype)
+
+
+def stream_link(stream_cells, flow_dir):
+    # Unique values for stream sections between junctions. A link starts at
+    # a source cell or at a junction cell (two or more stream donors)
+    graph = flow_graph(flow_dir)
+    stream = as_mask(stream_cells).ravel() & ~graph.nodata
+    rcv = graph.rcv
+    srcv = stream_receivers(stream, rcv)
+    donors = np.bincount(srcv[srcv >= 0], minlength=stream.size)
+    starts = np.flatnonzero(stream & (donors != 1))
+    links = np.zeros(stream.size, dtype=np.int32)
+    links[starts] = np.arange(1, starts.size + 1)
+    # Cells with a single stream donor inherit the link of that donor
+    donor = np.full(stream.size, -1, dtype=rcv.dtype)
+    sel = srcv >= 0
+    donor[srcv[sel]] = np.flatnonzero(sel)
+    for level in graph.levels():
+        level = level[stream[level] & (links[level] == 0)]
+        links[level] = links[donor[level]]
+    return links.reshape(graph.shape)
+
+
+def order_segments(stream_orders, flow_dir):
+    # Unique values for runs of equal stream order. A segment starts at a
+    # cell without a stream donor of its own order and ends where it joins a
+    # stream of another order, which is StreamLink of the cells of every
+    # order taken separately
+    graph = flow_graph(flow_dir)
+    order = np.asarray(stream_orders).ravel()
+    stream = (order > 0) & ~graph.nodata
+    rcv = graph.rcv
+    srcv = stream_receivers(stream, rcv)
+    same = (srcv >= 0) & (order[np.maximum(srcv, 0)] == order)
+    continues = np.zeros(stream.size, dtype=bool)
+    continues[srcv[same]] = True
+    starts = np.flatnonzero(stream & ~continues)
+    segments = np.zeros(stream.size, dtype=np.int32)
+    segments[starts] = np.arange(1, starts.size + 1)
+    donor = np.full(stream.size, -1, dtype=rcv.dtype)
+    donor[srcv[same]] = np.flatnonzero(same)
+    for level in graph.levels():
+        level = level[continues[level]]
+        segments[level] = segments[donor[level]]
+    return segments.reshape(graph.shape)
+
+
+def stream_order(stream_cells, flow_dir):
+    # Strahler order: sources get 1, the order grows by one where two or more
+    # streams of the highest incoming order meet
+    graph = flow_graph(flow_dir)
+    stream = as_mask(stream_cells).ravel() & ~graph.nodata
+    rcv = graph.rcv
+    srcv = stream_receivers(stream, rcv)
+    order = np.zeros(stream.size, dtype=np.int32)
+    up_max = np.zeros(stream.size, dtype=np.int32)
+    up_count = np.zeros(stream.size, dtype=np.int32)
+    for level in graph.levels():
+        level = level[stream[level]]
+        if not level.size:
+            continue
+        level_order = np.where(up_count[level] >= 2, up_max[level] + 1, np.maximum(up_max[level], 1))
+        order[level] = level_order
+        downstream = srcv[level]
+        sel = downstream >= 0
+        downstream, level_order = downstream[sel], level_order[sel]
+        # Track the highest incoming order and how many donors reach it
+        previous = up_max[downstream]
+        np.maximum.at(up_max, downstream, level_order)
+        up_count[downstream[up_max[downstream] != previous]] = 0
+        np.add.at(up_count, downstream, level_order == up_max[downstream])
+    return order.reshape(graph.shape)
+
+
+def watershed(flow_dir, pour_points):
+    # Every cell takes the value of the first pour point downstream of it
+    graph = flow_graph(flow_dir)
+    rcv = graph.rcv
+    labels = np.nan_to_num(np.asarray(pour_points)).astype(np.int32).ravel()
+    labels[graph.nodata] = 0
+    for level in reversed(graph.levels()):
+        level = level[labels[level] == 0]
+        downstream = rcv[level]
+        sel = downstream >= 0
+        labels[level[sel]] = labels[downstream[sel]]
+    return labels.reshape(graph.shape)
+
+
+def fill(DEM, cell_x=1.0, cell_y=1.0):
+    # Depression filling by a priority-flood over the graph of drainage basins.
+    # Cells are grouped by the local minimum their steepest descent path ends
+    # in; the spill height between adjacent basins is the lowest shared edge.
+    # Flooding that graph from the raster edge gives every basin its outlet
+    # level, and the filled surface is max(DEM, outlet level of the basin)
+    z = np.asarray(DEM, dtype=np.float64)
+    return _filled(z, cell_x, cell_y)[0].reshape(z.shape)
+
+
+def condition(DEM, cell_x=1.0, cell_y=1.0):
+    # Filled DEM and its flow directions in one pass, the same as
+    # flow_direction(fill(DEM)). The steepest descent computed for the
+    # basins of the fill stays valid wherever neither the cell nor a
+    # neighbour was raised, so only the cells around filled depressions are
+    # recomputed before the flats are drained
+    z = np.asarray(DEM, dtype=np.float64)
+    shape = z.shape
+    filled, flow_dir, edge_dir = _filled(z, cell_x, cell_y)
+    raised = (filled > z.ravel()).reshape(shape)
+    if raised.any():
+        changed = raised.copy()
+        for k in range(8):
+            changed |= _shifted(raised, ROW_OFFSETS[k], COL_OFFSETS[k], False)
+        index = np.flatnonzero(changed.ravel() & ~np.isnan(filled))
+        flow_dir.ravel()[index] = _steepest_descent_at(filled, index, shape, cell_x, cell_y)
+    outward = (flow_dir == 0) & (edge_dir > 0)
+    flow_dir[outward] = edge_dir[outward]
+    filled = filled.reshape(shape)
+    _resolve_flats(filled, flow_dir)
+    return filled, flow_dir
+
+
+def _steepest_descent_at(z, index, shape, cell_x, cell_y):
+    # _steepest_descent of the cells index of the flat array z
+    flow_dir = np.zeros(index.size, dtype=np.uint8)
+    best = np.zeros(index.size, dtype=np.float64)
+    centre = z[index]
+    for k in range(8):
+        nb, inside = _neighbour(index, k, shape)
+        neighbour = np.where(inside, z[np.where(inside, nb, 0)], np.nan)
+        distance = np.hypot(ROW_OFFSETS[k] * cell_y, COL_OFFSETS[k] * cell_x)
+        with np.errstate(invalid='ignore'):
+            drop = (centre - neighbour) / distance
+            better = drop > best
+        best[better] = drop[better]
+        flow_dir[better] = DIRECTION_CODES[k]
+    return flow_dir
+
+
+def _filled(z, cell_x, cell_y):
+    # Flat filled surface, steepest descent codes and edge directions of z
+    shape = z.shape
+    flat_z = z.ravel()
+    valid = ~np.isnan(flat_z)
+    codes, edge_dir = _steepest_descent(z, cell_x, cell_y)
+    graph = FlowGraph(codes)
+    # Label basins: every sink is the pour point of its own basin
+    sinks = np.flatnonzero(valid & (graph.rcv == -1))
+    pour_points = np.zeros(flat_z.size, dtype=np.int32)
+    pour_points[sinks] = np.arange(1, sinks.size + 1)
+    basins = watershed(graph, pour_points.reshape(shape)).ravel()
+    n_basins = sinks.size + 1  # basin 0 is the outside of the raster
+
+    # Spill heights between neighbouring basins (each cell pair is seen once)
+    keys = []
+    heights = []
+    index = np.flatnonzero(valid)
+    for k in range(4):
+        nb, inside = _neighbour(index, k, shape)
+        a, b = index[inside], nb[inside]
+        sel = valid[b] & (basins[a] != basins[b])
+        a, b = a[sel], b[sel]
+        keys.append(_spill_keys(basins[a], basins[b], n_basins))
+        heights.append(np.maximum(flat_z[a], flat_z[b]))
+    # Edge cells spill to the outside at their own elevation
+    edge = np.flatnonzero(edge_dir.ravel() > 0)
+    keys.append(basins[edge].astype(np.int64))
+    heights.append(flat_z[edge])
+    keys, heights = _lowest_spills(np.concatenate(keys), np.concatenate(heights))
+
+    level = _flood_basins(keys, heights, n_basins)
+    filled = np.where(valid, np.maximum(flat_z, level[basins]), np.nan)
+    return filled, codes, edge_dir
+
+
+def _spill_keys(basin_a, basin_b, n_basins):
+    # One int64 key per unordered pair of basins
+    low = np.minimum(basin_a, basin_b).astype(np.int64)
+    high = np.maximum(basin_a, basin_b).astype(np.int64)
+    return low * n_basins + high
+
+
+def _lowest_spills(keys, heights):
+    # Lowest spill height for every pair of basins
+    sort = np.lexsort((heights, keys))
+    keys, heights = keys[sort], heights[sort]
+    first = np.ones(keys.size, dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return keys[first], heights[first]
+
+
+def _flood_basins(keys, heights, n_basins):
+    # Priority-flood over the basin graph from the outside node (basin 0);
+    # returns the outlet level of every basin
+    low, high = keys // n_basins, keys % n_basins
+    # Adjacency lists of the basin graph
+    ends = np.concatenate([low, high])
+    other = np.concatenate([high, low])
+    spill = np.concatenate([heights, heights])
+    sort = np.argsort(ends, kind='mergesort')
+    other, spill = other[sort], spill[sort]
+    indptr = np.searchsorted(ends[sort], np.arange(n_basins + 1))
+
+    level = np.full(n_basins, np.inf)
+    done = np.zeros(n_basins, dtype=bool)
+    queue = [(-np.inf, 0)]
+    while queue:
+        height, basin = heapq.heappop(queue)
+        if done[basin]:
+            continue
+        done[basin] = True
+        level[basin] = height
+        for j in range(indptr[basin], indptr[basin + 1]):
+            if not done[other[j]]:
+                heapq.heappush(queue, (max(height, spill[j]), other[j]))
+    level[~np.isfinite(level)] = -np.inf
+    return level
@@ -0,0 +1,146 @@
+import csv
+import json
+import os
+import numpy as np
+
+
+# Machine-readable per-order statistics. The tools collect one value per
+# output segment (order, length and optional means such as slope or
+# catchment area) while the segments are written, and the report is reduced
+# from those arrays with bincount instead of selecting every order from the
+# output feature class. The report is written next to the text output as
+# <text_output>_orders.csv (one row per order) and <text_output>_orders.json
+# (totals and the same rows).
+
+
+def order_summary(orders, lengths, values, means=None):
+    # One row per order in values: count, total and mean length and the
+    # mean of every (name, per-segment array) pair in means; NaN values of
+    # a segment are left out of its order's mean
+    orders = np.asarray(orders, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.float64)
+    n_orders = max(values) + 1 if values else 1
+    count = np.bincount(orders, minlength=n_orders)
+    length = np.bincount(orders, weights=lengths, minlength=n_orders)
+    averaged = []
+    for name, segment_values in means or []:
+        segment_values = np.asarray(segment_values, dtype=np.float64)
+        known = ~np.isnan(segment_values)
+        sums = np.bincount(orders[known], weights=segment_values[known], minlength=n_orders)
+        counts = np.bincount(orders[known], minlength=n_orders)
+        averaged.append(('mean_' + name, sums, counts))
+    rows = []
+    for order in values:
+        row = {'order': int(order),
+               'count': int(count[order]),
+               'length': float(length[order]),
+               'mean_length': float(length[order] / count[order]) if count[order] else None}
+        for name, sums, counts in averaged:
+            row[name] = float(sums[order] / counts[order]) if counts[order] else None
+        rows.append(row)
+    return rows
+
+
+def report_path(text_output, extension):
+    return os.path.splitext(text_output)[0] + '_orders' + extension
+
+
+def write_report(text_output, totals, rows):
+    # CSV and JSON reports next to text_output; totals is a dict of
+    # network-wide values, rows come from order_summary
+    names = set(name for row in rows for name in row)
+    fields = ['order'] + sorted(names - set(['order']))
+    with open(report_path(text_output, '.csv'), 'w') as out:
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(['' if row.get(name) is None else row[name] for name in fields])
+    report = dict(totals)
+    report['orders'] = rows
+    with open(report_path(text_output, '.json'), 'w') as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+
+
+def write_statistics(out, total_length, total_count, values, order_length, order_count):
+    # Write network statistics in the text_output format
+    out.write('Total river length: ' + str(total_length) + ' m\n')
+    out.write('Total count: ' + str(total_count) + '\n')
+    for i in values:  # array starts at 0, but orders start from 1, so [i-1]
+        if i == 1:
+            suffix = "nd "
+        elif i == 2:
+            suffix = 'rd '
+        else:
+            suffix = 'st '
+        out.write(str(i) + suffix + 'order length: '+ str(order_length[i-1]) + 'm \n')
+        out.write(str(i) + suffix + 'order count: ' + str(order_count[i-1]) + '\n')
+
+
+def read_statistics(text_output):
+    # Statistics written by write_statistics as a dict of
+    # {'total_length', 'total_count', 'order_length', 'order_count'};
+    # per order values are dicts keyed by order
+    stats = {'order_length': {}, 'order_count': {}}
+    with open(text_output) as lines:
+        for line in lines:
+            name, _, value = line.partition(':')
+            value = value.strip().rstrip('m').strip()
+            if name == 'Total river length':
+                stats['total_length'] = float(value)
+            elif name == 'Total count':
+                stats['total_count'] = int(value)
+            elif name.endswith('order length'):
+                stats['order_length'][int(name[:-len('order length')].rstrip()[:-2])] = float(value)
+            elif name.endswith('order count'):
+                stats['order_count'][int(name[:-len('order count')].rstrip()[:-2])] = int(value)
+    return stats
+
+
+def write_stream_statistics(text_output, table):
+    # text_output and the CSV / JSON reports of a stream network from the
+    # per-segment arrays of its features: 'order', 'length' and, if there,
+    # 'mean_slope' and 'catchment_area'. Returns the order values
+    values = sorted(int(i) for i in np.unique(table['order']))
+    total_length = float(table['length'].sum())
+    total_count = table['length'].size
+    # Count number, total and mean length, mean slope and mean catchment
+    # area for every order
+    means = [(name, table[field]) for name, field in (('slope', 'mean_slope'), ('catchment_area', 'catchment_area'))
+             if field in table]
+    summary = order_summary(table['order'], table['length'], values, means)
+    # order_length[i-1] and order_count[i-1] hold the values of order i
+    order_length = [0.0] * max(values or [0])
+    order_count = [0] * max(values or [0])
+    for row in summary:
+        order_length[row['order'] - 1] = row['length']
+        order_count[row['order'] - 1] = row['count']
+    with open(text_output, 'w') as out:
+        write_statistics(out, total_length, total_count, values, order_length, order_count)
+    write_report(text_output, {'total_length': total_length, 'total_count': total_count}, summary)
+    return values
+
+
+def ridgeline_summary(full_sequence, highest_triplet, lengths, values):
+    # One row per order with count, length and mean_length of both ridgeline
+    # classifications (suffixes _full_sequence and _highest_triplet)
+    rows = []
+    for full, triplet in zip(order_summary(full_sequence, lengths, values),
+                             order_summary(highest_triplet, lengths, values)):
+        row = {'order': full['order']}
+        for name in ('count', 'length', 'mean_length'):
+            row[name + '_full_sequence'] = full[name]
+            row[name + '_highest_triplet'] = triplet[name]
+        rows.append(row)
+    return rows
+
+
+def write_ridgeline_statistics(out, total_length, total_count, rows):
+    # Write ridgeline statistics in the text_output format, highest order first
+    out.write('Total watershed length: ' + str(total_length) + ' m\n')
+    out.write('Total count: ' + str(total_count) + '\n')
+    for row in reversed(rows):
+        i = str(row['order']) + ' '
+        out.write(i + 'order length (full sequence): ' + str(row['length_full_sequence']) + 'm \n')
+        out.write(i + 'order length (highest triplet): ' + str(row['length_highest_triplet']) + 'm \n')
+        out.write(i + 'order count (full sequence): ' + str(row['count_full_sequence']) + '\n')
+        out.write(i + 'order count (highest triplet): ' + str(row['count_highest_triplet']) + '\n')
@@ -0,0 +1,119 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import numpy_hydrology as nh
+
+
+# Flow accumulation on a process pool. Cells draining to different outlets
+# are independent, so the grid is split into outlet-rooted basins, basins
+# are grouped into one chunk of about equal size per worker and every
+# worker accumulates its chunk on its own. Receivers, weights and results
+# are shared between the processes as memory-mapped files, each worker
+# writes only the cells of its own basins.
+#
+# The number of processes is taken from the STREAMSCAPE_PROCESSES
+# environment variable (default 1, i.e. the serial numpy_hydrology
+# functions). A single basin is never split, so the speed-up is bounded by
+# the share of the largest basin in the raster.
+
+MIN_PARALLEL_CELLS = 1000000
+
+_shared = {}
+
+
+def default_processes():
+    value = os.environ.get('STREAMSCAPE_PROCESSES', '1')
+    if value.upper() == 'ALL':
+        return multiprocessing.cpu_count()
+    return max(int(value), 1)
+
+
+def set_python_executable():
+    # Inside ArcMap sys.executable is the application itself, worker
+    # processes have to be started with the interpreter instead
+    if os.name == 'nt' and not os.path.basename(sys.executable).lower().startswith('python'):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+
+
+def outlets(rcv):
+    # Flat index of the outlet every cell drains to (pointer jumping)
+    outlet = np.where(rcv >= 0, rcv, np.arange(rcv.size, dtype=rcv.dtype))
+    while True:
+        jumped = outlet[outlet]
+        if np.array_equal(jumped, outlet):
+            return outlet
+        outlet = jumped
+
+
+def basin_chunks(outlet, n_chunks):
+    # Cells sorted by outlet and (start, end) ranges of that order, cut at
+    # basin boundaries into n_chunks parts of about equal size
+    order = np.argsort(outlet, kind='mergesort')
+    sorted_outlet = outlet[order]
+    # Start of every basin in the sorted order
+    starts = np.flatnonzero(np.r_[True, sorted_outlet[1:] != sorted_outlet[:-1]])
+    targets = np.arange(1, n_chunks) * (outlet.size / float(n_chunks))
+    cuts = np.unique(starts[np.minimum(np.searchsorted(starts, targets), starts.size - 1)])
+    bounds = np.unique(np.r_[0, cuts, outlet.size])
+    return order, list(zip(bounds[:-1], bounds[1:]))
+
+
+def _init_worker(paths):
+    for name, path in paths.items():
+        _shared[name] = np.load(path, mmap_mode='r+' if name == 'acc' else 'r')
+
+
+def _accumulate_chunk(bounds):
+    start, end = bounds
+    cells = np.asarray(_shared['order'][start:end])
+    downstream = _shared['rcv'][cells]
+    # Receivers in the numbering of the chunk
+    rcv = np.where(downstream >= 0, _shared['position'][np.maximum(downstream, 0)] - start, -1)
+    stack = np.asarray(_shared['stack'][cells])
+    _shared['acc'][cells] = nh._accumulate(rcv.astype(nh._index_dtype(cells.size)), stack)
+
+
+def multi_flow_accumulation(flow_dir, weights, processes=None, scratch_dir=None):
+    # Same as numpy_hydrology.multi_flow_accumulation, run on processes workers
+    graph = nh.flow_graph(flow_dir)
+    processes = processes or default_processes()
+    if processes < 2 or graph.codes.size < MIN_PARALLEL_CELLS:
+        return nh.multi_flow_accumulation(graph, weights)
+    rcv = graph.rcv
+    order, chunks = basin_chunks(outlets(rcv), processes)
+    position = np.empty(order.size, dtype=order.dtype)
+    position[order] = np.arange(order.size, dtype=order.dtype)
+
+    directory = tempfile.mkdtemp(dir=scratch_dir, prefix='streamscape_')
+    try:
+        arrays = {'rcv': rcv,
+                  'order': order,
+                  'position': position,
+                  'stack': nh._weight_stack(rcv.size, weights)}
+        paths = {}
+        for name, array in arrays.items():
+            paths[name] = os.path.join(directory, name + '.npy')
+            np.save(paths[name], array)
+        del arrays
+        paths['acc'] = os.path.join(directory, 'acc.npy')
+        acc = np.lib.format.open_memmap(paths['acc'], mode='w+', dtype=np.float64,
+                                        shape=(rcv.size, len(weights)))
+        set_python_executable()
+        pool = multiprocessing.Pool(min(processes, len(chunks)), _init_worker, (paths,))
+        try:
+            pool.map(_accumulate_chunk, chunks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        acc = np.array(acc)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    acc[graph.nodata] = np.nan
+    return [acc[:, j].reshape(graph.shape) for j in range(len(weights))]
+
+
+def flow_accumulation(flow_dir, weights=None, processes=None, scratch_dir=None):
+    return multi_flow_accumulation(flow_dir, [weights], processes, scratch_dir)[0]
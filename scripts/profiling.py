@@ -0,0 +1,259 @@
+import functools
+import json
+import os
+import sys
+import time
+try:
+    import psutil
+except ImportError:  # written bytes (and peak memory on Windows) from the OS where possible
+    psutil = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Per-stage run profile of the tools. A tool run is a session; inside it
+# named stages are timed either as with blocks (stage) or as consecutive
+# steps of a linear script (steps: a step lasts until the next step of the
+# same function, the end of the enclosing stage or the end of the session),
+# stages started inside another stage are nested in it. For every stage the
+# wall time, the CPU time, the peak resident memory of the process at the
+# end of the stage and the bytes the process wrote during the stage are
+# recorded. Peak memory is taken from getrusage on POSIX and from psutil on
+# Windows, written bytes from psutil if it is installed and /proc/self/io
+# otherwise; values are left empty where neither is available. Only the tool process itself is measured, not the workers
+# of parallel_hydrology.
+#
+# Profiling is off unless the STREAMSCAPE_PROFILE environment variable is
+# set to an output file or directory (one <tool>_<time>_<pid> file per run,
+# e.g. for batch jobs).
+# STREAMSCAPE_PROFILE_FORMAT selects 'JSON' (default) or 'CHROME' (Chrome
+# trace event format, for chrome://tracing or Perfetto). When it is off,
+# stage and steps return a shared object that does nothing.
+
+_timer = getattr(time, 'perf_counter', time.time)
+_profiler = None
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def peak_rss():
+    # Peak resident memory of the process in bytes, None if unknown: the
+    # maximum resident set size of getrusage on POSIX, the peak working set
+    # (through psutil) on Windows
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes on Linux
+    if psutil is not None:
+        return getattr(psutil.Process().memory_info(), 'peak_wset', None)
+    return None
+
+
+def bytes_written():
+    # Bytes written by the process so far, None if unknown
+    if psutil is not None:
+        try:
+            return psutil.Process().io_counters().write_bytes
+        except (AttributeError, NotImplementedError):  # macOS
+            return None
+    try:
+        with open('/proc/self/io') as counters:
+            for line in counters:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class Profiler(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.records = []
+        self.stack = []  # open stages: [name, wall, cpu, written]
+        self.origin = _timer()
+        self.started = time.time()
+        self.begin(name)
+
+    def begin(self, name):
+        frame = [name, _timer(), cpu_time(), bytes_written()]
+        self.stack.append(frame)
+        return frame
+
+    def end(self):
+        name, wall, cpu, written = self.stack.pop()
+        now = bytes_written()
+        self.records.append({'name': name,
+                             'path': '/'.join([frame[0] for frame in self.stack] + [name]),
+                             'depth': len(self.stack),
+                             'start': wall - self.origin,
+                             'wall_time': _timer() - wall,
+                             'cpu_time': cpu_time() - cpu,
+                             'peak_rss': peak_rss(),
+                             'bytes_written': now - written if None not in (now, written) else None})
+
+    def end_to(self, frame):
+        # End frame and the stages still open inside it
+        if any(open_frame is frame for open_frame in self.stack):
+            while self.stack[-1] is not frame:
+                self.end()
+            self.end()
+
+    def close(self):
+        while self.stack:
+            self.end()
+
+    def report(self):
+        # Stages in the order they started
+        return {'tool': self.name,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'stages': sorted(self.records, key=lambda record: (record['start'], record['depth']))}
+
+    def trace_events(self):
+        # Complete events ('X') in microseconds and a peak memory counter
+        pid = os.getpid()
+        events = []
+        for record in self.report()['stages']:
+            start = int(record['start'] * 1e6)
+            end = start + int(record['wall_time'] * 1e6)
+            events.append({'name': record['name'], 'cat': self.name, 'ph': 'X', 'pid': pid, 'tid': 0,
+                           'ts': start, 'dur': end - start,
+                           'args': {'cpu_time': record['cpu_time'],
+                                    'peak_rss': record['peak_rss'],
+                                    'bytes_written': record['bytes_written']}})
+            if record['peak_rss'] is not None:
+                events.append({'name': 'peak_rss', 'ph': 'C', 'pid': pid, 'tid': 0, 'ts': end,
+                               'args': {'bytes': record['peak_rss']}})
+        return events
+
+    def write(self, path, format='JSON'):
+        if format.upper() == 'CHROME':
+            data = {'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}
+        else:
+            data = self.report()
+        with open(path, 'w') as out:
+            json.dump(data, out, indent=1, sort_keys=True)
+
+
+class _Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.profiler = _profiler
+        if self.profiler is not None:
+            self.frame = self.profiler.begin(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler is not None:
+            self.profiler.end_to(self.frame)
+
+
+class _Steps(object):
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.frame = None
+
+    def next(self, name):
+        self.end()
+        self.frame = self.profiler.begin(name)
+
+    def end(self):
+        if self.frame is not None:
+            self.profiler.end_to(self.frame)
+            self.frame = None
+
+
+class _Nothing(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def next(self, name):
+        pass
+
+    def end(self):
+        pass
+
+
+_NOTHING = _Nothing()
+
+
+def enabled():
+    return _profiler is not None
+
+
+def stage(name):
+    # Context manager timing the enclosed block as stage name
+    if _profiler is None:
+        return _NOTHING
+    return _Stage(name)
+
+
+def steps():
+    # Consecutive stages of a linear script: steps.next(name) ends the
+    # previous step of the same object and starts the next one
+    if _profiler is None:
+        return _NOTHING
+    return _Steps(_profiler)
+
+
+def output_path(tool, destination):
+    if os.path.isdir(destination):
+        name = '%s_%s_%d.json' % (tool, time.strftime('%Y%m%d_%H%M%S'), os.getpid())
+        return os.path.join(destination, name)
+    return destination
+
+
+class session(object):
+    # Profile of a whole tool run written to destination (default: the
+    # STREAMSCAPE_PROFILE environment variable). Inside another session it is
+    # an ordinary stage, so a tool called from another tool is profiled as
+    # part of the outer run
+
+    def __init__(self, tool, destination=None, format=None):
+        self.tool = tool
+        self.destination = destination or os.environ.get('STREAMSCAPE_PROFILE') or None
+        self.format = format or os.environ.get('STREAMSCAPE_PROFILE_FORMAT', 'JSON')
+        self.stage = None
+        self.profiler = None
+
+    def __enter__(self):
+        global _profiler
+        if _profiler is not None:
+            self.stage = _Stage(self.tool)
+            self.stage.__enter__()
+        elif self.destination:
+            self.profiler = _profiler = Profiler(self.tool)
+        return self
+
+    def __exit__(self, *exc_info):
+        global _profiler
+        if self.stage is not None:
+            self.stage.__exit__(*exc_info)
+        elif self.profiler is not None:
+            _profiler = None
+            self.profiler.close()
+            self.profiler.write(output_path(self.tool, self.destination), self.format)
+
+
+def profiled(tool):
+    # Decorator running a tool function in a session
+    def decorate(function):
+        @functools.wraps(function)
+        def run(*args, **kwargs):
+            with session(tool):
+                return function(*args, **kwargs)
+        return run
+    return decorate
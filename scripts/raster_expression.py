@@ -0,0 +1,47 @@
+import numpy as np
+try:
+    import numexpr
+except ImportError:  # evaluated block by block with NumPy
+    numexpr = None
+
+
+# Fused evaluation of raster algebra formulas such as
+# 'sqrt(flow_accumulation * cell_area) * slope_tangent'. The formula is
+# compiled once and evaluated over blocks of cells, so the intermediate
+# results of its operators only ever exist for one block instead of the
+# whole raster. numexpr is used when it is installed (it does the blocking
+# and multithreading itself), otherwise the blocks are evaluated with NumPy.
+# Division by zero and NaN give inf and NaN silently, as in Map Algebra
+
+BLOCK_CELLS = 1 << 16
+
+FUNCTIONS = {'sqrt': np.sqrt,
+             'exp': np.exp,
+             'log': np.log,
+             'abs': np.abs,
+             'where': np.where}
+
+
+def evaluate(expression, variables, out=None):
+    # Value of expression for arrays of one shape and scalars in variables
+    variables = dict((name, np.asarray(value)) for name, value in variables.items())
+    shapes = set(value.shape for value in variables.values() if value.ndim)
+    if len(shapes) > 1:
+        raise ValueError('Rasters of different shapes in expression: %s' % expression)
+    shape = shapes.pop() if shapes else ()
+    if numexpr is not None:
+        return numexpr.evaluate(expression, local_dict=variables, out=out)
+
+    code = compile(expression, '<expression>', 'eval')
+    namespace = dict(FUNCTIONS, __builtins__={})
+    if out is None:
+        out = np.empty(shape, dtype=np.float64)
+    flat = dict((name, value.ravel() if value.ndim else value) for name, value in variables.items())
+    out_flat = out.reshape(-1)
+    size = out_flat.size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, max(size, 1), BLOCK_CELLS):
+            block = dict((name, value[start:start + BLOCK_CELLS] if value.ndim else value)
+                         for name, value in flat.items())
+            out_flat[start:start + BLOCK_CELLS] = eval(code, namespace, block)
+    return out
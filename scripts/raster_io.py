@@ -0,0 +1,74 @@
+import numpy as np
+import numpy_hydrology
+try:
+    import arcpy
+except ImportError:  # NumPy backend on machines without ArcGIS
+    arcpy = None
+
+
+# Conversion between ArcGIS rasters and NumPy arrays for the NumPy backend.
+# Arrays are float64 with NaN for NoData; RasterInfo keeps the georeference
+# needed to write results back on the same grid
+
+class RasterInfo(object):
+
+    def __init__(self, x_min, y_min, cell_x, cell_y, rows, cols, spatial_reference=None):
+        self.x_min = x_min
+        self.y_min = y_min
+        self.cell_x = cell_x
+        self.cell_y = cell_y
+        self.rows = rows
+        self.cols = cols
+        self.spatial_reference = spatial_reference
+
+    @property
+    def cell_area(self):
+        return self.cell_x * self.cell_y
+
+
+def read_raster(raster, like=None):
+    # Read a raster (optionally clipped to the grid of another one) as float64
+    if not isinstance(raster, arcpy.Raster):
+        raster = arcpy.Raster(raster)
+    if like is None:
+        like = RasterInfo(raster.extent.XMin, raster.extent.YMin,
+                          raster.meanCellWidth, raster.meanCellHeight,
+                          raster.height, raster.width, raster.spatialReference)
+    array = arcpy.RasterToNumPyArray(raster, arcpy.Point(like.x_min, like.y_min), like.cols, like.rows)
+    array = array.astype(np.float64)
+    if raster.noDataValue is not None:
+        array[array == raster.noDataValue] = np.nan
+    return array, like
+
+
+def read_flow_directions(raster, like=None):
+    # D8 flow directions as uint8 codes, NoData is numpy_hydrology.FLOW_DIR_NODATA
+    array, info = read_raster(raster, like)
+    array = np.where(np.isnan(array), numpy_hydrology.FLOW_DIR_NODATA, array)
+    return array.astype(np.uint8), info
+
+
+def to_raster(array, info, nodata=None):
+    # Convert an array back to an arcpy Raster on the grid described by info
+    if array.dtype == bool:
+        array = array.astype(np.uint8)
+    raster = arcpy.NumPyArrayToRaster(array, arcpy.Point(info.x_min, info.y_min),
+                                      info.cell_x, info.cell_y, nodata)
+    if info.spatial_reference is not None:
+        arcpy.DefineProjection_management(raster, info.spatial_reference)
+    return raster
+
+
+def cell_centres(rows, cols, info):
+    # Map coordinates of cell centres (row 0 is the top of the raster)
+    x = info.x_min + (np.asarray(cols) + 0.5) * info.cell_x
+    y = info.y_min + (info.rows - np.asarray(rows) - 0.5) * info.cell_y
+    return x, y
+
+
+def corner_coordinates(rows, cols, info):
+    # Map coordinates of cell corners; corner (r, c) is the top left corner
+    # of cell (r, c), so rows and cols run up to info.rows and info.cols
+    x = info.x_min + np.asarray(cols) * info.cell_x
+    y = info.y_min + (info.rows - np.asarray(rows)) * info.cell_y
+    return x, y
@@ -0,0 +1,219 @@
+import numpy as np
+import numpy_hydrology as nh
+
+
+# Ordered ridgelines without per-order watershed delineation. The watershed
+# of a Strahler order is Watershed(flow directions, same-order segments),
+# so every cell belongs to the segment of each order its flow path meets
+# first. A cell's path enters the stream network at one stream cell, and
+# the segments met below that cell only depend on the cell, so a single
+# traversal of the flow tree gives the watersheds of all orders: the entry
+# stream cell of every cell and, for every stream cell, the segment of each
+# order downstream of it.
+#
+# Ridges are the cell edges where the watershed label of some order changes;
+# the orders whose label changes across an edge form its membership bit
+# mask (bit j for values[j]). Edges are chained into polylines through
+# lattice corners where exactly two edges of the same mask meet.
+
+
+def order_watersheds(stream_orders, flow_dir, values=None):
+    # Returns (entry, table, values): entry is the first stream cell on the
+    # flow path of every cell (-1 if there is none) and table[s, j] the
+    # segment of order values[j] reached from stream cell s (0 if none). The
+    # watershed raster of order values[j] is table[entry, j], 0 where entry
+    # is -1
+    flow = nh.flow_graph(flow_dir)
+    order = np.asarray(stream_orders).ravel()
+    segments = nh.order_segments(order, flow).ravel()
+    stream = segments > 0
+    if values is None:
+        values = sorted(int(v) for v in np.unique(order[stream]))
+    rcv = flow.rcv
+    srcv = nh.stream_receivers(stream, rcv)
+    cells = np.flatnonzero(stream)
+    position = np.full(order.size, -1, dtype=cells.dtype)
+    position[cells] = np.arange(cells.size)
+
+    table = np.zeros((cells.size, len(values)), dtype=np.int32)
+    column = np.searchsorted(values, order[cells])
+    table[np.arange(cells.size), column] = segments[cells]
+    entry = np.where(stream, np.arange(order.size), -1)
+    # Downstream cells come first
+    for level in reversed(flow.levels()):
+        downstream = rcv[level]
+        # Stream cells take the segments below them
+        on_stream = stream[level] & (srcv[level] >= 0)
+        upper = position[level[on_stream]]
+        lower = position[downstream[on_stream]]
+        table[upper] = np.where(table[upper] > 0, table[upper], table[lower])
+        # Other cells enter the network where their downstream cell does
+        sel = ~stream[level] & (downstream >= 0)
+        entry[level[sel]] = entry[downstream[sel]]
+    entry = np.where(entry >= 0, position[np.maximum(entry, 0)], -1)
+    return entry.reshape(flow.shape), table, values
+
+
+def ridge_edges(entry, table):
+    # Cell edges between different watersheds of at least one order.
+    # Returns the lattice corners of both edge ends (flat indices on the
+    # (rows + 1) x (cols + 1) corner grid) and the membership masks
+    rows, cols = entry.shape
+    # The outside of the raster belongs to no watershed
+    padded = np.pad(entry, 1, mode='constant', constant_values=-1)
+    labels = np.vstack([table, np.zeros((1, table.shape[1]), dtype=table.dtype)])
+    weights = (np.int64(1) << np.arange(table.shape[1], dtype=np.int64))
+    corner_cols = cols + 1
+    starts, ends, masks = [], [], []
+    # Vertical edges between cells (r, c - 1) and (r, c), c = 0..cols
+    left, right = padded[1:-1, :-1], padded[1:-1, 1:]
+    r, c = np.nonzero(left != right)
+    a, b = left[r, c], right[r, c]
+    starts.append(r * corner_cols + c)
+    ends.append((r + 1) * corner_cols + c)
+    masks.append((labels[a] != labels[b]).dot(weights))
+    # Horizontal edges between cells (r - 1, c) and (r, c), r = 0..rows
+    upper, lower = padded[:-1, 1:-1], padded[1:, 1:-1]
+    r, c = np.nonzero(upper != lower)
+    a, b = upper[r, c], lower[r, c]
+    starts.append(r * corner_cols + c)
+    ends.append(r * corner_cols + c + 1)
+    masks.append((labels[a] != labels[b]).dot(weights))
+    starts, ends, masks = np.concatenate(starts), np.concatenate(ends), np.concatenate(masks)
+    ridge = masks > 0
+    return starts[ridge], ends[ridge], masks[ridge]
+
+
+def _jump(link, rounds):
+    # Pointer jumping along link (-1 ends a chain) for the given number of
+    # rounds, enough to cover the longest chain or cycle. Returns the chain
+    # end reached from every element, the number of steps to it and the
+    # smallest element met on the way (over a whole cycle for cycles)
+    index = np.arange(link.size)
+    pointer = np.where(link >= 0, link, index)
+    steps = (link >= 0).astype(np.int64)
+    smallest = index.copy()
+    for _ in range(rounds):
+        smallest = np.minimum(smallest, smallest[pointer])
+        steps += steps[pointer]
+        pointer = pointer[pointer]
+    return pointer, steps, smallest
+
+
+def ridge_lines(starts, ends, masks, shape, simplify=True):
+    # Chain ridge edges into polylines of equal membership mask. Lines end
+    # at corners where the mask changes or more than two edges meet.
+    # Returns a list of (mask, rows, cols) with corner indices of vertices
+    n_corners = (shape[0] + 1) * (shape[1] + 1)
+    corner_cols = shape[1] + 1
+    n_edges = starts.size
+    if not n_edges:
+        return []
+    edge_ends = np.concatenate([starts, ends])
+    edge_ids = np.tile(np.arange(n_edges), 2)
+    sort = np.argsort(edge_ends, kind='mergesort')
+    incident = edge_ids[sort]
+    indptr = np.searchsorted(edge_ends[sort], np.arange(n_corners + 1))
+    degree = np.diff(indptr)
+    # Corners a line passes through
+    through = degree == 2
+    pairs = indptr[:-1][through]
+    through[np.flatnonzero(through)] = masks[incident[pairs]] == masks[incident[pairs + 1]]
+
+    # Directed edges: 2 * e runs from starts[e] to ends[e], 2 * e + 1 back.
+    # At a through corner a directed edge continues with the other edge
+    # there, leaving the corner; lines are the chains of this successor
+    edge = np.arange(2 * n_edges) // 2
+    forward = np.arange(2 * n_edges) % 2 == 0
+    origin = np.where(forward, starts[edge], ends[edge])
+    arrival = np.where(forward, ends[edge], starts[edge])
+    k = indptr[arrival]
+    other = np.where(incident[k] == edge, incident[np.minimum(k + 1, incident.size - 1)], incident[k])
+    successor = np.where(through[arrival], 2 * other + (starts[other] != arrival), -1)
+    predecessor = np.full(successor.size, -1, dtype=np.int64)
+    predecessor[successor[successor >= 0]] = np.flatnonzero(successor >= 0)
+    # Position of a directed edge among the edges of its origin corner, the
+    # order in which lines are started from stop corners
+    position = np.empty(2 * n_edges, dtype=np.int64)
+    position[np.where(sort < n_edges, 2 * sort, 2 * (sort - n_edges) + 1)] = np.arange(sort.size)
+    rounds = int(2 * n_edges).bit_length()
+
+    # A line between stop corners is followed from the end whose directed
+    # edge comes first; a closed ring from the start of its lowest edge, so of
+    # its two directed cycles the one through an even directed edge is kept
+    # and cut open before that edge
+    last, _, smallest = _jump(successor, rounds)
+    ring = successor[last] >= 0
+    kept = ~ring | (smallest % 2 == 0)
+    head_of_ring = ring & kept & (smallest == np.arange(2 * n_edges))
+    predecessor[head_of_ring] = -1
+    predecessor[ring & ~kept] = -1
+    head, rank, _ = _jump(predecessor, rounds)
+    kept &= ring | (position[head] < position[last ^ 1])
+    kept = np.flatnonzero(kept)
+    head, rank = head[kept], rank[kept]
+    # Lines from stop corners first (by corner), then rings (by lowest edge);
+    # vertices are the origin of the first edge and the arrival of every edge
+    heads = np.unique(head)
+    line_key = np.where(ring[heads], position.size + heads, position[heads])
+    heads = heads[np.argsort(line_key, kind='mergesort')]
+    line = np.empty(2 * n_edges, dtype=np.int64)
+    line[heads] = np.arange(heads.size)
+    line_of_edge = line[head]
+    walk = np.lexsort((rank, line_of_edge))
+    vertices = np.insert(arrival[kept][walk], np.searchsorted(line_of_edge[walk], np.arange(heads.size)),
+                         origin[heads])
+    line_of_vertex = np.repeat(np.arange(heads.size), np.bincount(line_of_edge, minlength=heads.size) + 1)
+    line_masks = masks[heads // 2].tolist()
+
+    rows, cols = np.divmod(vertices, corner_cols)
+    first = np.r_[True, line_of_vertex[1:] != line_of_vertex[:-1]]
+    final = np.r_[line_of_vertex[1:] != line_of_vertex[:-1], True]
+    if simplify:
+        # Keep ends and the corners where the line turns
+        step_in = np.c_[np.r_[0, np.diff(rows)], np.r_[0, np.diff(cols)]]
+        step_out = np.r_[step_in[1:], [[0, 0]]]
+        keep = first | final | (step_in != step_out).any(axis=1)
+        rows, cols, first, final = rows[keep], cols[keep], first[keep], final[keep]
+    bounds = zip(np.flatnonzero(first), np.flatnonzero(final) + 1)
+    return [(line_masks[i], rows[s:e], cols[s:e]) for i, (s, e) in enumerate(bounds)]
+
+
+def ridgelines(stream_orders, flow_dir, values=None, simplify=True):
+    # Ridge polylines with their membership masks; returns (lines, values)
+    entry, table, values = order_watersheds(stream_orders, flow_dir, values)
+    starts, ends, masks = ridge_edges(entry, table)
+    return ridge_lines(starts, ends, masks, entry.shape, simplify), values
+
+
+def classify(masks, n_orders):
+    # Orders of ridge segments from their membership masks (bit j is order
+    # j + 1), 0 where a class is undefined:
+    # Filosofov - the highest order the ridge bounds;
+    # full sequence - k if the ridge bounds orders 1..k but not k + 1;
+    # highest triplet - the highest k such that the ridge does not bound
+    #   order k + 1 and bounds k and the (up to) two orders below it.
+    # Returns (filosofov, full_sequence, highest_triplet)
+    masks = np.asarray(masks, dtype=np.int64)
+    bits = [(masks >> j & 1).astype(bool) for j in range(n_orders)]
+    filosofov = np.zeros(masks.size, dtype=np.int16)
+    full_sequence = np.zeros(masks.size, dtype=np.int16)
+    highest_triplet = np.zeros(masks.size, dtype=np.int16)
+    run = np.ones(masks.size, dtype=bool)
+    for j in range(n_orders):
+        filosofov[bits[j]] = j + 1
+        run &= bits[j]
+        full_sequence[run] = j + 1
+    for k in range(n_orders, 0, -1):
+        match = highest_triplet == 0
+        if k < n_orders:
+            match &= ~bits[k]
+        for j in range(max(k - 3, 0), k):
+            match &= bits[j]
+        highest_triplet[match] = k
+    return filosofov, full_sequence, highest_triplet
+
+
+def watershed_order(mask, values):
+    # Text of the orders a ridge bounds, highest first, 0 for the others
+    return ''.join(str(value) if mask >> j & 1 else '0' for j, value in reversed(list(enumerate(values))))
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+# Per-run store of intermediate rasters. Arrays are kept in memory while
+# they fit the memory budget and are spilled to uncompressed .npy files
+# memory-mapped from a temporary directory otherwise, so later stages read
+# them in place instead of through a compressed geodatabase raster. Stages
+# that can write their output in place allocate it with create; put takes
+# a finished array as it is while it fits the budget and copies it to a
+# memmap otherwise, after which the caller has to drop its own reference
+# for the memory to be freed. The
+# directory is also the scratch workspace for temporary ArcGIS rasters of
+# the run. Everything is removed when the store is closed, which a with
+# block does even when the run fails.
+#
+# The directory is created under STREAMSCAPE_SCRATCH_DIR (default: the
+# system temporary directory), the memory budget in megabytes is taken from
+# STREAMSCAPE_SCRATCH_MEMORY_MB.
+
+DEFAULT_MEMORY_MB = 1024
+
+
+class ScratchStore(object):
+
+    def __init__(self, directory=None, memory_bytes=None):
+        directory = directory or os.environ.get('STREAMSCAPE_SCRATCH_DIR') or None
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if memory_bytes is None:
+            memory_mb = float(os.environ.get('STREAMSCAPE_SCRATCH_MEMORY_MB', DEFAULT_MEMORY_MB))
+            memory_bytes = int(memory_mb * 1024 ** 2)
+        self.directory = tempfile.mkdtemp(dir=directory, prefix='streamscape_run_')
+        self.memory_bytes = memory_bytes
+        self.arrays = {}
+        self.in_memory = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.npy')
+
+    def create(self, name, shape, dtype=np.float64):
+        # Empty array to be filled in place
+        self.delete(name)
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self.in_memory + nbytes <= self.memory_bytes:
+            array = np.empty(shape, dtype=dtype)
+            self.in_memory += nbytes
+        else:
+            array = np.lib.format.open_memmap(self.path(name), mode='w+', dtype=dtype, shape=tuple(shape))
+        self.arrays[name] = array
+        return array
+
+    def put(self, name, array):
+        # Keep array: the array itself (no copy) within the memory budget, a
+        # memmap copy of it otherwise. Returns the stored array, None stays None
+        if array is None:
+            return None
+        array = np.asarray(array)
+        self.delete(name)
+        if self.in_memory + array.nbytes <= self.memory_bytes:
+            self.arrays[name] = array
+            self.in_memory += array.nbytes
+            return array
+        stored = np.lib.format.open_memmap(self.path(name), mode='w+', dtype=array.dtype, shape=array.shape)
+        stored[...] = array
+        stored.flush()
+        self.arrays[name] = stored
+        return stored
+
+    def get(self, name):
+        return self.arrays[name]
+
+    def delete(self, name):
+        array = self.arrays.pop(name, None)
+        if array is None:
+            return
+        if isinstance(array, np.memmap):
+            try:
+                os.remove(self.path(name))
+            except OSError:  # still mapped elsewhere, removed on close
+                pass
+        else:
+            self.in_memory -= array.nbytes
+
+    def close(self):
+        self.arrays.clear()
+        self.in_memory = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
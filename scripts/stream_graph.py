@@ -0,0 +1,392 @@
+import hashlib
+import numpy as np
+import numpy_hydrology as nh
+
+
+# Stream network as a graph of links. A link is a run of stream cells from
+# a source or junction cell down to the cell above the next junction, the
+# same sections StreamLink numbers; link k (0-based) has the raster value
+# k + 1. Links are stored as a structure of arrays: downstream link (-1 at
+# outlets), Strahler order, length (D8 steps between cell centres, down to
+# the next link's head) and head and outlet cells, with the cells of every
+# link in CSR form (cell_index[indptr[k]:indptr[k + 1]], head first).
+# Ordering, pruning and per-link statistics are then operations over links
+# rather than over the raster, and a graph can be saved and loaded again.
+# A graph may carry the source key of the flow directions and cell size it
+# was traced on (see source_key), so a saved graph is only updated on the
+# grid it belongs to.
+
+FIELDS = ('downstream', 'order', 'length', 'head', 'outlet', 'indptr', 'cell_index')
+
+
+class StreamGraph(object):
+
+    def __init__(self, shape, downstream, order, length, head, outlet, indptr, cell_index, source=None):
+        self.shape = tuple(int(n) for n in shape)
+        self.source = source
+        self.downstream = downstream
+        self.order = order
+        self.length = length
+        self.head = head
+        self.outlet = outlet
+        self.indptr = indptr
+        self.cell_index = cell_index
+
+    @property
+    def size(self):
+        return self.downstream.size
+
+    @property
+    def ids(self):
+        # Link values of the stream link raster
+        return np.arange(1, self.size + 1, dtype=np.int32)
+
+    @property
+    def cell_count(self):
+        return np.diff(self.indptr)
+
+    def levels(self):
+        # Topological levels of links, sources first
+        return nh._flow_levels(self.downstream)
+
+    def upstream_count(self):
+        # Number of links draining directly into every link
+        return np.bincount(self.downstream[self.downstream >= 0], minlength=self.size)
+
+    def link_of_cells(self):
+        # Link index of every cell in cell_index
+        return np.repeat(np.arange(self.size), self.cell_count)
+
+    def paint(self, values, fill_value=0, dtype=None):
+        # Raster with the value of every link on its cells
+        values = np.asarray(values)
+        out = np.full(self.shape[0] * self.shape[1], fill_value, dtype=dtype or values.dtype)
+        out[self.cell_index] = np.repeat(values, self.cell_count)
+        return out.reshape(self.shape)
+
+    def cells_of(self, links):
+        # Flat cell indices of the links selected by a boolean mask
+        return self.cell_index[np.repeat(links, self.cell_count)]
+
+    def link_raster(self):
+        return self.paint(self.ids)
+
+    def order_raster(self):
+        return self.paint(self.order, dtype=np.int32)
+
+
+def strahler_order(downstream, levels=None, up_max=None, up_count=None):
+    # Strahler order of graph nodes: sources get 1, the order grows by one
+    # where two or more links of the highest incoming order meet. up_max and
+    # up_count are the highest order flowing in from outside the graph and
+    # the number of such inflows
+    order = np.zeros(downstream.size, dtype=np.int32)
+    if up_max is None:
+        up_max = np.zeros(downstream.size, dtype=np.int32)
+        up_count = np.zeros(downstream.size, dtype=np.int32)
+    if levels is None:
+        levels = nh._flow_levels(downstream)
+    for level in levels:
+        level_order = np.where(up_count[level] >= 2, up_max[level] + 1, np.maximum(up_max[level], 1))
+        order[level] = level_order
+        below = downstream[level]
+        sel = below >= 0
+        below, level_order = below[sel], level_order[sel]
+        previous = up_max[below]
+        np.maximum.at(up_max, below, level_order)
+        up_count[below[up_max[below] != previous]] = 0
+        np.add.at(up_count, below, level_order == up_max[below])
+    return order
+
+
+def _empty(shape, index_dtype):
+    empty = np.zeros(0, dtype=index_dtype)
+    return StreamGraph(shape, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                       np.zeros(0), empty, empty, np.zeros(1, dtype=index_dtype), empty)
+
+
+def _trace_links(below, donors):
+    # Links of a set of stream cells; below is the position of the stream
+    # receiver of every cell in the set (-1 if none) and donors the number
+    # of stream donors of the cell. Links start at sources and junctions,
+    # other cells continue the link of their single donor. Returns the link
+    # of every cell, the cells sorted by link from head to outlet and the
+    # CSR pointers of that order
+    has_below = below >= 0
+    starts = np.flatnonzero(donors != 1)
+    link = np.full(below.size, -1, dtype=np.int32)
+    link[starts] = np.arange(starts.size)
+    donor = np.full(below.size, -1, dtype=below.dtype)
+    donor[below[has_below]] = np.flatnonzero(has_below)
+    depth = np.zeros(below.size, dtype=np.int64)
+    for step, level in enumerate(nh._flow_levels(below)):
+        depth[level] = step
+        level = level[link[level] < 0]
+        link[level] = link[donor[level]]
+    sort = np.lexsort((depth, link))
+    indptr = np.zeros(starts.size + 1, dtype=below.dtype)
+    indptr[1:] = np.cumsum(np.bincount(link, minlength=starts.size))
+    return link, sort, indptr
+
+
+def _step_lengths(cells, targets, shape, cell_x, cell_y):
+    # D8 step lengths from cells to their stream receivers (0 where none)
+    has_target = targets >= 0
+    targets = np.where(has_target, targets, cells)
+    step_rows = np.abs(targets // shape[1] - cells // shape[1])
+    step_cols = np.abs(targets % shape[1] - cells % shape[1])
+    return np.hypot(step_rows * cell_y, step_cols * cell_x)
+
+
+def _csr_take(indptr, values, links):
+    # Values of the selected links in CSR form, in the order of links
+    count = np.diff(indptr)[links]
+    offsets = np.cumsum(count) - count
+    take = np.repeat(indptr[:-1][links] - offsets, count) + np.arange(count.sum())
+    out_ptr = np.zeros(len(links) + 1, dtype=indptr.dtype)
+    out_ptr[1:] = np.cumsum(count)
+    return out_ptr, values[take]
+
+
+def build(stream_cells, flow_dir, cell_x=1.0, cell_y=1.0):
+    # Link graph of the stream cells, traversing only the stream cells
+    flow = nh.flow_graph(flow_dir)
+    shape = flow.shape
+    stream = nh.as_mask(stream_cells).ravel() & ~flow.nodata
+    srcv = nh.stream_receivers(stream, flow.rcv)
+    cells = np.flatnonzero(stream)
+    index_dtype = nh._index_dtype(stream.size)
+    if not cells.size:
+        return _empty(shape, index_dtype)
+    # Stream graph in the numbering of stream cells
+    position = np.full(stream.size, -1, dtype=index_dtype)
+    position[cells] = np.arange(cells.size)
+    below = np.where(srcv[cells] >= 0, position[np.maximum(srcv[cells], 0)], -1)
+    has_below = below >= 0
+    donors = np.bincount(below[has_below], minlength=cells.size)
+    link, sort, indptr = _trace_links(below, donors)
+    head = sort[indptr[:-1]]
+    outlet = sort[indptr[1:] - 1]
+    downstream = np.where(has_below[outlet], link[np.maximum(below[outlet], 0)], -1).astype(np.int32)
+    length = np.bincount(link, weights=_step_lengths(cells, srcv[cells], shape, cell_x, cell_y),
+                         minlength=indptr.size - 1)
+    return StreamGraph(shape, downstream, strahler_order(downstream), length,
+                       cells[head], cells[outlet], indptr, cells[sort])
+
+
+def _merge_groups(downstream, head):
+    # Chains of links joined where a link has a single upstream link, as
+    # after removing a tributary. Returns the group of every link, numbered
+    # by the head cell of its first link as StreamLink numbers links, and
+    # the rank of every link within its group
+    levels = nh._flow_levels(downstream)
+    upstream = np.bincount(downstream[downstream >= 0], minlength=downstream.size)
+    starts = np.flatnonzero(upstream != 1)
+    group = np.full(downstream.size, -1, dtype=np.int32)
+    group[starts[np.argsort(head[starts], kind='mergesort')]] = np.arange(starts.size)
+    donor = np.full(downstream.size, -1, dtype=downstream.dtype)
+    sel = downstream >= 0
+    donor[downstream[sel]] = np.flatnonzero(sel)
+    rank = np.zeros(downstream.size, dtype=np.int64)
+    for step, level in enumerate(levels):
+        rank[level] = step
+        level = level[group[level] < 0]
+        group[level] = group[donor[level]]
+    return group, rank
+
+
+def short_sources(graph, min_cells, iterative=False):
+    # Boolean mask of the 1st order links of min_cells cells or less. 1st
+    # order links are sources, so removing one only merges the link below it
+    # with the other tributary; with iterative, the merged network is
+    # re-ordered and pruned again until no short source is left
+    removed = np.zeros(graph.size, dtype=bool)
+    kept = np.arange(graph.size)
+    downstream, order, cell_count = graph.downstream, graph.order, graph.cell_count
+    group = np.arange(graph.size)
+    while kept.size:
+        short = np.zeros(group.max() + 1, dtype=np.int64)
+        np.add.at(short, group, cell_count)
+        short = (short <= min_cells)[group] & (order == 1)
+        if not short.any():
+            break
+        removed[kept[short]] = True
+        if not iterative:
+            break
+        # Same links without the removed sources, in the numbering of kept
+        position = np.full(graph.size, -1, dtype=np.int64)
+        position[kept[~short]] = np.arange(np.count_nonzero(~short))
+        kept = kept[~short]
+        below = graph.downstream[kept]
+        downstream = np.where(below >= 0, position[np.maximum(below, 0)], -1).astype(np.int32)
+        cell_count = graph.cell_count[kept]
+        group = _merge_groups(downstream, graph.head[kept])[0]
+        order = strahler_order(downstream)
+    return removed
+
+
+def remove_links(graph, removed):
+    # Graph of the network without the removed source links: chains left
+    # with a single upstream link are merged and orders are recomputed, the
+    # same graph build gives for the remaining cells
+    kept = np.flatnonzero(~removed)
+    if not kept.size:
+        return _empty(graph.shape, graph.indptr.dtype)
+    position = np.full(graph.size, -1, dtype=np.int64)
+    position[kept] = np.arange(kept.size)
+    below = graph.downstream[kept]
+    downstream = np.where(below >= 0, position[np.maximum(below, 0)], -1)
+    group, rank = _merge_groups(downstream, graph.head[kept])
+    n_groups = int(group.max()) + 1 if group.size else 0
+    # Links of every group from head to outlet, then their cells
+    members = np.lexsort((rank, group))
+    links = kept[members]
+    link_ptr, cell_index = _csr_take(graph.indptr, graph.cell_index, links)
+    first = np.r_[True, group[members][1:] != group[members][:-1]]
+    last = np.r_[first[1:], True]
+    indptr = link_ptr[np.r_[np.flatnonzero(first), links.size]]
+    outlet_link = downstream[members[last]]
+    group_downstream = np.where(outlet_link >= 0, group[np.maximum(outlet_link, 0)], -1).astype(np.int32)
+    return StreamGraph(graph.shape, group_downstream, strahler_order(group_downstream),
+                       np.bincount(group, weights=graph.length[kept], minlength=n_groups),
+                       graph.head[links[first]], graph.outlet[links[last]], indptr, cell_index)
+
+
+def _lookup(sorted_cells, values, cells):
+    # values of cells found in sorted_cells, -1 for the others
+    if not sorted_cells.size:
+        return np.full(len(cells), -1, dtype=np.int64)
+    position = np.minimum(np.searchsorted(sorted_cells, cells), sorted_cells.size - 1)
+    return np.where(sorted_cells[position] == cells, values[position], -1)
+
+
+def _stream_donors(cells, stream, rcv, shape):
+    # Number of stream cells draining into each of cells
+    donors = np.zeros(cells.size, dtype=np.int64)
+    for k in range(8):
+        nb, inside = nh._neighbour(cells, k, shape)
+        nb = np.where(inside, nb, 0)
+        donors += inside & stream[nb] & (rcv[nb] == cells)
+    return donors
+
+
+def update(graph, stream_cells, flow_dir, cell_x=1.0, cell_y=1.0, changed=None, rcv=None):
+    # Graph of new stream cells on the same flow directions from the graph
+    # of the previous network, equal to what build gives. Only the links
+    # around the changed cells are traced again: links holding a changed
+    # cell or the receiver of one (its donor count changes) and links
+    # draining into such a receiver. Other links keep their cells and
+    # length, and Strahler orders are propagated again only downstream of
+    # the traced links. changed are the flat indices of cells that entered
+    # or left the network, if known; rcv the receivers of flow_dir
+    if not graph.size:
+        return build(stream_cells, flow_dir, cell_x, cell_y)
+    flow = nh.flow_graph(flow_dir)
+    shape = flow.shape
+    stream = nh.as_mask(stream_cells).ravel() & ~flow.nodata
+    if rcv is None:
+        rcv = flow.rcv
+    if changed is None:
+        previous = np.zeros(stream.size, dtype=bool)
+        previous[graph.cell_index] = True
+        changed = np.flatnonzero(previous != stream)
+    changed = np.asarray(changed)
+    if not changed.size:
+        return graph
+    below_changed = rcv[changed]
+    dirty = np.unique(np.r_[changed, below_changed[below_changed >= 0]])
+
+    # Old links to trace again
+    sort = np.argsort(graph.cell_index, kind='mergesort')
+    old_cells = graph.cell_index[sort]
+    old_link = graph.link_of_cells()[sort]
+    touched = np.zeros(graph.size, dtype=bool)
+    hit = _lookup(old_cells, old_link, dirty)
+    touched[hit[hit >= 0]] = True
+    touched |= _lookup(dirty, np.arange(dirty.size), rcv[graph.outlet]) >= 0
+    kept = np.flatnonzero(~touched)
+    local = graph.cells_of(touched)
+    local = np.unique(np.r_[local[stream[local]], changed[stream[changed]]])
+
+    # Links of the traced cells
+    receiver = rcv[local]
+    receiver = np.where((receiver >= 0) & stream[np.maximum(receiver, 0)], receiver, -1)
+    below = _lookup(local, np.arange(local.size), receiver)
+    link, local_sort, local_ptr = _trace_links(below, _stream_donors(local, stream, rcv, shape))
+    n_local = local_ptr.size - 1
+    local_length = np.bincount(link, weights=_step_lengths(local, receiver, shape, cell_x, cell_y),
+                               minlength=n_local)
+
+    # Kept links followed by the traced ones
+    kept_ptr, kept_cells = _csr_take(graph.indptr, graph.cell_index, kept)
+    head = np.r_[graph.head[kept], local[local_sort[local_ptr[:-1]]]]
+    outlet = np.r_[graph.outlet[kept], local[local_sort[local_ptr[1:] - 1]]]
+    length = np.r_[graph.length[kept], local_length]
+    indptr = np.r_[kept_ptr, kept_ptr[-1] + local_ptr[1:]]
+    cells = np.r_[kept_cells, local[local_sort]]
+    combined = np.full(graph.size, -1, dtype=np.int64)
+    combined[kept] = np.arange(kept.size)
+    n_links = kept.size + n_local
+
+    # Downstream links: the link of the stream receiver of every outlet
+    target = rcv[outlet]
+    target = np.where((target >= 0) & stream[np.maximum(target, 0)], target, -1)
+    downstream = _lookup(local, kept.size + link, target)
+    in_kept = downstream < 0
+    old = _lookup(old_cells, old_link, target[in_kept])
+    downstream[in_kept] = np.where(old >= 0, combined[np.maximum(old, 0)], -1)
+    downstream[target < 0] = -1
+
+    # Orders of traced links and of all links below them
+    order = np.r_[graph.order[kept], np.zeros(n_local, dtype=np.int32)]
+    affected = np.zeros(n_links, dtype=bool)
+    frontier = np.arange(kept.size, n_links)
+    while frontier.size:
+        affected[frontier] = True
+        frontier = downstream[frontier]
+        frontier = np.unique(frontier[frontier >= 0])
+        frontier = frontier[~affected[frontier]]
+    sub = np.flatnonzero(affected)
+    position = np.full(n_links, -1, dtype=np.int64)
+    position[sub] = np.arange(sub.size)
+    sub_down = np.where(downstream[sub] >= 0, position[np.maximum(downstream[sub], 0)], -1)
+    # Inflow of unchanged links into the affected ones
+    inflow = np.flatnonzero(~affected & (downstream >= 0))
+    inflow = inflow[affected[downstream[inflow]]]
+    up_max = np.zeros(sub.size, dtype=np.int32)
+    up_count = np.zeros(sub.size, dtype=np.int32)
+    into = position[downstream[inflow]]
+    np.maximum.at(up_max, into, order[inflow])
+    np.add.at(up_count, into, order[inflow] == up_max[into])
+    order[sub] = strahler_order(sub_down, None, up_max, up_count)
+
+    # Number links by head cell, as build does
+    renumber = np.argsort(head, kind='mergesort')
+    new_id = np.empty(n_links, dtype=np.int64)
+    new_id[renumber] = np.arange(n_links)
+    downstream = np.where(downstream >= 0, new_id[np.maximum(downstream, 0)], -1)
+    indptr, cells = _csr_take(indptr, cells, renumber)
+    return StreamGraph(shape, downstream[renumber].astype(np.int32), order[renumber], length[renumber],
+                       head[renumber], outlet[renumber], indptr, cells)
+
+
+def source_key(flow_dir, cell_x=1.0, cell_y=1.0):
+    # Hash of the flow directions and the cell size of a graph
+    codes = np.ascontiguousarray(nh.flow_graph(flow_dir).codes, dtype=np.uint8)
+    digest = hashlib.sha1()
+    digest.update(str((codes.shape, float(cell_x), float(cell_y))).encode('utf-8'))
+    digest.update(codes.data)
+    return digest.hexdigest()
+
+
+def save(graph, path):
+    # Arrays of the graph and its source key in one .npz file
+    np.savez(path, shape=np.array(graph.shape), source=np.array(graph.source or ''),
+             **dict((name, getattr(graph, name)) for name in FIELDS))
+
+
+def load(path):
+    # Graphs saved without a source key get None
+    with np.load(path) as data:
+        source = str(data['source']) if 'source' in data.files else ''
+        return StreamGraph(data['shape'], *[data[name] for name in FIELDS], source=source or None)
@@ -1,4 +1,14 @@
+import os
 import arcpy
+import numpy as np
+import hydro_cache
+import numpy_hydrology
+import order_report
+import profiling
+import raster_io
+import scratch_store
+import stream_graph
+import stream_network_numpy
 
 
 def extract_streams_flowacc(flow_directions,
@@ -32,8 +42,6 @@ def extract_streams_flowacc(flow_directions,
     if out_flow_acc and out_flow_acc != "#":
         arcpy.AddMessage('Saving flow accumulation')
         flow_accumulation.save(out_flow_acc)
-    else:
-        flow_accumulation.save('FlowAcc')
 
     # Calculate initiation function raster
     arcpy.AddMessage('Calculating initiation function')
@@ -62,21 +70,13 @@ def extract_streams_flowacc(flow_directions,
         # Calculating flow accumulation again to reconstuct connected stream network
         arcpy.AddMessage('Reconstructing stream network')
         flow_accumulation_streams = arcpy.sa.FlowAccumulation(flow_directions, initials)
-        flow_accumulation_streams.save('flow_acc_streams')
         flow_accumulation_streams_corrected = flow_accumulation_streams + initials
-        flow_accumulation_streams_corrected.save('flow_acc_streams_corrected')
         # Exctacting stream cells
         arcpy.AddMessage('Extracting stream network')
         stream_cells0 = arcpy.sa.Con(flow_accumulation_streams_corrected, '1', '0', "Value > 0")
         # Combining stream cells and initials
         stream_cells = arcpy.sa.BooleanOr(initials, stream_cells0)
         # stream_cells.save('stream_cells')  # DEBUG
-        arcpy.Delete_management('flow_acc_streams')
-        arcpy.Delete_management('flow_acc_streams_corrected')
-    
-    # Delete temporary rasters
-    if out_flow_acc and out_flow_acc != "#":
-        arcpy.Delete_management('FlowAcc')
 
     return stream_cells
 
@@ -89,40 +89,28 @@ def extract_streams_erosion_cut(flow_directions,
 
     # Compute 'usual' fow accumulation
     flow_accumulation_simple = arcpy.sa.FlowAccumulation(flow_directions)
-    flow_accumulation_simple.save('flow_accumulation_simple')
     # Compute flow accumulation, but weights are elevation
     flow_accumulation_elev_weighted = arcpy.sa.FlowAccumulation(flow_directions, DEM)
-    flow_accumulation_elev_weighted.save('flow_accumulation_elev_weighted')
     # Divide weighted FAcc by simple FAcc, get mean elevation within point's watershed
     mean_elevation_at_point = (flow_accumulation_elev_weighted + DEM) / (flow_accumulation_simple + 1)
-    mean_elevation_at_point.save('mean_elevation_at_point')
-    # Remove temporary rasters
-    arcpy.Delete_management('flow_accumulation_simple')
-    arcpy.Delete_management('flow_accumulation_elev_weighted')
     # Derive initiation raster: extract point elevation from mean watershed elevation
     initiation_raster = arcpy.sa.Minus(mean_elevation_at_point, DEM)
-    initiation_raster.save('initiation_raster')
 
     # Extracting initial cells
     arcpy.AddMessage('Extracting initial cells')
     initials = arcpy.sa.Con(initiation_raster, '1', '0', "Value > %s" % (initiation_threshold))
-    arcpy.Delete_management('initiation_raster')
     # initials.save('Initials')  # DEBUG
 
     # Reconstructing river network (raster)
     arcpy.AddMessage('Reconstructing stream network')
     flow_accumulation_streams = arcpy.sa.FlowAccumulation(flow_directions, initials)
-    flow_accumulation_streams.save('flow_acc_streams')
     flow_accumulation_streams_corrected = flow_accumulation_streams + initials
-    flow_accumulation_streams_corrected.save('flow_acc_streams_corrected')
     # Exctacting stream cells
     arcpy.AddMessage('Extracting stream network')
     stream_cells0 = arcpy.sa.Con(flow_accumulation_streams_corrected, '1', '0', "Value > 0")
     # Combining stream cells and initials
     stream_cells = arcpy.sa.BooleanOr(initials, stream_cells0)
     # stream_cells.save('stream_cells')  # DEBUG
-    arcpy.Delete_management('flow_acc_streams')
-    arcpy.Delete_management('flow_acc_streams_corrected')
 
     return stream_cells
 
@@ -153,26 +141,18 @@ def extract_streams_cei_to_mean_erosion_cut(flow_directions,
     if out_flow_acc and out_flow_acc != "#":
         arcpy.AddMessage('Saving flow accumulation')
         flow_accumulation.save(out_flow_acc)
-    else:
-        flow_accumulation.save('FlowAcc')
     # Calculating CEI itself
     cei = flow_accumulation * cell_area * slope_tangent
-    cei.save('cei')
 
     # Calculating mean erosion cut
     # Compute 'usual' fow accumulation
     flow_accumulation_simple = arcpy.sa.FlowAccumulation(flow_directions)
-    flow_accumulation_simple.save('flow_accumulation_simple')
     # Compute flow accumulation, but weights are elevation
     flow_accumulation_elev_weighted = arcpy.sa.FlowAccumulation(flow_directions, DEM)
-    flow_accumulation_elev_weighted.save('flow_accumulation_elev_weighted')
     # Divide weighted FAcc by simple FAcc, get mean elevation within point's watershed
     mean_elevation_at_point = (flow_accumulation_elev_weighted + DEM) / (flow_accumulation_simple + 1)
-    mean_elevation_at_point.save('mean_elevation_at_point')
     # Derive mean erosion cut raster
     mean_erosion_cut = arcpy.sa.Minus(mean_elevation_at_point, DEM)
-    mean_erosion_cut.save('mean_erosion_cut')
-    arcpy.Delete_management('mean_elevation_at_point')
     
     if initiation_function_type == 'RESILIENCE':
         # Calculate initiation raster (CEI / mean erosion cut)
@@ -182,20 +162,15 @@ def extract_streams_cei_to_mean_erosion_cut(flow_directions,
         if out_initiation_raster and out_initiation_raster != "#":
             arcpy.AddMessage('Saving initiation raster')
             initiation_raster.save(out_initiation_raster)
-        else:
-            initiation_raster.save('initiation_raster')
     elif initiation_function_type == 'CEI_TO_MEAN_EROSION_CUT':
         #TODO: CEI пропустить как вес через flow accumulation, поделить на простой flow accumulation
         # Calculating accumulated CEI
         flow_acc_cei = arcpy.sa.FlowAccumulation(flow_directions, cei)
-        flow_acc_cei.save('flow_acc_cei')
         # Calculating mean CEI over basin
         mean_cei_basin = (flow_acc_cei + cei) / (flow_accumulation_simple + 1)
-        mean_cei_basin.save('mean_cei_basin')
         #TODO: Этот результат разделить на врез. Получается сопротивляемость
         # Divide accumulated CEI by erosion cut (ground resistance)
         resilience = mean_cei_basin / mean_erosion_cut
-        resilience.save('resilience')   
         #TODO: Потом взять CEI и разделить на сопротивляемость.
         # Это и будет новый индекс.
         initiation_raster = cei / resilience
@@ -203,16 +178,6 @@ def extract_streams_cei_to_mean_erosion_cut(flow_directions,
         if out_initiation_raster and out_initiation_raster != "#":
             arcpy.AddMessage('Saving initiation raster')
             initiation_raster.save(out_initiation_raster)
-        else:
-            initiation_raster.save('initiation_raster')
-        arcpy.Delete_management('flow_acc_cei')
-        arcpy.Delete_management('mean_cei_basin')
-        arcpy.Delete_management('resilience')
-    # Remove temporary rasters
-    arcpy.Delete_management('cei')
-    arcpy.Delete_management('flow_accumulation_simple')
-    arcpy.Delete_management('flow_accumulation_elev_weighted')
-    arcpy.Delete_management('mean_erosion_cut')
 
     # Reconstructing river network (raster)
     # Extracting initial cells
@@ -223,19 +188,13 @@ def extract_streams_cei_to_mean_erosion_cut(flow_directions,
     # Reconstructing river network (raster)
     arcpy.AddMessage('Reconstructing stream network')
     flow_accumulation_streams = arcpy.sa.FlowAccumulation(flow_directions, initials)
-    flow_accumulation_streams.save('flow_acc_streams')
     flow_accumulation_streams_corrected = flow_accumulation_streams + initials
-    flow_accumulation_streams_corrected.save('flow_acc_streams_corrected')
     # Exctacting stream cells
     arcpy.AddMessage('Extracting stream network')
     stream_cells0 = arcpy.sa.Con(flow_accumulation_streams_corrected, '1', '0', "Value > 0")
     # Combining stream cells and initials
     stream_cells = arcpy.sa.BooleanOr(initials, stream_cells0)
     # stream_cells.save('stream_cells')  # DEBUG
-    arcpy.Delete_management('flow_acc_streams')
-    arcpy.Delete_management('flow_acc_streams_corrected')
-
-    if arcpy.Exists('initiation_raster'): arcpy.Delete_management('initiation_raster')
 
     return stream_cells
 
@@ -250,49 +209,188 @@ def extract_streams_drainage_strahler_order(flow_directions,
     stream_cells = arcpy.sa.SetNull(stream_orders, stream_orders, expression)
 
     # Extract cells 
-    stream_cells.save('stream_cells_strahler_order_debug')  # DEBUG
-    return stream_cells
-
-def exclude_small_streams(stream_cells, flow_directions, min_length_pixels):
-    
-    # Derive stream links and stream orders 
-    stream_links = arcpy.sa.StreamLink(stream_cells, flow_directions)
-    arcpy.BuildRasterAttributeTable_management(stream_links, "Overwrite")
-    stream_orders = arcpy.sa.StreamOrder(stream_cells, flow_directions, "STRAHLER")
-    arcpy.BuildRasterAttributeTable_management(stream_orders, "Overwrite")
-    # Extract stream links longer than min_length_pixels
-    expression = "Count > " + min_length_pixels
-    stream_links_selection = arcpy.sa.ExtractByAttributes(stream_links, expression)
-    # stream_links_selection.save('stream_links_selection')
-    # Extract stream orders higher than 1
-    stream_order_selection = arcpy.sa.ExtractByAttributes(stream_orders, "Value >= 2")
-    # stream_order_selection.save('stream_order_selection')
-    # Reclass selections to avoid NoData values. "Data" values are set to 0
-    stream_links_selection_isnull = arcpy.sa.IsNull(stream_links_selection)
-    stream_order_selection_isnull = arcpy.sa.IsNull(stream_order_selection)
-    # Revert reclassified rasters to set data cells to 1
-    stream_links_selection_notnull = arcpy.sa.BooleanNot(stream_links_selection_isnull)
-    stream_order_selection_notnull = arcpy.sa.BooleanNot(stream_order_selection_isnull)
-    # Combine obtained rasters
-    stream_cells = arcpy.sa.BooleanOr(stream_links_selection_notnull, stream_order_selection_notnull)
-
+    # stream_cells.save('stream_cells_strahler_order_debug')  # DEBUG
     return stream_cells
 
-def CEI_extraction(DEM_input,
-                   precipitation,
-                   evapotranspiration,
-                   initiation_function_type,
-                   initiation_threshold,
-                   min_segment_length,
-                   rivers_output,
-                   text_output,
-                   out_flow_dir,
-                   out_flow_acc,
-                   out_initiation_raster,
-                   out_stream_links,
-                   out_stream_orders,
-                   out_watersheds):
+def exclude_small_streams(stream_cells, flow_directions, min_length_pixels, iterative=False):
+
+    # Drop 1st order links not longer than min_length_pixels on the stream
+    # link graph; with iterative, repeat on the re-ordered network until no
+    # short 1st order link is left
+    cells, info = raster_io.read_raster(stream_cells)
+    codes = raster_io.read_flow_directions(flow_directions, info)[0]
+    cells = stream_network_numpy.exclude_small_streams(cells, codes, min_length_pixels, iterative)
+    return raster_io.to_raster(cells.astype(np.uint8), info, 0)
+
+def numpy_backend_rasters(DEM_input,
+                          precipitation,
+                          evapotranspiration,
+                          initiation_function_type,
+                          initiation_threshold,
+                          min_segment_length,
+                          out_flow_dir,
+                          out_flow_acc,
+                          out_initiation_raster,
+                          cache=None,
+                          graph_output=None,
+                          iterative_pruning=False,
+                          incremental=False,
+                          store=None):
+
+    # Read input rasters on the DEM grid
+    steps = profiling.steps()
+    steps.next('Reading input rasters')
+    arcpy.AddMessage('Reading input rasters')
+    DEM, info = raster_io.read_raster(DEM_input)
+    if precipitation and precipitation != "#":
+        precipitation = raster_io.read_raster(precipitation, info)[0]
+    if evapotranspiration and evapotranspiration != "#":
+        evapotranspiration = raster_io.read_raster(evapotranspiration, info)[0]
+
+    # Graph of the previous run for an incremental update
+    previous_graph = None
+    if incremental and graph_output and os.path.exists(graph_output):
+        arcpy.AddMessage('Updating the stream graph of the previous run')
+        previous_graph = stream_graph.load(graph_output)
+
+    # Slope, hydro-processing and stream network in memory
+    steps.next('Running NumPy hydrology backend')
+    arcpy.AddMessage('Running NumPy hydrology backend')
+    results = stream_network_numpy.CEI_extraction(DEM,
+                                                  info.cell_x,
+                                                  info.cell_y,
+                                                  precipitation,
+                                                  evapotranspiration,
+                                                  initiation_function_type,
+                                                  initiation_threshold,
+                                                  min_segment_length,
+                                                  cache,
+                                                  iterative_pruning,
+                                                  previous_graph,
+                                                  store)
+
+    # Convert results back to rasters
+    steps.next('Writing rasters')
+    slope_percent = raster_io.to_raster(results['slope_percent'], info)
+    slope_percent.save('slope_percent')  # Do not delete!
+    raster_io.to_raster(results['flow_drop'], info).save('flow_drop')  # Do not delete!
+    flow_directions = raster_io.to_raster(results['flow_directions'], info, numpy_hydrology.FLOW_DIR_NODATA)
+    if out_flow_dir and out_flow_dir != "#":
+        arcpy.AddMessage('Saving flow directions')
+        flow_directions.save(out_flow_dir)
+    if out_flow_acc and out_flow_acc != "#" and results['flow_accumulation'] is not None:
+        arcpy.AddMessage('Saving flow accumulation')
+        raster_io.to_raster(results['flow_accumulation'], info).save(out_flow_acc)
+    if out_initiation_raster and out_initiation_raster != "#" and results['initiation_raster'] is not None:
+        arcpy.AddMessage('Saving initiation raster')
+        raster_io.to_raster(results['initiation_raster'], info).save(out_initiation_raster)
+    if graph_output:
+        # Link graph of the network before pruning for later runs
+        stream_graph.save(results['network_graph'], graph_output)
+    stream_links = raster_io.to_raster(results['stream_links'], info, 0)
+    stream_orders = raster_io.to_raster(results['stream_orders'], info, 0)
+    watersheds = raster_io.to_raster(results['watersheds'], info, 0)
+    steps.end()
+    return flow_directions, stream_links, stream_orders, watersheds, results['flow_accumulation_simple']
+
+def write_stream_segments(stream_orders, flow_directions, rivers_output, slope=None, DEM=None,
+                          flow_accumulation=None):
+    # Polylines of same-order stream segments with their Strahler order and,
+    # with a slope raster or a DEM, the slope and elevation statistics of
+    # their cells (see stream_network_numpy.SEGMENT_FIELDS), traced on the
+    # rasters and inserted in one pass. flow_accumulation is the unweighted
+    # accumulation array of the run, if it has one. Returns per-segment
+    # arrays of the written features (see stream_network_numpy.segment_table)
+    steps = profiling.steps()
+    steps.next('Segment statistics')
+    orders, info = raster_io.read_raster(stream_orders)
+    orders = np.where(np.isnan(orders), 0, orders).astype(np.int32)
+    codes = raster_io.read_flow_directions(flow_directions, info)[0]
+    if slope is not None:
+        slope = raster_io.read_raster(slope, info)[0]
+    if DEM is not None:
+        DEM = raster_io.read_raster(DEM, info)[0]
+    segments, table = stream_network_numpy.segment_table(orders, codes, info.cell_x, info.cell_y, slope, DEM,
+                                                         flow_accumulation)
+
+    steps.next('Writing stream features')
+    out_path, out_name = os.path.split(rivers_output)
+    arcpy.CreateFeatureclass_management(out_path or arcpy.env.workspace, out_name, "POLYLINE",
+                                        spatial_reference=info.spatial_reference)
+    # Shapefile field names are cut to 10 characters
+    field = 'strahler_o' if rivers_output[-4:] == '.shp' else 'strahler_order'
+    arcpy.AddField_management(rivers_output, field, "SHORT", field_alias="Strahler order")
+    columns = [(name, table[key]) for key, name in stream_network_numpy.SEGMENT_FIELDS if key in table]
+    for name, _ in columns:
+        arcpy.AddField_management(rivers_output, name, "FLOAT")
+    # NaN (no valid cells) is written as null
+    values = [[None if np.isnan(value) else float(value) for value in column] for _, column in columns]
+    with arcpy.da.InsertCursor(rivers_output, ['SHAPE@', field] + [name for name, _ in columns]) as cursor:
+        for n, (order, rows, cols) in enumerate(segments):
+            x, y = raster_io.cell_centres(rows, cols, info)
+            points = arcpy.Array([arcpy.Point(float(i), float(j)) for i, j in zip(x, y)])
+            cursor.insertRow([arcpy.Polyline(points, info.spatial_reference), order] +
+                             [column[n] for column in values])
+    steps.end()
+    return table
+
+@profiling.profiled('threshold_sweep')
+def threshold_sweep(DEM_input,
+                    precipitation,
+                    evapotranspiration,
+                    initiation_function_type,
+                    thresholds,
+                    min_segment_length,
+                    text_output):
+    # Stream network statistics for a list of initiation thresholds
+    # (separated by ';'), computed from a single initiation raster
+    DEM, info = raster_io.read_raster(DEM_input)
+    if precipitation and precipitation != "#":
+        precipitation = raster_io.read_raster(precipitation, info)[0]
+    if evapotranspiration and evapotranspiration != "#":
+        evapotranspiration = raster_io.read_raster(evapotranspiration, info)[0]
+    thresholds = [t for t in thresholds.split(';') if t.strip()]
+    arcpy.AddMessage('Sweeping initiation thresholds: ' + str(thresholds))
+    results = stream_network_numpy.threshold_sweep(DEM,
+                                                   info.cell_x,
+                                                   info.cell_y,
+                                                   precipitation,
+                                                   evapotranspiration,
+                                                   initiation_function_type,
+                                                   thresholds,
+                                                   min_segment_length)
+
+    # Write statistics for every threshold to the output text file
+    arcpy.AddMessage('Save statistics to the text file')
+    with open(text_output, 'w') as out:
+        for threshold, stats in results:
+            out.write('Initiation threshold: ' + str(threshold) + '\n')
+            order_report.write_statistics(out, stats['total_length'], stats['total_count'],
+                                          stats['values'], stats['order_length'], stats['order_count'])
+            out.write('\n')
+
+def _extract_network(DEM_input,
+                     precipitation,
+                     evapotranspiration,
+                     initiation_function_type,
+                     initiation_threshold,
+                     min_segment_length,
+                     rivers_output,
+                     text_output,
+                     out_flow_dir,
+                     out_flow_acc,
+                     out_initiation_raster,
+                     out_stream_links,
+                     out_stream_orders,
+                     out_watersheds,
+                     backend='ARCGIS',
+                     cache_dir=None,
+                     iterative_pruning='false',
+                     incremental='false',
+                     store=None):
     # Prepare environments
+    steps = profiling.steps()
+    steps.next('Preparing environments')
     arcpy.env.overwriteOutput = True
     arcpy.env.extent = DEM_input
     arcpy.env.snapRaster = DEM_input
@@ -307,191 +405,212 @@ def CEI_extraction(DEM_input,
         output_format = 'SHAPE'
     else:
         output_format = 'GDB'
-
-    # Calculate slope
-    arcpy.AddMessage('Calculating slope')
-    slope_percent = arcpy.sa.Slope(DEM_input, "PERCENT_RISE")
-    slope_percent.save('slope_percent')  # Do not delete!
-    slope_tangent = arcpy.sa.Times(slope_percent, 0.01)
-    slope_tangent.save('slope_tangent')  # left for debugging purposes
+    # Optional cache of hydro-conditioned DEM products (see hydro_cache)
+    cache = hydro_cache.open_cache(cache_dir)
+    # Boolean tool parameters come as 'true' / 'false'
+    iterative_pruning = str(iterative_pruning).lower() == 'true'
+    incremental = str(incremental).lower() == 'true'
+    # Unweighted flow accumulation array for the segment catchment areas,
+    # computed with the segments if the run has none
+    flow_accumulation = None
+
+    if backend == 'NUMPY':
+        # Raster part of the pipeline runs on in-memory arrays
+        steps.next('NumPy backend')
+        flow_directions, stream_links, stream_orders, outWatersheds_raster, flow_accumulation = \
+            numpy_backend_rasters(DEM_input,
+                                  precipitation,
+                                  evapotranspiration,
+                                  initiation_function_type,
+                                  initiation_threshold,
+                                  min_segment_length,
+                                  out_flow_dir,
+                                  out_flow_acc,
+                                  out_initiation_raster,
+                                  cache,
+                                  os.path.splitext(text_output)[0] + '_graph.npz' if incremental else None,
+                                  iterative_pruning,
+                                  incremental,
+                                  store)
+    elif cache is not None:
+        # Slope and flow directions from the cache of conditioned DEMs
+        steps.next('Reading hydro-conditioned DEM from cache')
+        arcpy.AddMessage('Reading hydro-conditioned DEM from cache')
+        products, info = hydro_cache.conditioned_rasters(DEM_input, cache)
+        slope_percent = raster_io.to_raster(products['slope_percent'], info)
+        slope_percent.save('slope_percent')  # Do not delete!
+        slope_tangent = arcpy.sa.Times(slope_percent, 0.01)
+        raster_io.to_raster(products['flow_drop'], info).save('flow_drop')  # Do not delete!
+        flow_directions = raster_io.to_raster(products['flow_directions'], info, numpy_hydrology.FLOW_DIR_NODATA)
+        flow_accumulation = products['flow_accumulation']
+    else:
+        # Calculate slope
+        steps.next('Calculating slope')
+        arcpy.AddMessage('Calculating slope')
+        slope_percent = arcpy.sa.Slope(DEM_input, "PERCENT_RISE")
+        slope_percent.save('slope_percent')  # Do not delete!
+        slope_tangent = arcpy.sa.Times(slope_percent, 0.01)
+        # slope_tangent.save('slope_tangent')  # DEBUG
     
-    # DEM Hydro-processing
-    # Fill in sinks
-    arcpy.AddMessage('Fill in sinks')
-    DEM_fill = arcpy.sa.Fill(DEM_input)
-    # Calculate flow directions
-    arcpy.AddMessage('Calculating flow directions')
-    flow_directions = arcpy.sa.FlowDirection(DEM_fill, "NORMAL", 'slope_percent')
-    # Save output flow direction as optional parameter
-    if out_flow_dir and out_flow_dir != "#":
-        arcpy.AddMessage('Saving flow directions')
-        flow_directions.save(out_flow_dir)
+        # DEM Hydro-processing
+        # Fill in sinks
+        steps.next('Fill in sinks')
+        arcpy.AddMessage('Fill in sinks')
+        DEM_fill = arcpy.sa.Fill(DEM_input)
+        # Calculate flow directions
+        steps.next('Calculating flow directions')
+        arcpy.AddMessage('Calculating flow directions')
+        flow_directions = arcpy.sa.FlowDirection(DEM_fill, "NORMAL", 'flow_drop')
+
+    if backend != 'NUMPY':
+        # Save output flow direction as optional parameter
+        if out_flow_dir and out_flow_dir != "#":
+            arcpy.AddMessage('Saving flow directions')
+            flow_directions.save(out_flow_dir)
     
-    # Reconstructing river network
-    if initiation_function_type in ('CATCHMENT_AREA', 'SLOPE_POWER_INDEX', 'SHEAR_STRESS_INDEX',
-                                    'CLIMATIC_RUNOFF', 'COMPLEX_ENERGY_INDEX', 'SHEAR_STRESS_ENERGY'):
-        stream_cells = extract_streams_flowacc(flow_directions,
-                                               initiation_function_type,
-                                               precipitation,
-                                               evapotranspiration,
-                                               slope_tangent,
-                                               cell_area,
-                                               out_flow_acc,
-                                               out_initiation_raster,
-                                               initiation_threshold)
-    elif initiation_function_type == 'MEAN_EROSION_CUT':
-        stream_cells = extract_streams_erosion_cut(flow_directions,
-                                                   DEM_input,
+        # Reconstructing river network
+        steps.next('Extracting stream cells')
+        if initiation_function_type in ('CATCHMENT_AREA', 'SLOPE_POWER_INDEX', 'SHEAR_STRESS_INDEX',
+                                        'CLIMATIC_RUNOFF', 'COMPLEX_ENERGY_INDEX', 'SHEAR_STRESS_ENERGY'):
+            stream_cells = extract_streams_flowacc(flow_directions,
+                                                   initiation_function_type,
+                                                   precipitation,
+                                                   evapotranspiration,
+                                                   slope_tangent,
+                                                   cell_area,
+                                                   out_flow_acc,
+                                                   out_initiation_raster,
                                                    initiation_threshold)
-    elif initiation_function_type in ('RESILIENCE', 'CEI_TO_MEAN_EROSION_CUT'):
-        stream_cells = extract_streams_cei_to_mean_erosion_cut(flow_directions, 
-                                                               initiation_function_type,
-                                                               DEM_input,
-                                                               precipitation,
-                                                               evapotranspiration,
-                                                               slope_tangent,
-                                                               cell_area,
-                                                               initiation_threshold,
-                                                               out_flow_acc,
-                                                               out_initiation_raster)
-    elif initiation_function_type == 'DRAINAGE_NETWORK_STRAHLER_ORDER':
-        stream_cells = extract_streams_drainage_strahler_order(flow_directions,
-                                                               initiation_threshold)
+        elif initiation_function_type == 'MEAN_EROSION_CUT':
+            stream_cells = extract_streams_erosion_cut(flow_directions,
+                                                       DEM_input,
+                                                       initiation_threshold)
+        elif initiation_function_type in ('RESILIENCE', 'CEI_TO_MEAN_EROSION_CUT'):
+            stream_cells = extract_streams_cei_to_mean_erosion_cut(flow_directions, 
+                                                                   initiation_function_type,
+                                                                   DEM_input,
+                                                                   precipitation,
+                                                                   evapotranspiration,
+                                                                   slope_tangent,
+                                                                   cell_area,
+                                                                   initiation_threshold,
+                                                                   out_flow_acc,
+                                                                   out_initiation_raster)
+        elif initiation_function_type == 'DRAINAGE_NETWORK_STRAHLER_ORDER':
+            stream_cells = extract_streams_drainage_strahler_order(flow_directions,
+                                                                   initiation_threshold)
 
-    else:
-        arcpy.AddMessage('Wrong initiation function type')
+        else:
+            arcpy.AddMessage('Wrong initiation function type')
     
-    # Wipe short 1st order cells
-    if min_segment_length and min_segment_length not in ('#', '0'):
-        arcpy.AddMessage('Wipe short 1st order streams')
-        stream_cells = exclude_small_streams(stream_cells, flow_directions, min_segment_length)
+        # Wipe short 1st order cells
+        if min_segment_length and min_segment_length not in ('#', '0'):
+            steps.next('Wipe short 1st order streams')
+            arcpy.AddMessage('Wipe short 1st order streams')
+            stream_cells = exclude_small_streams(stream_cells, flow_directions, min_segment_length,
+                                                 iterative_pruning)
+
+        # Extract stream links and orders
+        steps.next('Extract stream links and orders')
+        arcpy.AddMessage('Extract stream links and orders')
+        stream_links = arcpy.sa.StreamLink(stream_cells, flow_directions)
+        stream_orders = arcpy.sa.StreamOrder(stream_cells, flow_directions, "STRAHLER")
+        if out_watersheds and out_watersheds != '#':
+            # Only the watershed polygons need them
+            steps.next('Delineating watersheds')
+            arcpy.AddMessage('Delineating watersheds')
+            outWatersheds_raster = arcpy.sa.Watershed(flow_directions, stream_links)
 
     # Extract streams
+    steps.next('Extract vector streams')
     arcpy.AddMessage('Extract vector streams')
-    stream_links = arcpy.sa.StreamLink(stream_cells, flow_directions)
     if out_stream_links and out_stream_links != '#':
         stream_links.save(out_stream_links)
-    stream_orders = arcpy.sa.StreamOrder(stream_cells, flow_directions, "STRAHLER")
     if out_stream_orders and out_stream_orders != '#':
         stream_orders.save(out_stream_orders)
     else:
         out_stream_orders = 'stream_order'
         stream_orders.save(out_stream_orders)
-    arcpy.sa.StreamToFeature(stream_orders, flow_directions, 'streams_output', "SIMPLIFY")
-    # Changing field name to a meaningful string
-    arcpy.AlterField_management('streams_output', 'grid_code', 'strahler_order', "Strahler order")
-    arcpy.AddMessage('Delineating watersheds')
-    outWatersheds_raster = arcpy.sa.Watershed(flow_directions, stream_links)
     # outWatersheds_raster.save(out_watersheds)  # DEBUG
     if out_watersheds and out_watersheds != '#':
         arcpy.RasterToPolygon_conversion(outWatersheds_raster, out_watersheds, "NO_SIMPLIFY", "", "MULTIPLE_OUTER_PART")
 
-    # Join streams with equal Strahler order
-    arcpy.AddMessage('Dissolving streams')
-    # Working with Stream order raster attribute table
-    # Build attribute table
-    arcpy.BuildRasterAttributeTable_management(out_stream_orders)
-    # Extract values
-    values = [i[0] for i in arcpy.da.SearchCursor(out_stream_orders, "Value")]
+    # Trace streams into segments of equal Strahler order, split at confluences
+    steps.next('Tracing stream segments')
+    arcpy.AddMessage('Tracing stream segments')
+    # Slope and elevation statistics of every segment are written with it.
+    # The slope is taken along the flow on both backends: the drop raster of
+    # FlowDirection or its numpy_hydrology.flow_drop counterpart
+    segments = write_stream_segments(stream_orders, flow_directions, rivers_output, 'flow_drop', DEM_input,
+                                     flow_accumulation)
+    values = sorted(int(i) for i in np.unique(segments['order']))
     arcpy.AddMessage("Strahler orders are: " + str(values))
-    # Dissolve streams by Strahler order
-    arcpy.Dissolve_management('streams_output', 'streams_output_dissolve', 'strahler_order', "", "SINGLE_PART", "DISSOLVE_LINES")
-    # Extract both ends from dissolved streams
-    arcpy.FeatureVerticesToPoints_management('streams_output_dissolve', 'streams_output_end', "BOTH_ENDS")
-    # Split 'V-shaped' dissolved streams at end points
-    fc_list = []
-    # Set radius for splitting
-    split_radius = '1 Meters'
-    # Processing each order separately
-    for i in values:
-        # Selecting streams to split
-        expr = "strahler_order = " + str(i)
-        arcpy.MakeFeatureLayer_management('streams_output_dissolve', "streams_selection", expr)
-        # Selecting points to split. They have i+1 order
-        expr = "strahler_order = " + str(i + 1)
-        arcpy.MakeFeatureLayer_management('streams_output_end', "points_selection", expr)
-        # Split selected streams at selected points
-        rivers_temp = 'rivers_%s_order' % (i)  # Set dataset name
-        fc_list.append(rivers_temp)
-        arcpy.SplitLineAtPoint_management("streams_selection", "points_selection", rivers_temp, split_radius)
-    # Merging streams
-    arcpy.Merge_management(fc_list, rivers_output)
-    # Deleting temporary feature classes
-    arcpy.Delete_management('streams_output')
-    arcpy.Delete_management('streams_output_dissolve')
-    arcpy.Delete_management('streams_output_end')
-    for fc in fc_list:
-        arcpy.Delete_management(fc)
-
-    # Calculate mean slope within streams
-    # TODO: добавить вычисление средней высоты
-    arcpy.AddMessage('Calculate mean slope')
-    # Extract drop values by mask
-    drop_raster_streams = arcpy.sa.ExtractByMask('slope_percent', stream_orders)
-    # Perform zonal statistics; result is saved as raster
-    drop_raster_mean = arcpy.sa.ZonalStatistics(outWatersheds_raster, 'Value', drop_raster_streams, "MEAN")
-    # Extract rivers startpoints
-    arcpy.FeatureVerticesToPoints_management(rivers_output, 'rivers_startpoints', "START")
-    # Extract zonal statistics raster values to rivers' startpoints
-    arcpy.sa.ExtractValuesToPoints('rivers_startpoints', drop_raster_mean, 'rivers_startpoints_stat')
-    arcpy.Delete_management('rivers_startpoints')
-    # Join point attribute table to rivers, transfer attributes
-    arcpy.AddField_management(rivers_output, 'Mean_slope', "FLOAT")
-    arcpy.MakeFeatureLayer_management(rivers_output, 'rivers_layer')
-    if output_format == 'SHAPE':
-        target_field = 'FID'
-    else:
-        target_field = 'OBJECTID'
-    arcpy.AddJoin_management('rivers_layer', target_field, 'rivers_startpoints_stat', "ORIG_FID")
-    arcpy.CalculateField_management('rivers_layer', "Mean_slope", "!rivers_startpoints_stat.RASTERVALU!", "PYTHON_9.3")
-    # Remove join
-    arcpy.RemoveJoin_management('rivers_layer')
     # Delete temporary files
-    arcpy.Delete_management('rivers_startpoints_stat')
     arcpy.Delete_management('slope_percent')
-
-    # Compute number of streams and total length
-    # Computation is performed over simplified streams to reduce error
-    # Compute total river length
-    arcpy.AddMessage('Compute river length and number of segments')
-    total_length = float(sum(row[0] for row in arcpy.da.SearchCursor(rivers_output, 'SHAPE@LENGTH')))
-    total_count = arcpy.GetCount_management(rivers_output)
-    
-    # Compute statistics by order   
-    # Count number and total length for every order
-    order_length = []
-    order_count = []
-    for i in values:
-        if output_format == 'SHAPE':
-            expr = "strahler_o = " + str(i)
-        else:
-            expr = "strahler_order = " + str(i)
-        arcpy.MakeFeatureLayer_management(rivers_output, "rivers_selection", expr)
-        order_length.append(float(sum(row[0] for row in arcpy.da.SearchCursor("rivers_selection", 'SHAPE@LENGTH'))))
-        order_count.append(arcpy.GetCount_management("rivers_selection"))
+    arcpy.Delete_management('flow_drop')
 
     # Delete Strahler order raster if not saved explicitly
     if out_stream_orders and out_stream_orders != '#':
         arcpy.Delete_management('stream_order')
 
-    # Write parameters to the output text file
+    # Number of streams, total length and statistics by order from the
+    # per-segment values collected while the segments were written
+    steps.next('Save statistics to the text file')
     arcpy.AddMessage('Save statistics to the text file')
-    with open(text_output, 'w') as out:
-        out.write('Total river length: ' + str(total_length) + ' m\n')
-        out.write('Total count: ' + str(total_count) + '\n')
-        for i in values:  # array starts at 0, but orders start from 1, so [i-1]
-            if i == 1:
-                suffix = "nd "
-            elif i == 2:
-                suffix = 'rd '
-            else:
-                suffix = 'st '
-            out.write(str(i) + suffix + 'order length: '+ str(order_length[i-1]) + 'm \n')
-            out.write(str(i) + suffix + 'order count: ' + str(order_count[i-1]) + '\n')
-    #TODO: средняя длина, средний уклон, средняя площадь водосбора
+    order_report.write_stream_statistics(text_output, segments)
+    steps.end()
     return
 
 
+@profiling.profiled('stream_network')
+def CEI_extraction(DEM_input,
+                   precipitation,
+                   evapotranspiration,
+                   initiation_function_type,
+                   initiation_threshold,
+                   min_segment_length,
+                   rivers_output,
+                   text_output,
+                   out_flow_dir,
+                   out_flow_acc,
+                   out_initiation_raster,
+                   out_stream_links,
+                   out_stream_orders,
+                   out_watersheds,
+                   backend='ARCGIS',
+                   cache_dir=None,
+                   iterative_pruning='false',
+                   incremental='false'):
+    # Intermediate rasters of the run live in a scratch store that also
+    # takes the temporary ArcGIS rasters and is removed when the run ends,
+    # failed or not
+    with scratch_store.ScratchStore() as store:
+        scratch_workspace = arcpy.env.scratchWorkspace
+        arcpy.env.scratchWorkspace = store.directory
+        try:
+            return _extract_network(DEM_input,
+                                    precipitation,
+                                    evapotranspiration,
+                                    initiation_function_type,
+                                    initiation_threshold,
+                                    min_segment_length,
+                                    rivers_output,
+                                    text_output,
+                                    out_flow_dir,
+                                    out_flow_acc,
+                                    out_initiation_raster,
+                                    out_stream_links,
+                                    out_stream_orders,
+                                    out_watersheds,
+                                    backend,
+                                    cache_dir,
+                                    iterative_pruning,
+                                    incremental,
+                                    store)
+        finally:
+            arcpy.env.scratchWorkspace = scratch_workspace
+
+
 if __name__ == '__main__':
     # Arguments are optional
     args = tuple(arcpy.GetParameterAsText(i)
@@ -0,0 +1,560 @@
+import os
+import numpy as np
+import hydro_cache
+import numpy_hydrology as nh
+import parallel_hydrology as ph
+import profiling
+import raster_expression
+import stream_graph
+import tiled_hydrology
+import zonal_statistics
+
+
+# NumPy counterpart of the raster part of stream_network.CEI_extraction.
+# Every function works on in-memory arrays (NoData is NaN, see numpy_hydrology)
+# and keeps the same initiation function types and parameters as the
+# arcpy.sa implementation, so a run needs neither ArcGIS nor scratch rasters.
+# Functions taking flow_directions also take a numpy_hydrology.FlowGraph;
+# a run builds one after conditioning the DEM, so the accumulations, stream
+# links, orders and watersheds share one set of receivers and one
+# topological order of the cells.
+
+FLOWACC_TYPES = ('CATCHMENT_AREA', 'SLOPE_POWER_INDEX', 'SHEAR_STRESS_INDEX',
+                 'CLIMATIC_RUNOFF', 'COMPLEX_ENERGY_INDEX', 'SHEAR_STRESS_ENERGY')
+# Initiation types whose initial cells are taken as the stream network as is
+DIRECT_TYPES = ('CATCHMENT_AREA', 'CLIMATIC_RUNOFF', 'DRAINAGE_NETWORK_STRAHLER_ORDER')
+# Initiation functions as raster expressions (see raster_expression)
+FLOWACC_EXPRESSIONS = {
+    'CATCHMENT_AREA': 'flow_accumulation * cell_area',
+    'CLIMATIC_RUNOFF': 'flow_accumulation * cell_area',
+    'SLOPE_POWER_INDEX': 'flow_accumulation * cell_area * slope_tangent',
+    'COMPLEX_ENERGY_INDEX': 'flow_accumulation * cell_area * slope_tangent',
+    'SHEAR_STRESS_INDEX': 'sqrt(flow_accumulation * cell_area) * slope_tangent',
+    'SHEAR_STRESS_ENERGY': 'sqrt(flow_accumulation * cell_area) * slope_tangent'}
+MEAN_EROSION_CUT_EXPRESSION = \
+    '(flow_accumulation_elev_weighted + DEM) / (flow_accumulation_simple + 1) - DEM'
+RESILIENCE_EXPRESSION = 'cei / (%s)' % MEAN_EROSION_CUT_EXPRESSION
+CEI_TO_MEAN_EROSION_CUT_EXPRESSION = \
+    'cei / ((flow_acc_cei + cei) / (flow_accumulation_simple + 1) / (%s))' % MEAN_EROSION_CUT_EXPRESSION
+
+
+def _to_float(value):
+    # Tool parameters come as text, possibly with a comma decimal separator
+    return float(str(value).replace(',', '.'))
+
+
+def _is_set(parameter):
+    # Optional tool parameters are None, '' or '#' when not set
+    if parameter is None:
+        return False
+    if isinstance(parameter, np.ndarray):
+        return True
+    return str(parameter) not in ('', '#')
+
+
+def overland_flow(flow_directions, precipitation, evapotranspiration):
+    # P - ET in metres; ET is 0 if it is not set explicitly
+    valid = nh.flow_graph(flow_directions).codes != nh.FLOW_DIR_NODATA
+    if _is_set(evapotranspiration):
+        runoff = precipitation - evapotranspiration
+    else:
+        runoff = np.where(valid, precipitation, np.nan)
+    return runoff * 0.001
+
+
+def reconstruct_streams(flow_directions, initials):
+    # Stream cells are the initial cells and every cell downstream of them
+    flow_accumulation_streams = ph.flow_accumulation(flow_directions, initials)
+    return initials | (np.nan_to_num(flow_accumulation_streams) + initials > 0)
+
+
+def extract_initials(initiation_raster, initiation_function_type, initiation_threshold):
+    # NoData cells are never initial cells
+    with np.errstate(invalid='ignore'):
+        if initiation_function_type == 'DRAINAGE_NETWORK_STRAHLER_ORDER':
+            return initiation_raster >= _to_float(initiation_threshold)
+        return initiation_raster > _to_float(initiation_threshold)
+
+
+def condition_dem(DEM, cell_x, cell_y, cache=None, tile_size=None, directory=None):
+    # Slope, filled DEM, flow directions and (with a cache or tiles only) the
+    # unweighted flow accumulation computed along with them. With tile_size
+    # and no cache the DEM is conditioned tile by tile into .npy memmaps in
+    # directory; given a directory, tile_size defaults to
+    # tiled_hydrology.default_tile_size. Tiling bounds the memory of the
+    # conditioning only, the caller still holds the DEM
+    if cache is not None:
+        products = hydro_cache.conditioned_dem(DEM, cell_x, cell_y, cache)
+        return (products['slope_percent'], products['DEM_fill'],
+                products['flow_directions'], products['flow_accumulation'])
+    if not tile_size and directory is not None:
+        tile_size = tiled_hydrology.default_tile_size()
+    if tile_size:
+        if directory is None:
+            raise ValueError('Tiled conditioning needs a directory for its rasters')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return tiled_hydrology.condition_dem(DEM, directory, int(tile_size), cell_x, cell_y)
+    DEM_fill, flow_directions = nh.condition(DEM, cell_x, cell_y)
+    return nh.slope(DEM, cell_x, cell_y), DEM_fill, flow_directions, None
+
+
+def flowacc_initiation(flow_directions,
+                       initiation_function_type,
+                       precipitation,
+                       evapotranspiration,
+                       slope_tangent,
+                       cell_area,
+                       flow_accumulation_simple=None):
+
+    # Calculate flow accumulation (weighted by P - ET for climatic types)
+    if initiation_function_type in ('CATCHMENT_AREA', 'SLOPE_POWER_INDEX', 'SHEAR_STRESS_INDEX'):
+        if flow_accumulation_simple is None:
+            flow_accumulation_simple = ph.flow_accumulation(flow_directions)
+        flow_accumulation = flow_accumulation_simple
+    else:
+        overland_flow_m = overland_flow(flow_directions, precipitation, evapotranspiration)
+        flow_accumulation = ph.flow_accumulation(flow_directions, overland_flow_m)
+
+    # Calculate initiation function raster
+    initiation_raster = raster_expression.evaluate(FLOWACC_EXPRESSIONS[initiation_function_type],
+                                                   {'flow_accumulation': flow_accumulation,
+                                                    'cell_area': cell_area,
+                                                    'slope_tangent': slope_tangent})
+    return initiation_raster, flow_accumulation, flow_accumulation_simple
+
+
+def mean_erosion_cut(DEM, flow_accumulation_simple, flow_accumulation_elev_weighted):
+    # Mean elevation of the cell's watershed minus the cell elevation
+    return raster_expression.evaluate(MEAN_EROSION_CUT_EXPRESSION,
+                                      {'DEM': DEM,
+                                       'flow_accumulation_simple': flow_accumulation_simple,
+                                       'flow_accumulation_elev_weighted': flow_accumulation_elev_weighted})
+
+
+def erosion_cut_initiation(flow_directions, DEM, flow_accumulation_simple=None):
+
+    # Simple and elevation-weighted flow accumulation in one pass
+    if flow_accumulation_simple is None:
+        flow_accumulation_simple, flow_accumulation_elev_weighted = \
+            ph.multi_flow_accumulation(flow_directions, [None, DEM])
+    else:
+        flow_accumulation_elev_weighted = ph.flow_accumulation(flow_directions, DEM)
+    initiation_raster = mean_erosion_cut(DEM, flow_accumulation_simple, flow_accumulation_elev_weighted)
+    return initiation_raster, None, flow_accumulation_simple
+
+
+def cei_to_mean_erosion_cut_initiation(flow_directions,
+                                       initiation_function_type,
+                                       DEM,
+                                       precipitation,
+                                       evapotranspiration,
+                                       slope_tangent,
+                                       cell_area,
+                                       flow_accumulation_simple=None):
+
+    # Overland flow, simple and elevation-weighted accumulation in one pass
+    overland_flow_m = overland_flow(flow_directions, precipitation, evapotranspiration)
+    if flow_accumulation_simple is None:
+        flow_accumulation, flow_accumulation_simple, flow_accumulation_elev_weighted = \
+            ph.multi_flow_accumulation(flow_directions, [overland_flow_m, None, DEM])
+    else:
+        flow_accumulation, flow_accumulation_elev_weighted = \
+            ph.multi_flow_accumulation(flow_directions, [overland_flow_m, DEM])
+    # Calculating CEI
+    cei = raster_expression.evaluate(FLOWACC_EXPRESSIONS['COMPLEX_ENERGY_INDEX'],
+                                     {'flow_accumulation': flow_accumulation,
+                                      'cell_area': cell_area,
+                                      'slope_tangent': slope_tangent})
+    variables = {'cei': cei,
+                 'DEM': DEM,
+                 'flow_accumulation_simple': flow_accumulation_simple,
+                 'flow_accumulation_elev_weighted': flow_accumulation_elev_weighted}
+    if initiation_function_type == 'RESILIENCE':
+        # CEI divided by the mean erosion cut
+        initiation_raster = raster_expression.evaluate(RESILIENCE_EXPRESSION, variables)
+    else:
+        # Mean CEI over the basin divided by the erosion cut (ground resistance)
+        variables['flow_acc_cei'] = ph.flow_accumulation(flow_directions, cei)
+        initiation_raster = raster_expression.evaluate(CEI_TO_MEAN_EROSION_CUT_EXPRESSION, variables)
+    return initiation_raster, flow_accumulation, flow_accumulation_simple
+
+
+def drainage_strahler_order_initiation(flow_directions, flow_accumulation_simple=None):
+
+    # Strahler orders for all cells
+    valid = nh.flow_graph(flow_directions).codes != nh.FLOW_DIR_NODATA
+    return nh.stream_order(valid, flow_directions).astype(np.float64), None, flow_accumulation_simple
+
+
+def initiation(flow_directions,
+               initiation_function_type,
+               DEM,
+               precipitation,
+               evapotranspiration,
+               slope_tangent,
+               cell_area,
+               flow_accumulation_simple=None):
+    # Initiation function raster, the flow accumulation it is based on and
+    # the unweighted flow accumulation (None if the type needs none). A
+    # precomputed unweighted accumulation is reused where the type needs one
+    if initiation_function_type in FLOWACC_TYPES:
+        return flowacc_initiation(flow_directions,
+                                  initiation_function_type,
+                                  precipitation,
+                                  evapotranspiration,
+                                  slope_tangent,
+                                  cell_area,
+                                  flow_accumulation_simple)
+    elif initiation_function_type == 'MEAN_EROSION_CUT':
+        return erosion_cut_initiation(flow_directions, DEM, flow_accumulation_simple)
+    elif initiation_function_type in ('RESILIENCE', 'CEI_TO_MEAN_EROSION_CUT'):
+        return cei_to_mean_erosion_cut_initiation(flow_directions,
+                                                  initiation_function_type,
+                                                  DEM,
+                                                  precipitation,
+                                                  evapotranspiration,
+                                                  slope_tangent,
+                                                  cell_area,
+                                                  flow_accumulation_simple)
+    elif initiation_function_type == 'DRAINAGE_NETWORK_STRAHLER_ORDER':
+        return drainage_strahler_order_initiation(flow_directions, flow_accumulation_simple)
+    raise ValueError('Wrong initiation function type: %s' % initiation_function_type)
+
+
+def extract_streams(flow_directions, initiation_raster, initiation_function_type, initiation_threshold):
+    # Initial cells, connected downstream unless the type uses them directly
+    initials = extract_initials(initiation_raster, initiation_function_type, initiation_threshold)
+    if initiation_function_type in DIRECT_TYPES:
+        return initials
+    return reconstruct_streams(flow_directions, initials)
+
+
+def prune_short_streams(graph, stream_cells, min_length_pixels, iterative=False):
+    # Remove 1st order links of min_length_pixels cells or less from the
+    # link graph (see stream_graph.short_sources); only the cells of removed
+    # links are cleared. Returns the pruned graph and stream cells
+    removed = stream_graph.short_sources(graph, _to_float(min_length_pixels), iterative)
+    stream_cells = nh.as_mask(stream_cells).copy()
+    stream_cells.flat[graph.cells_of(removed)] = False
+    return stream_graph.remove_links(graph, removed), stream_cells
+
+
+def exclude_small_streams(stream_cells, flow_directions, min_length_pixels, iterative=False):
+
+    # Keep links longer than min_length_pixels and everything above 1st order
+    graph = stream_graph.build(stream_cells, flow_directions)
+    return prune_short_streams(graph, stream_cells, min_length_pixels, iterative)[1]
+
+
+def network_statistics(stream_orders, flow_directions, cell_x, cell_y):
+    # Total length and count of the network and per Strahler order, as written
+    # to text_output: the segments are those of the stream features (see
+    # segment_table), lengths are measured between cell centres
+    segments = stream_segments(stream_orders, flow_directions)
+    segments = [segments[n] for n in polyline_segments(segments)]
+    orders = np.array([order for order, _, _ in segments], dtype=np.int64)
+    lengths = segment_lengths(segments, cell_x, cell_y)
+    n_orders = int(orders.max()) + 1 if orders.size else 1
+    order_length = np.bincount(orders, weights=lengths, minlength=n_orders)
+    order_count = np.bincount(orders, minlength=n_orders)
+    values = [i for i in range(1, n_orders) if order_count[i]]
+    return {'total_length': float(lengths.sum()),
+            'total_count': len(segments),
+            'values': values,
+            'order_length': [float(order_length[i]) for i in values],
+            'order_count': [int(order_count[i]) for i in values]}
+
+
+def stream_segments(stream_orders, flow_directions, simplify=True, labels=False):
+    # Polylines of same-order segments, traced along the D8 graph of stream
+    # cells. A segment runs from its head (no donor of its own order) down to
+    # the cell where it joins a stream of another order; that junction cell is
+    # the last vertex, so segments meet at confluences as StreamToFeature
+    # lines do. With simplify, vertices inside straight runs are dropped.
+    # Returns a list of (order, rows, cols) with vertex cell indices; with
+    # labels also a raster of segment index + 1 on the cells of each segment
+    # (the junction cell belongs to the downstream segment), 0 elsewhere
+    order = np.asarray(stream_orders).ravel()
+    flow = nh.flow_graph(flow_directions)
+    shape = flow.shape
+    stream = order > 0
+    srcv = nh.stream_receivers(stream, flow.rcv)
+    cells = np.flatnonzero(stream)
+    if not cells.size:
+        return ([], np.zeros(shape, dtype=np.int32)) if labels else []
+    # Stream graph in the numbering of stream cells
+    position = np.full(order.size, -1, dtype=cells.dtype)
+    position[cells] = np.arange(cells.size)
+    downstream = np.where(srcv[cells] >= 0, position[np.maximum(srcv[cells], 0)], -1)
+    cell_order = order[cells]
+    # Every cell continues the segment of its donor of the same order
+    has_downstream = downstream >= 0
+    continues = np.zeros(cells.size, dtype=bool)
+    same = has_downstream & (cell_order[np.maximum(downstream, 0)] == cell_order)
+    continues[downstream[same]] = True
+    donor = np.full(cells.size, -1, dtype=cells.dtype)
+    donor[downstream[same]] = np.flatnonzero(same)
+    segment = np.zeros(cells.size, dtype=np.int64)
+    heads = np.flatnonzero(~continues)
+    segment[heads] = np.arange(heads.size)
+    depth = np.zeros(cells.size, dtype=np.int64)
+    levels = nh._flow_levels(downstream)
+    for step, level in enumerate(levels):
+        level = level[continues[level]]
+        segment[level] = segment[donor[level]]
+        depth[level] = step
+
+    # Cells of every segment from head to mouth, then the junction cell
+    vertices = np.lexsort((depth, segment))
+    vertex_segment = segment[vertices]
+    last = np.flatnonzero(np.r_[vertex_segment[1:] != vertex_segment[:-1], True])
+    mouth = downstream[vertices[last]]
+    joined = mouth >= 0
+    vertices = np.insert(vertices, last[joined] + 1, mouth[joined])
+    vertex_segment = np.insert(vertex_segment, last[joined] + 1, vertex_segment[last[joined]])
+    rows, cols = np.divmod(cells[vertices], shape[1])
+    first = np.r_[True, vertex_segment[1:] != vertex_segment[:-1]]
+    final = np.r_[vertex_segment[1:] != vertex_segment[:-1], True]
+    if simplify:
+        # Keep ends and the vertices where the flow direction turns
+        step_in = np.c_[np.r_[0, np.diff(rows)], np.r_[0, np.diff(cols)]]
+        step_out = np.r_[step_in[1:], [[0, 0]]]
+        turns = (step_in != step_out).any(axis=1)
+        keep = first | final | turns
+        rows, cols, vertex_segment = rows[keep], cols[keep], vertex_segment[keep]
+        first, final = first[keep], final[keep]
+    starts = np.flatnonzero(first)
+    ends = np.flatnonzero(final) + 1
+    head_order = cell_order[heads]
+    segments = [(int(head_order[vertex_segment[s]]), rows[s:e], cols[s:e]) for s, e in zip(starts, ends)]
+    if not labels:
+        return segments
+    # Segments are listed in the order of their numbers
+    label_raster = np.zeros(order.size, dtype=np.int32)
+    label_raster[cells] = segment + 1
+    return segments, label_raster.reshape(shape)
+
+
+# Per-segment slope and elevation statistics of segment_table and the
+# names of their fields in the stream features
+SEGMENT_FIELDS = (('mean_slope', 'Mean_slope'), ('min_slope', 'Min_slope'), ('max_slope', 'Max_slope'),
+                  ('mean_elevation', 'Mean_elev'), ('min_elevation', 'Min_elev'), ('max_elevation', 'Max_elev'),
+                  ('drop', 'Drop'))
+
+
+def polyline_segments(segments):
+    # Indices of the segments written as stream features. A segment of one
+    # vertex makes no polyline: a single cell with no stream cell downstream,
+    # i.e. at the raster edge, next to NoData or in a sink. One-cell heads
+    # joining another stream have the junction as their second vertex
+    return np.array([n for n, (_, rows, _) in enumerate(segments) if rows.size > 1], dtype=np.intp)
+
+
+def segment_lengths(segments, cell_x, cell_y):
+    return np.array([np.hypot(np.diff(cols) * cell_x, np.diff(rows) * cell_y).sum()
+                     for _, rows, cols in segments], dtype=np.float64)
+
+
+def segment_table(stream_orders, flow_directions, cell_x, cell_y, slope=None, DEM=None, flow_accumulation=None):
+    # Stream segments (see stream_segments) written as features (see
+    # polyline_segments), and per-segment arrays: 'order', 'length' (between
+    # cell centres), 'catchment_area' (area drained at the segment mouth,
+    # sq. m), with a slope raster 'mean_slope', 'min_slope' and 'max_slope'
+    # and with a DEM 'mean_elevation', 'min_elevation', 'max_elevation' and
+    # 'drop' (elevation range). Statistics are taken over the cells of every
+    # segment in one grouped reduction per raster. flow_accumulation is the
+    # unweighted accumulation of the run if it has one, it is computed
+    # otherwise. Returns (segments, table)
+    flow = nh.flow_graph(flow_directions)
+    segments, labels = stream_segments(stream_orders, flow, labels=True)
+    zones = zonal_statistics.ZoneIndex(labels, len(segments) + 1)
+    if flow_accumulation is None:
+        flow_accumulation = ph.flow_accumulation(flow)
+    # Accumulation grows downstream, its maximum is at the segment mouth
+    upstream_cells = zones.statistics(flow_accumulation)['max'][1:]
+    kept = polyline_segments(segments)
+    segments = [segments[n] for n in kept]
+    table = {'order': np.array([order for order, _, _ in segments], dtype=np.int32),
+             'length': segment_lengths(segments, cell_x, cell_y),
+             'catchment_area': (upstream_cells[kept] + 1) * cell_x * cell_y}
+    if slope is not None:
+        statistics = zones.statistics(slope)
+        for name in ('mean', 'min', 'max'):
+            table[name + '_slope'] = statistics[name][1:][kept]
+    if DEM is not None:
+        statistics = zones.statistics(DEM)
+        for name in ('mean', 'min', 'max'):
+            table[name + '_elevation'] = statistics[name][1:][kept]
+        table['drop'] = statistics['range'][1:][kept]
+    return segments, table
+
+
+def _keep(store, name, array):
+    # Array kept in the scratch store if there is one. A spilled array is a
+    # copy, callers replace their reference to the original with the result
+    if store is None or array is None:
+        return array
+    if isinstance(array, np.memmap):
+        return array  # already on disk (hydro cache, tiled conditioning)
+    return store.put(name, array)
+
+
+def CEI_extraction(DEM,
+                   cell_x,
+                   cell_y,
+                   precipitation,
+                   evapotranspiration,
+                   initiation_function_type,
+                   initiation_threshold,
+                   min_segment_length=None,
+                   cache=None,
+                   iterative_pruning=False,
+                   previous_graph=None,
+                   store=None,
+                   tile_size=None):
+    # Whole raster pipeline; returns a dict of named output arrays.
+    # cache is an optional hydro_cache.HydroCache for the conditioned DEM;
+    # with iterative_pruning short 1st order streams are removed until none
+    # is left in the re-ordered network. previous_graph is the unpruned
+    # 'network_graph' of an earlier run on the same DEM: only the links
+    # around cells that entered or left the network are traced and ordered
+    # again (see stream_graph.update); it is ignored if its source key does
+    # not match the flow directions and cell size of this run. With a
+    # scratch_store.ScratchStore the full rasters passed between stages are
+    # kept in the store, the returned arrays stay valid while it is open.
+    # tile_size conditions the DEM tile by tile (see condition_dem); the
+    # tiled rasters are written to the store directory, so it needs a store.
+    # The later stages read the conditioned rasters whole
+    DEM = np.asarray(DEM, dtype=np.float64)
+    cell_area = cell_x * cell_y
+    steps = profiling.steps()
+
+    # Slope and DEM hydro-processing
+    steps.next('Slope and DEM hydro-processing')
+    products = list(condition_dem(DEM, cell_x, cell_y, cache, tile_size,
+                                  os.path.join(store.directory, 'tiled') if store is not None else None))
+    # One original at a time is alive next to its copy
+    for n, name in enumerate(('slope_percent', 'DEM_fill', 'flow_directions', 'flow_accumulation_simple')):
+        products[n] = _keep(store, name, products[n])
+    slope_percent, DEM_fill, flow_directions, flow_accumulation_simple = products
+    del products
+    slope_tangent = slope_percent * 0.01
+    flow = nh.FlowGraph(flow_directions)
+    # Slope along the flow for the segment statistics, as the drop raster
+    # of FlowDirection on the ArcGIS backend
+    flow_drop = _keep(store, 'flow_drop', nh.flow_drop(DEM_fill, flow, cell_x, cell_y))
+
+    # Reconstructing river network
+    steps.next('Initiation function')
+    initiation_raster, flow_accumulation, flow_accumulation_simple = \
+        initiation(flow,
+                   initiation_function_type,
+                   DEM,
+                   precipitation,
+                   evapotranspiration,
+                   slope_tangent,
+                   cell_area,
+                   flow_accumulation_simple)
+    del slope_tangent
+    initiation_raster = _keep(store, 'initiation_raster', initiation_raster)
+    # Types based on the unweighted accumulation return it as both
+    same = flow_accumulation is flow_accumulation_simple
+    flow_accumulation_simple = _keep(store, 'flow_accumulation_simple', flow_accumulation_simple)
+    flow_accumulation = flow_accumulation_simple if same else _keep(store, 'flow_accumulation', flow_accumulation)
+    steps.next('Extracting stream cells')
+    stream_cells = extract_streams(flow, initiation_raster,
+                                   initiation_function_type, initiation_threshold)
+
+    # Link graph of the network
+    steps.next('Stream link graph')
+    # A previous graph traced on other flow directions or another cell size
+    # is not reused
+    source = stream_graph.source_key(flow, cell_x, cell_y)
+    if previous_graph is not None and previous_graph.source == source:
+        network_graph = stream_graph.update(previous_graph, stream_cells, flow, cell_x, cell_y)
+    else:
+        network_graph = stream_graph.build(stream_cells, flow, cell_x, cell_y)
+    network_graph.source = source
+    graph = network_graph
+    # Wipe short 1st order links
+    if _is_set(min_segment_length) and str(min_segment_length) != '0':
+        steps.next('Wipe short 1st order streams')
+        graph, stream_cells = prune_short_streams(graph, stream_cells, min_segment_length, iterative_pruning)
+
+    # Stream links, orders and watersheds
+    steps.next('Stream links, orders and watersheds')
+    stream_links = graph.link_raster()
+    stream_orders = graph.order_raster()
+    watersheds = nh.watershed(flow, stream_links)
+    steps.end()
+
+    return {'slope_percent': slope_percent,
+            'flow_drop': flow_drop,
+            'DEM_fill': DEM_fill,
+            'flow_directions': flow_directions,
+            'flow_accumulation': flow_accumulation,
+            'flow_accumulation_simple': flow_accumulation_simple,
+            'initiation_raster': initiation_raster,
+            'stream_cells': stream_cells,
+            'stream_links': stream_links,
+            'stream_orders': stream_orders,
+            'stream_graph': graph,
+            'network_graph': network_graph,
+            'watersheds': watersheds}
+
+
+def threshold_sweep(DEM,
+                    cell_x,
+                    cell_y,
+                    precipitation,
+                    evapotranspiration,
+                    initiation_function_type,
+                    thresholds,
+                    min_segment_length=None,
+                    cache=None):
+    # Network statistics for many initiation thresholds from one initiation
+    # raster. Every cell gets the key "highest initiation value at or upstream
+    # of the cell" (the initiation value itself for direct types), so the
+    # stream network for a threshold is exactly the cells with key above it.
+    # Cells are ranked by key once; going from the highest threshold down,
+    # each threshold only adds the next slice of the ranking.
+    # Returns a list of (threshold, statistics) in the input order
+    DEM = np.asarray(DEM, dtype=np.float64)
+    slope_percent, DEM_fill, flow_directions, flow_accumulation_simple = \
+        condition_dem(DEM, cell_x, cell_y, cache)
+    flow = nh.FlowGraph(flow_directions)
+    initiation_raster = initiation(flow,
+                                   initiation_function_type,
+                                   DEM,
+                                   precipitation,
+                                   evapotranspiration,
+                                   slope_percent * 0.01,
+                                   cell_x * cell_y,
+                                   flow_accumulation_simple)[0]
+    if initiation_function_type in DIRECT_TYPES:
+        key = np.asarray(initiation_raster, dtype=np.float64).ravel()
+    else:
+        key = nh.upstream_maximum(flow, initiation_raster).ravel()
+    valid = np.flatnonzero(~np.isnan(key))
+    ranking = valid[np.argsort(-key[valid], kind='mergesort')]
+    negative_keys = -key[ranking]  # ascending, as searchsorted expects
+    # Strahler order thresholds are inclusive, see extract_initials
+    side = 'right' if initiation_function_type == 'DRAINAGE_NETWORK_STRAHLER_ORDER' else 'left'
+
+    # The link graph is updated with the added cells only
+    graph = stream_graph.build(np.zeros(flow_directions.shape, dtype=bool), flow, cell_x, cell_y)
+    stream_cells = np.zeros(key.size, dtype=bool)
+    included = 0
+    results = {}
+    for threshold in sorted(set(_to_float(t) for t in thresholds), reverse=True):
+        count = np.searchsorted(negative_keys, -threshold, side=side)
+        stream_cells[ranking[included:count]] = True
+        cells = stream_cells.reshape(flow_directions.shape)
+        graph = stream_graph.update(graph, cells, flow, cell_x, cell_y, ranking[included:count])
+        included = count
+        pruned = graph
+        if _is_set(min_segment_length) and str(min_segment_length) != '0':
+            pruned = prune_short_streams(graph, cells, min_segment_length)[0]
+        results[threshold] = network_statistics(pruned.order_raster(), flow, cell_x, cell_y)
+    return [(t, results[_to_float(t)]) for t in thresholds]
@@ -0,0 +1,256 @@
+import argparse
+import sys
+import numpy as np
+import hydro_cache
+import local_io
+import numpy_hydrology as nh
+import order_report
+import profiling
+import raster_io
+import ridgeline_numpy
+import scratch_store
+import stream_network_numpy
+import watershed_thickness_numpy
+
+
+# Command line entry point for the three tools without the toolbox:
+#
+#   python streamscape.py streams DEM.tif rivers.gpkg --initiation-type CATCHMENT_AREA --threshold 1e6
+#   python streamscape.py ridgelines flow_dir.tif stream_orders.tif ridgelines.geojson
+#   python streamscape.py thickness DEM.tif streams.tif watersheds.gpkg
+#
+# With the default NUMPY backend rasters are read and written with local_io
+# (GeoTIFF or .npy) and vectors are GeoJSON, GeoPackage or GeoParquet, so a
+# run needs neither ArcGIS nor Windows. The ARCGIS backend passes the paths
+# to the toolbox functions (stream_network.CEI_extraction,
+# ordered_ridgelines.Watershed_extraction,
+# watershed_thickness_metrics.Basin_parameters); arcpy is only imported then.
+# Optional outputs that are not given are not written. With --tile-size the
+# NUMPY backend conditions the DEM (slope, fill, flow directions and
+# accumulation) tile by tile (tiled_hydrology) into the scratch directory of
+# the run. Only the conditioning is tiled: the DEM is read whole and the
+# later stages hold whole rasters, so the option lowers the peak of the
+# conditioning, not the memory a run needs.
+
+BACKENDS = ('NUMPY', 'ARCGIS')
+INITIATION_TYPES = ('CATCHMENT_AREA', 'SLOPE_POWER_INDEX', 'SHEAR_STRESS_INDEX',
+                    'CLIMATIC_RUNOFF', 'COMPLEX_ENERGY_INDEX', 'SHEAR_STRESS_ENERGY',
+                    'MEAN_EROSION_CUT', 'RESILIENCE', 'CEI_TO_MEAN_EROSION_CUT',
+                    'DRAINAGE_NETWORK_STRAHLER_ORDER')
+
+
+def _arcgis_parameter(value):
+    # Toolbox functions take '#' for parameters that are not set
+    if value is None or value is False:
+        return '#'
+    if value is True:
+        return 'true'
+    return str(value)
+
+
+def _save(path, array, info, nodata=None):
+    if path and array is not None:
+        local_io.write_raster(path, array, info, nodata)
+
+
+def streams(options):
+    if options.backend == 'ARCGIS':
+        import stream_network
+        return stream_network.CEI_extraction(*[_arcgis_parameter(value) for value in (
+            options.DEM, options.precipitation, options.evapotranspiration,
+            options.initiation_type, options.threshold, options.min_segment_length,
+            options.rivers_output, options.text_output, options.flow_dir, options.flow_acc,
+            options.initiation_raster, options.stream_links, options.stream_orders, options.watersheds,
+            'ARCGIS', options.cache_dir, options.iterative_pruning, False)])
+    DEM, info = local_io.read_raster(options.DEM, cell_size=options.cell_size)
+    precipitation = evapotranspiration = None
+    if options.precipitation:
+        precipitation = local_io.read_raster(options.precipitation, info)[0]
+    if options.evapotranspiration:
+        evapotranspiration = local_io.read_raster(options.evapotranspiration, info)[0]
+    with scratch_store.ScratchStore() as store:
+        results = stream_network_numpy.CEI_extraction(DEM,
+                                                      info.cell_x,
+                                                      info.cell_y,
+                                                      precipitation,
+                                                      evapotranspiration,
+                                                      options.initiation_type,
+                                                      options.threshold,
+                                                      options.min_segment_length,
+                                                      hydro_cache.open_cache(options.cache_dir),
+                                                      options.iterative_pruning,
+                                                      None,
+                                                      store,
+                                                      options.tile_size)
+        with profiling.stage('Writing rasters'):
+            _save(options.flow_dir, results['flow_directions'], info, nh.FLOW_DIR_NODATA)
+            _save(options.flow_acc, results['flow_accumulation'], info)
+            _save(options.initiation_raster, results['initiation_raster'], info)
+            _save(options.stream_links, results['stream_links'], info, 0)
+            _save(options.stream_orders, results['stream_orders'], info, 0)
+            _save(options.watersheds, results['watersheds'], info, 0)
+        with profiling.stage('Writing stream features'):
+            segments, table = stream_network_numpy.segment_table(results['stream_orders'],
+                                                                 results['flow_directions'],
+                                                                 info.cell_x, info.cell_y,
+                                                                 results['flow_drop'], DEM,
+                                                                 results['flow_accumulation_simple'])
+            lines = [np.column_stack(raster_io.cell_centres(rows, cols, info)).tolist()
+                     for _, rows, cols in segments]
+            local_io.write_features(options.rivers_output, 'LineString', lines,
+                                    [('strahler_order', table['order'])] +
+                                    [(name, table[key]) for key, name in stream_network_numpy.SEGMENT_FIELDS] +
+                                    [('catchment_area', table['catchment_area'])], info)
+    if options.text_output:
+        order_report.write_stream_statistics(options.text_output, table)
+
+
+def ridgelines(options):
+    if options.backend == 'ARCGIS':
+        import ordered_ridgelines
+        return ordered_ridgelines.Watershed_extraction(*[_arcgis_parameter(value) for value in (
+            options.flow_dir, options.rivers, options.ridgelines_output, options.text_output)])
+    codes, info = local_io.read_flow_directions(options.flow_dir, cell_size=options.cell_size)
+    rivers = local_io.read_raster(options.rivers, info)[0]
+    with profiling.stage('Extracting ridgelines'):
+        flow = nh.FlowGraph(codes)
+        stream_order = nh.stream_order(nh.as_mask(rivers), flow)
+        values = sorted(int(i) for i in np.unique(stream_order[stream_order > 0]))
+        lines, values = ridgeline_numpy.ridgelines(stream_order, flow, values)
+        masks = np.array([mask for mask, _, _ in lines], dtype=np.int64)
+        filosofov, full_sequence, highest_triplet = ridgeline_numpy.classify(masks, len(values))
+    with profiling.stage('Writing ridgelines'):
+        geometries = []
+        lengths = np.zeros(len(lines))
+        for n, (_, rows, cols) in enumerate(lines):
+            x, y = raster_io.corner_coordinates(rows, cols, info)
+            lengths[n] = np.hypot(np.diff(x), np.diff(y)).sum()
+            geometries.append(np.column_stack((x, y)).tolist())
+        # Undefined classes are null as in the toolbox output
+        local_io.write_features(options.ridgelines_output, 'LineString', geometries,
+                                [('watershed_order', [ridgeline_numpy.watershed_order(mask, values)
+                                                      for mask in masks]),
+                                 ('Filosofov_order', filosofov),
+                                 ('Full_sequence', [int(i) or None for i in full_sequence]),
+                                 ('Highest_triplet', [int(i) or None for i in highest_triplet])],
+                                info)
+    if options.text_output:
+        total_length = float(lengths.sum())
+        summary = order_report.ridgeline_summary(full_sequence, highest_triplet, lengths, values)
+        with open(options.text_output, 'w') as out:
+            order_report.write_ridgeline_statistics(out, total_length, len(lines), summary)
+        order_report.write_report(options.text_output, {'total_length': total_length, 'total_count': len(lines)},
+                                  summary)
+
+
+def thickness(options):
+    if options.backend == 'ARCGIS':
+        import watershed_thickness_metrics
+        return watershed_thickness_metrics.Basin_parameters(*[_arcgis_parameter(value) for value in (
+            options.DEM, options.streams, options.watersheds, options.flow_dir, options.watersheds_output,
+            options.mean_watershed_elevation, options.mean_erosion_cut, options.text_output,
+            options.cache_dir, options.divide_lines)])
+    DEM, info = local_io.read_raster(options.DEM, cell_size=options.cell_size)
+    streams = ~np.isnan(local_io.read_raster(options.streams, info)[0])
+    with profiling.stage('Preprocessing'):
+        cache = hydro_cache.open_cache(options.cache_dir)
+        if cache is not None:
+            products = hydro_cache.conditioned_dem(DEM, info.cell_x, info.cell_y, cache)
+            DEM_fill, flow_directions = products['DEM_fill'], products['flow_directions']
+        else:
+            DEM_fill, flow_directions = nh.condition(DEM, info.cell_x, info.cell_y)
+        if options.flow_dir:
+            flow_directions = local_io.read_flow_directions(options.flow_dir, info)[0]
+        if options.watersheds:
+            zones = local_io.read_raster(options.watersheds, info)[0]
+            zones = np.where(np.isnan(zones), 0, zones).astype(np.int64)
+        else:
+            flow = nh.FlowGraph(flow_directions)
+            zones = nh.watershed(flow, nh.stream_link(streams, flow))
+    with profiling.stage('Thickness metrics'):
+        columns, totals = watershed_thickness_numpy.thickness_metrics(DEM, zones, streams, info.cell_area,
+                                                                      divide_lines=options.divide_lines)
+        mean_watershed_elevation, mean_erosion_cut = watershed_thickness_numpy.erosion_cut(DEM_fill,
+                                                                                            flow_directions)
+    with profiling.stage('Writing outputs'):
+        _save(options.mean_watershed_elevation, mean_watershed_elevation, info)
+        _save(options.mean_erosion_cut, mean_erosion_cut, info)
+        if local_io.is_raster(options.watersheds_output):
+            local_io.write_raster(options.watersheds_output, zones, info, 0)
+        else:
+            polygons = local_io.zone_polygons(zones, info)
+            zone_ids = np.array([zone for _, zone in polygons], dtype=np.int64)
+            fields = [('zone', zone_ids)]
+            for dH_field, V_field in watershed_thickness_numpy.VOLUME_FIELDS:
+                fields += [(dH_field, columns[dH_field][zone_ids]), (V_field, columns[V_field][zone_ids])]
+            local_io.write_features(options.watersheds_output, 'Polygon', [rings for rings, _ in polygons],
+                                    fields, info)
+    if options.text_output:
+        with open(options.text_output, 'w') as out:
+            watershed_thickness_numpy.write_statistics(out, totals, float(np.nanmax(mean_erosion_cut)))
+
+
+def parser():
+    main = argparse.ArgumentParser(prog='streamscape', description='Stream network structure analysis')
+    main.add_argument('--backend', choices=BACKENDS, default='NUMPY')
+    main.add_argument('--cell-size', type=float, default=1.0,
+                      help='cell size of .npy rasters without a georeference sidecar')
+    commands = main.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser('streams', help='stream network and its Strahler orders')
+    command.add_argument('DEM')
+    command.add_argument('rivers_output')
+    command.add_argument('--initiation-type', choices=INITIATION_TYPES, default='CATCHMENT_AREA')
+    command.add_argument('--threshold', required=True)
+    command.add_argument('--precipitation')
+    command.add_argument('--evapotranspiration')
+    command.add_argument('--min-segment-length', help='in cells')
+    command.add_argument('--iterative-pruning', action='store_true')
+    command.add_argument('--text-output')
+    command.add_argument('--flow-dir')
+    command.add_argument('--flow-acc')
+    command.add_argument('--initiation-raster')
+    command.add_argument('--stream-links')
+    command.add_argument('--stream-orders')
+    command.add_argument('--watersheds')
+    command.add_argument('--cache-dir')
+    command.add_argument('--tile-size', type=int,
+                         help='run the DEM conditioning (slope, fill, flow directions and accumulation) '
+                              'in tiles of this many cells a side; the later stages still use whole rasters '
+                              '(NUMPY backend), default: STREAMSCAPE_TILE_SIZE or the whole raster')
+    command.set_defaults(run=streams)
+
+    command = commands.add_parser('ridgelines', help='ordered ridgelines of a stream network')
+    command.add_argument('flow_dir')
+    command.add_argument('rivers', help='stream raster, NoData outside the streams')
+    command.add_argument('ridgelines_output')
+    command.add_argument('--text-output')
+    command.set_defaults(run=ridgelines)
+
+    command = commands.add_parser('thickness', help='watershed thickness metrics')
+    command.add_argument('DEM')
+    command.add_argument('streams', help='stream raster, NoData outside the streams')
+    command.add_argument('watersheds_output', help='polygons, or a zone raster for a raster extension')
+    command.add_argument('--watersheds', help='watershed zone raster (feature class with the ARCGIS backend), '
+                                              'default: watersheds of the stream links')
+    command.add_argument('--flow-dir')
+    command.add_argument('--mean-watershed-elevation')
+    command.add_argument('--mean-erosion-cut')
+    command.add_argument('--text-output')
+    command.add_argument('--divide-lines', choices=('BUFFER', 'RASTER_4', 'RASTER_8'), default='BUFFER',
+                         help='BUFFER is the inner buffer of the watershed polygons with the ARCGIS backend '
+                              'and the RASTER_8 ring with the NUMPY backend')
+    command.add_argument('--cache-dir')
+    command.set_defaults(run=thickness)
+    return main
+
+
+def main(argv=None):
+    options = parser().parse_args(argv)
+    with profiling.session('streamscape_' + options.command):
+        options.run(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+import os
+import numpy as np
+import numpy_hydrology as nh
+
+
+# Out-of-core Slope, Fill, FlowDirection and FlowAccumulation for rasters
+# that do not fit in memory. Inputs and outputs are 2D array-likes, normally
+# np.memmap arrays of .npy files (see open_raster / create_raster), and only
+# one tile (plus a one cell halo) is held in memory at a time. Flow across
+# tile edges is resolved on small boundary graphs, so the results match the
+# whole-raster functions of numpy_hydrology: slope, fill and flow directions
+# cell for cell, flow accumulation up to floating point summation order
+# (exactly for the unweighted accumulation). Besides the tiles, fill keeps
+# its basin spill graph in memory, which grows with the number of pits
+# rather than with the raster size.
+#
+# The NumPy backend conditions the DEM tile by tile when a tile size is
+# given (stream_network_numpy.condition_dem, --tile-size of streamscape.py)
+# or set in the STREAMSCAPE_TILE_SIZE environment variable. Only the
+# conditioning is out of core: the stages after it (initiation, stream
+# network, watersheds) read the conditioned rasters whole.
+
+DEFAULT_TILE_SIZE = 2048
+
+
+def default_tile_size():
+    # Tile size from the environment, None (whole raster) if it is not set
+    value = os.environ.get('STREAMSCAPE_TILE_SIZE')
+    return int(value) if value else None
+
+
+def open_raster(path, mode='r'):
+    # Memory-mapped .npy raster
+    return np.load(path, mmap_mode=mode)
+
+
+def create_raster(path, shape, dtype):
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def _tiles(shape, tile_size):
+    rows, cols = shape
+    for r0 in range(0, rows, tile_size):
+        for c0 in range(0, cols, tile_size):
+            yield r0, min(r0 + tile_size, rows), c0, min(c0 + tile_size, cols)
+
+
+def _window(array, r0, r1, c0, c1, fill_value, dtype=None):
+    # Tile with a one cell halo; cells outside the raster get fill_value
+    rows, cols = array.shape
+    out = np.empty((r1 - r0 + 2, c1 - c0 + 2), dtype=dtype or array.dtype)
+    out[...] = fill_value
+    rr0, rr1 = max(r0 - 1, 0), min(r1 + 1, rows)
+    cc0, cc1 = max(c0 - 1, 0), min(c1 + 1, cols)
+    out[rr0 - r0 + 1:rr1 - r0 + 1, cc0 - c0 + 1:cc1 - c0 + 1] = array[rr0:rr1, cc0:cc1]
+    return out
+
+
+def _global_index(window_index, r0, c0, window_cols, cols):
+    # Raster-wide flat index of window cells (window origin at r0 - 1, c0 - 1)
+    r = window_index // window_cols + r0 - 1
+    c = window_index % window_cols + c0 - 1
+    return r.astype(np.int64) * cols + c
+
+
+def _interior(window_shape):
+    inside = np.zeros(window_shape, dtype=bool)
+    inside[1:-1, 1:-1] = True
+    return inside.ravel()
+
+
+def _local_graph(codes_window):
+    # Receivers of the tile cells restricted to the tile and the window index
+    # of the receiver for cells whose flow leaves the tile (-1 otherwise)
+    rcv = nh.receivers(codes_window)
+    interior = _interior(codes_window.shape)
+    leaving = (rcv >= 0) & ~interior[np.where(rcv >= 0, rcv, 0)] & interior
+    exits = np.where(leaving, rcv, -1)
+    rcv = np.where(leaving | ~interior, -1, rcv)
+    return rcv, exits, interior
+
+
+def _terminals(rcv):
+    # Last cell of the local flow path of every cell
+    terminal = np.arange(rcv.size)
+    for level in reversed(nh._flow_levels(rcv)):
+        downstream = rcv[level]
+        sel = downstream >= 0
+        terminal[level[sel]] = terminal[downstream[sel]]
+    return terminal
+
+
+def _resolve_chains(ids, targets):
+    # Follow id -> target links (by pointer jumping) until the target is not
+    # an id itself
+    order = np.argsort(ids)
+    ids, targets = ids[order], targets[order]
+    final = targets.copy()
+    while ids.size:
+        position = np.searchsorted(ids, final)
+        position = np.minimum(position, ids.size - 1)
+        chained = ids[position] == final
+        if not chained.any():
+            break
+        final[chained] = final[position[chained]]
+    return ids, final
+
+
+def _map_through(values, ids, final):
+    # Replace values found in ids by the matching final value
+    if not ids.size:
+        return values
+    position = np.minimum(np.searchsorted(ids, values), ids.size - 1)
+    return np.where(ids[position] == values, final[position], values)
+
+
+def slope(DEM, out, tile_size=DEFAULT_TILE_SIZE, cell_x=1.0, cell_y=1.0):
+    # Tiled version of numpy_hydrology.slope; off-grid halo cells are NoData,
+    # which slope replaces by the centre cell as it does on the whole raster
+    for r0, r1, c0, c1 in _tiles(DEM.shape, tile_size):
+        z = _window(DEM, r0, r1, c0, c1, np.nan, np.float64)
+        out[r0:r1, c0:c1] = nh.slope(z, cell_x, cell_y)[1:-1, 1:-1]
+    return out
+
+
+def fill(DEM, out, tile_size=DEFAULT_TILE_SIZE, cell_x=1.0, cell_y=1.0, scratch_dir=None):
+    # Tiled version of numpy_hydrology.fill. Cells are labelled with the
+    # local end of their steepest descent path; paths leaving a tile are
+    # chained across tiles into raster-wide basins, whose spill graph is
+    # flooded in memory. The basin labels are kept in a scratch memmap
+    shape = DEM.shape
+    cols = shape[1]
+    scratch_dir = scratch_dir or os.path.dirname(os.path.abspath(getattr(out, 'filename', None) or '.'))
+    labels_path = os.path.join(scratch_dir, '_fill_labels.npy')
+    labels = create_raster(labels_path, shape, np.int64)
+
+    # Pass 1: local basins and links between tiles
+    sinks, exit_ids, exit_targets = [], [], []
+    for r0, r1, c0, c1 in _tiles(shape, tile_size):
+        z = _window(DEM, r0, r1, c0, c1, np.nan, np.float64)
+        codes, edge_dir = nh._steepest_descent(z, cell_x, cell_y)
+        rcv, exits, interior = _local_graph(codes)
+        terminal = _terminals(rcv)
+        window_cols = z.shape[1]
+        valid = interior & ~np.isnan(z.ravel())
+        leaving = np.flatnonzero(exits >= 0)
+        sinks.append(_global_index(np.flatnonzero(valid & (rcv == -1) & (exits == -1)), r0, c0, window_cols, cols))
+        exit_ids.append(_global_index(leaving, r0, c0, window_cols, cols))
+        exit_targets.append(_global_index(exits[leaving], r0, c0, window_cols, cols))
+        tile_labels = _global_index(terminal, r0, c0, window_cols, cols).reshape(z.shape)
+        labels[r0:r1, c0:c1] = tile_labels[1:-1, 1:-1]
+    sinks = np.unique(np.concatenate(sinks))
+    exit_ids = np.concatenate(exit_ids)
+    exit_targets = np.concatenate(exit_targets)
+    # An exit leads to the local terminal of its target cell
+    exit_ids, exit_final = _resolve_chains(exit_ids, labels.ravel()[exit_targets])
+    n_basins = sinks.size + 1
+
+    def basins_of(window_labels):
+        # Compact basin number (1..) of raster-wide terminal labels
+        if not sinks.size:
+            return np.zeros(window_labels.shape, dtype=np.int64)
+        sink = _map_through(window_labels, exit_ids, exit_final)
+        position = np.minimum(np.searchsorted(sinks, sink), sinks.size - 1)
+        return np.where((window_labels >= 0) & (sinks[position] == sink), position + 1, 0)
+
+    # Pass 2: spill heights between basins
+    keys, heights = [], []
+    for r0, r1, c0, c1 in _tiles(shape, tile_size):
+        z = _window(DEM, r0, r1, c0, c1, np.nan, np.float64)
+        basins = basins_of(_window(labels, r0, r1, c0, c1, -1).ravel())
+        edge_dir = nh._steepest_descent(z, cell_x, cell_y)[1].ravel()
+        flat_z = z.ravel()
+        interior = _interior(z.shape)
+        index = np.flatnonzero(interior & ~np.isnan(flat_z))
+        tile_keys, tile_heights = [], []
+        for k in range(4):
+            nb, inside = nh._neighbour(index, k, z.shape)
+            a, b = index[inside], nb[inside]
+            sel = ~np.isnan(flat_z[b]) & (basins[a] != basins[b])
+            a, b = a[sel], b[sel]
+            tile_keys.append(nh._spill_keys(basins[a], basins[b], n_basins))
+            tile_heights.append(np.maximum(flat_z[a], flat_z[b]))
+        edge = np.flatnonzero(interior & (edge_dir > 0))
+        tile_keys.append(basins[edge].astype(np.int64))
+        tile_heights.append(flat_z[edge])
+        tile_keys, tile_heights = nh._lowest_spills(np.concatenate(tile_keys), np.concatenate(tile_heights))
+        keys.append(tile_keys)
+        heights.append(tile_heights)
+    keys, heights = nh._lowest_spills(np.concatenate(keys), np.concatenate(heights))
+    level = nh._flood_basins(keys, heights, n_basins)
+
+    # Pass 3: raise every basin to its outlet level
+    for r0, r1, c0, c1 in _tiles(shape, tile_size):
+        z = np.asarray(DEM[r0:r1, c0:c1], dtype=np.float64)
+        basins = basins_of(np.asarray(labels[r0:r1, c0:c1]))
+        out[r0:r1, c0:c1] = np.where(np.isnan(z), np.nan, np.maximum(z, level[basins]))
+    del labels
+    os.remove(labels_path)
+    return out
+
+
+def flow_direction(DEM_fill, out, tile_size=DEFAULT_TILE_SIZE, cell_x=1.0, cell_y=1.0, scratch_dir=None):
+    # Tiled version of numpy_hydrology.flow_direction. Flat distances are
+    # relaxed tile by tile until no tile changes, which gives the same
+    # breadth-first distances as a whole-raster run
+    shape = DEM_fill.shape
+    scratch_dir = scratch_dir or os.path.dirname(os.path.abspath(getattr(out, 'filename', None) or '.'))
+    distance_path = os.path.join(scratch_dir, '_flat_distance.npy')
+    distance = create_raster(distance_path, shape, np.int32)
+
+    # Steepest descent and edge cells
+    has_flats = False
+    for r0, r1, c0, c1 in _tiles(shape, tile_size):
+        z = _window(DEM_fill, r0, r1, c0, c1, np.nan, np.float64)
+        codes, edge_dir = nh._steepest_descent(z, cell_x, cell_y)
+        outward = (codes == 0) & (edge_dir > 0)
+        codes[outward] = edge_dir[outward]
+        codes = codes[1:-1, 1:-1]
+        out[r0:r1, c0:c1] = codes
+        distance[r0:r1, c0:c1] = nh._flat_seeds(codes)
+        has_flats = has_flats or (codes == 0).any()
+
+    # Flat distances across tiles
+    changed = has_flats
+    while changed:
+        changed = False
+        for r0, r1, c0, c1 in _tiles(shape, tile_size):
+            codes = _window(out, r0, r1, c0, c1, nh.FLOW_DIR_NODATA)
+            if not (codes[1:-1, 1:-1] == 0).any():
+                continue
+            z = _window(DEM_fill, r0, r1, c0, c1, np.nan, np.float64)
+            window_distance = _window(distance, r0, r1, c0, c1, -2)
+            before = window_distance[1:-1, 1:-1].copy()
+            nh._flat_distances(z, codes, window_distance)
+            if (window_distance[1:-1, 1:-1] != before).any():
+                distance[r0:r1, c0:c1] = window_distance[1:-1, 1:-1]
+                changed = True
+
+    # Drain flats
+    if has_flats:
+        for r0, r1, c0, c1 in _tiles(shape, tile_size):
+            codes = _window(out, r0, r1, c0, c1, nh.FLOW_DIR_NODATA)
+            if not (codes[1:-1, 1:-1] == 0).any():
+                continue
+            z = _window(DEM_fill, r0, r1, c0, c1, np.nan, np.float64)
+            nh._drain_flats(z, codes, _window(distance, r0, r1, c0, c1, -2))
+            out[r0:r1, c0:c1] = codes[1:-1, 1:-1]
+    del distance
+    os.remove(distance_path)
+    return out
+
+
+def flow_accumulation(flow_dir, out, tile_size=DEFAULT_TILE_SIZE, weights=None):
+    # Tiled version of numpy_hydrology.flow_accumulation. Pass 1 accumulates
+    # every tile on its own and records, for each cell where flow leaves a
+    # tile, the outflow and the exit reached next downstream. Accumulating
+    # that exit graph gives the inflow into every tile, which pass 2 adds
+    # while accumulating each tile again
+    shape = flow_dir.shape
+    cols = shape[1]
+
+    def tile_graph(r0, r1, c0, c1):
+        codes = _window(flow_dir, r0, r1, c0, c1, nh.FLOW_DIR_NODATA)
+        rcv, exits, interior = _local_graph(codes)
+        stack = np.zeros((rcv.size, 1))
+        if weights is None:
+            stack[interior, 0] = 1.0
+        else:
+            window_weights = _window(weights, r0, r1, c0, c1, 0.0, np.float64).ravel()
+            stack[interior, 0] = np.nan_to_num(window_weights[interior])
+        stack[codes.ravel() == nh.FLOW_DIR_NODATA] = 0.0
+        return codes, rcv, exits, stack
+
+    # Pass 1: outflow of every exit and the next exit downstream of its target
+    exit_ids, exit_targets, exit_outflow = [], [], []
+    perimeter_ids, perimeter_exit = [], []
+    for r0, r1, c0, c1 in _tiles(shape, tile_size):
+        codes, rcv, exits, stack = tile_graph(r0, r1, c0, c1)
+        window_cols = codes.shape[1]
+        acc = nh._accumulate(rcv, stack)[:, 0] + stack[:, 0]
+        leaving = np.flatnonzero(exits >= 0)
+        exit_ids.append(_global_index(leaving, r0, c0, window_cols, cols))
+        exit_targets.append(_global_index(exits[leaving], r0, c0, window_cols, cols))
+        exit_outflow.append(acc[leaving])
+        # Where flow entering the tile at a perimeter cell leaves it again
+        terminal = _terminals(rcv)
+        ring = np.zeros(codes.shape, dtype=bool)
+        ring[1:-1, 1:-1] = True
+        ring[2:-2, 2:-2] = False
+        ring = np.flatnonzero(ring.ravel())
+        leaves = exits[terminal[ring]] >= 0
+        perimeter_ids.append(_global_index(ring, r0, c0, window_cols, cols))
+        perimeter_exit.append(np.where(leaves, _global_index(terminal[ring], r0, c0, window_cols, cols), -1))
+    exit_ids = np.concatenate(exit_ids)
+    exit_targets = np.concatenate(exit_targets)
+    exit_outflow = np.concatenate(exit_outflow)
+    perimeter_ids = np.concatenate(perimeter_ids)
+    perimeter_exit = np.concatenate(perimeter_exit)
+
+    # Exit graph: exit -> target cell -> next exit of the target's tile
+    order = np.argsort(perimeter_ids)
+    perimeter_ids, perimeter_exit = perimeter_ids[order], perimeter_exit[order]
+    next_exit = perimeter_exit[np.searchsorted(perimeter_ids, exit_targets)]
+    order = np.argsort(exit_ids)
+    exit_ids, exit_targets = exit_ids[order], exit_targets[order]
+    exit_outflow, next_exit = exit_outflow[order], next_exit[order]
+    exit_rcv = np.where(next_exit >= 0, np.searchsorted(exit_ids, next_exit), -1)
+    through = nh._accumulate(exit_rcv, exit_outflow[:, None])[:, 0] + exit_outflow
+    # Inflow of every cell that receives flow from another tile
+    inflow_ids, inverse = np.unique(exit_targets, return_inverse=True)
+    inflow = np.bincount(inverse, weights=through)
+
+    # Pass 2: accumulate every tile with the inflow injected at entry cells
+    for r0, r1, c0, c1 in _tiles(shape, tile_size):
+        codes, rcv, exits, stack = tile_graph(r0, r1, c0, c1)
+        window_cols = codes.shape[1]
+        interior = np.flatnonzero(_interior(codes.shape))
+        ids = _global_index(interior, r0, c0, window_cols, cols)
+        position = np.minimum(np.searchsorted(inflow_ids, ids), max(inflow_ids.size - 1, 0))
+        entering = inflow_ids[position] == ids if inflow_ids.size else np.zeros(ids.size, dtype=bool)
+        injected = np.zeros(rcv.size)
+        injected[interior[entering]] = inflow[position[entering]]
+        stack = np.column_stack([stack[:, 0], injected])
+        acc = nh._accumulate(rcv, stack)
+        acc = acc[:, 0] + acc[:, 1] + injected
+        acc[codes.ravel() == nh.FLOW_DIR_NODATA] = np.nan
+        out[r0:r1, c0:c1] = acc.reshape(codes.shape)[1:-1, 1:-1]
+    return out
+
+
+def condition_dem(DEM, directory, tile_size=DEFAULT_TILE_SIZE, cell_x=1.0, cell_y=1.0):
+    # Slope (percent), filled DEM, flow directions and flow accumulation as
+    # .npy memmaps in directory; peak memory is bounded by the tile size and
+    # the spill graph of fill
+    shape = DEM.shape
+    slope_percent = create_raster(os.path.join(directory, 'slope_percent.npy'), shape, np.float64)
+    slope(DEM, slope_percent, tile_size, cell_x, cell_y)
+    DEM_fill = create_raster(os.path.join(directory, 'DEM_fill.npy'), shape, np.float64)
+    fill(DEM, DEM_fill, tile_size, cell_x, cell_y, directory)
+    flow_directions = create_raster(os.path.join(directory, 'flow_directions.npy'), shape, np.uint8)
+    flow_direction(DEM_fill, flow_directions, tile_size, cell_x, cell_y, directory)
+    flow_accumulation_raw = create_raster(os.path.join(directory, 'flow_accumulation.npy'), shape, np.float64)
+    flow_accumulation(flow_directions, flow_accumulation_raw, tile_size)
+    return slope_percent, DEM_fill, flow_directions, flow_accumulation_raw
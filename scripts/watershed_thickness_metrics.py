@@ -1,9 +1,32 @@
 import math
 import arcpy
+import numpy as np
+import attribute_io
+import hydro_cache
+import numpy_hydrology
+import profiling
+import raster_io
+import watershed_thickness_numpy
+import zonal_statistics
 from arcpy import env
 from arcpy.sa import *
 
 
+def rasterize_polygons(features, out_raster, DEM):
+    # Polygons to a raster of their OBJECTID on the DEM grid. The snap raster
+    # and extent are set for the conversion only, later tools of the session
+    # keep their own
+    snap_raster, extent = arcpy.env.snapRaster, arcpy.env.extent
+    arcpy.env.snapRaster = DEM
+    arcpy.env.extent = DEM
+    try:
+        arcpy.PolygonToRaster_conversion(features, 'OBJECTID', out_raster, "CELL_CENTER", "", DEM)
+    finally:
+        arcpy.env.snapRaster = snap_raster
+        arcpy.env.extent = extent
+
+
+@profiling.profiled('watershed_thickness_metrics')
 def Basin_parameters(DEM,
                      streams,
                      watersheds,
@@ -11,7 +34,9 @@ def Basin_parameters(DEM,
                      watersheds_output,
                      mean_watershed_elevation,
                      mean_erosion_cut,
-                     text_output):
+                     text_output,
+                     cache_dir=None,
+                     divide_lines='BUFFER'):
     
     # # Prepare environments
     arcpy.env.overwriteOutput = True
@@ -20,17 +45,32 @@ def Basin_parameters(DEM,
     cell_area = cell_x * cell_y  # cell area in sq. m
     
     # Preprocessing
+    steps = profiling.steps()
+    steps.next('Preprocessing')
     arcpy.AddMessage('Preprocessing...')
-    # Fill in sinks (required for analysis)
-    DEM_fill = Fill(DEM)
-    # Calculate flow directions (if not in input)
-    if not (flow_directions and flow_directions != "#"):
-        flow_directions = FlowDirection(DEM_fill, "NORMAL", 'flowdir')
-    # Calculate flow accumulation
-    flow_accumulation_raw = FlowAccumulation(flow_directions)
+    # Optional cache of hydro-conditioned DEM products (see hydro_cache)
+    cache = hydro_cache.open_cache(cache_dir)
+    if cache is not None:
+        products, info = hydro_cache.conditioned_rasters(DEM, cache)
+        DEM_fill = raster_io.to_raster(products['DEM_fill'], info)
+        # Cached accumulation is only valid for the cached flow directions
+        if not (flow_directions and flow_directions != "#"):
+            flow_directions = raster_io.to_raster(products['flow_directions'], info, numpy_hydrology.FLOW_DIR_NODATA)
+            flow_accumulation_raw = raster_io.to_raster(products['flow_accumulation'], info)
+        else:
+            flow_accumulation_raw = FlowAccumulation(flow_directions)
+    else:
+        # Fill in sinks (required for analysis)
+        DEM_fill = Fill(DEM)
+        # Calculate flow directions (if not in input)
+        if not (flow_directions and flow_directions != "#"):
+            flow_directions = FlowDirection(DEM_fill, "NORMAL", 'flowdir')
+        # Calculate flow accumulation
+        flow_accumulation_raw = FlowAccumulation(flow_directions)
     flow_accumulation = flow_accumulation_raw + 1.0
     # flow_accumulation.save('flow_accumulation')
     # Check if watersheds are given as input data
+    steps.next('Watersheds')
     if watersheds and watersheds != '#':  # if yes, create a copy of input data
         arcpy.Copy_management(watersheds, watersheds_output)  # Note that 'watersheds' are feature class, not feature layer
     else:  # if not, delineate them
@@ -46,96 +86,70 @@ def Basin_parameters(DEM,
         arcpy.AddField_management(watersheds_output, 'Shape_Area', "DOUBLE")
         arcpy.CalculateField_management(watersheds_output, 'Shape_Area', '!shape.area!', 'PYTHON_9.3')
     
-    # calculate sum of shape_area:
-    sum_area = 0
-    with arcpy.da.SearchCursor(watersheds_output, "Shape_Area") as cursor:
-        for row in cursor:
-            sum_area = sum_area + row[0]
+    # Watershed IDs and areas as whole columns
+    steps.next('Zonal statistics')
+    columns = attribute_io.read_columns(watersheds_output, ['OBJECTID', 'Shape_Area'])
+    object_ids, area = columns['OBJECTID'], columns['Shape_Area']
+    sum_area = float(area.sum())
 
-    # Perform zonal statistics as table
-    ZonalStatisticsAsTable(watersheds_output, 'OBJECTID', DEM, 'stat_table_watersheds')
-    # Join table with layer 'watersheds_output'
-    arcpy.MakeFeatureLayer_management(watersheds_output, 'watersheds_layer')
-    arcpy.AddJoin_management('watersheds_layer', "OBJECTID", 'stat_table_watersheds', "OBJECTID")
-    # arcpy.RemoveJoin_management("watersheds_layer", "stat_table_watersheds")
-    
-    # Processings
+    # Rasterize watersheds on the DEM grid; OBJECTID is the zone value
+    rasterize_polygons(watersheds_output, 'watershed_zones', DEM)
+    DEM_values, info = raster_io.read_raster(DEM)
+    zones = raster_io.read_raster('watershed_zones', info)[0]
+    n_zones = int(object_ids.max()) + 1 if object_ids.size else 1
+    # Zonal statistics of the DEM and of stream elevations in one pass
+    streams_mask = ~np.isnan(raster_io.read_raster(streams, info)[0])
+    DEM_streams = np.where(streams_mask, DEM_values, np.nan)
+    stat_watersheds, stat_streams = zonal_statistics.zonal_statistics(zones, [DEM_values, DEM_streams], n_zones)
 
-    # 1: Extrema thickness
-    arcpy.AddMessage('1: Extrema thickness...')
-    # Assign elevation range to the new field
-    arcpy.AddField_management(watersheds_output, "deltaH_extr", "DOUBLE")
-    expression = '!stat_table_watersheds.range!'
-    arcpy.CalculateField_management('watersheds_layer', "deltaH_extr", expression, "PYTHON_9.3")
-    # Compute 'extrema volume'
-    arcpy.AddField_management(watersheds_output, "V_extr", "DOUBLE")
-    expression = '!stat_table_watersheds.range! * !%s.Shape_Area!' % (watersheds_output.split('\\')[-1])
-    arcpy.CalculateField_management('watersheds_layer', "V_extr", expression, "PYTHON_9.3")
-    # Calculate final 'extrema thickness'
-    sum_volume_extr = 0
-    with arcpy.da.SearchCursor(watersheds_output, "V_extr") as cursor:
-        for row in cursor:
-            sum_volume_extr = sum_volume_extr + row[0]
-    dH_extr = sum_volume_extr / sum_area
-    # arcpy.AddMessage('dH_extr is: ' + str(dH_extr))  # DEBUG
+    # Watershed lines
+    steps.next('Watershed lines')
+    # BUFFER (default) erases an inner buffer from the polygons; RASTER_4 and
+    # RASTER_8 are opt-in through the divide_lines tool parameter
+    if not divide_lines or divide_lines == '#':
+        divide_lines = 'BUFFER'
+    if divide_lines == 'BUFFER':
+        # Inner buffer of one cell diagonal
+        buffer_distance = math.sqrt(cell_x**2 + cell_y**2) * (-1)
+        arcpy.Buffer_analysis(watersheds_output, 'watersheds_buffer', buffer_distance)
+        # Erase watershed polygons with buffer
+        arcpy.Erase_analysis(watersheds_output, 'watersheds_buffer', 'watersheds_mask')
+        rasterize_polygons('watersheds_mask', 'watershed_line_zones', DEM)
+        line_zones = raster_io.read_raster('watershed_line_zones', info)[0]
+    else:
+        # Cells with a neighbour in another watershed ('RASTER_4' or 'RASTER_8')
+        connectivity = 4 if divide_lines == 'RASTER_4' else 8
+        line_zones = zonal_statistics.zone_boundaries(zones, connectivity)
+    stat_lines = zonal_statistics.zonal_statistics(line_zones, [DEM_values], n_zones)[0]
 
-    # 2: mean thickness
-    arcpy.AddMessage('2: Mean thickness...')
-    # Extract stream elevations
-    DEM_streams = ExtractByMask(DEM, streams)
-    # Calculate zonal statistics for stream elevations
-    ZonalStatisticsAsTable(watersheds_output, 'OBJECTID', DEM_streams, 'stat_table_streams')
-    # Join calculated statistics to watersheds layer
-    arcpy.AddJoin_management('watersheds_layer', "OBJECTID", 'stat_table_streams', "OBJECTID_1")
-    # Compute 'mean elevation difference'
-    arcpy.AddField_management(watersheds_output, 'deltaH_mean', 'Double')
-    expression = '!stat_table_watersheds.mean! - !stat_table_streams.mean!'
-    arcpy.CalculateField_management('watersheds_layer', "deltaH_mean", expression, "PYTHON_9.3")
-    # Compute 'mean elevation volume'
-    arcpy.AddField_management(watersheds_output, 'V_mean', 'Double')
-    expression = '!deltaH_mean! * !%s.Shape_Area!' % (watersheds_output.split('\\')[-1])
-    arcpy.CalculateField_management('watersheds_layer', "V_mean", expression, "PYTHON_9.3")
-    # Calculate final 'mean thickness'
-    sum_volume_mean = 0
-    with arcpy.da.SearchCursor(watersheds_output, "V_mean") as cursor:
-        for row in cursor:
-            if row[0] is None:
-                continue
-            sum_volume_mean = sum_volume_mean + row[0]
+    # Processings
+    # 1: Extrema thickness: elevation range
+    # 2: Mean thickness: mean elevation above the mean stream elevation
+    # 3: Watershed thickness: mean elevation of watershed lines above the
+    #    mean stream elevation
+    steps.next('Thickness metrics')
+    arcpy.AddMessage('Thickness metrics...')
+    deltaH = {'deltaH_extr': stat_watersheds['range'],
+              'deltaH_mean': stat_watersheds['mean'] - stat_streams['mean'],
+              'deltaH_watershed': stat_lines['mean'] - stat_streams['mean']}
+    volume_fields = (('deltaH_extr', 'V_extr'), ('deltaH_mean', 'V_mean'), ('deltaH_watershed', 'V_watershed'))
+    columns = []
+    sum_volume = {}
+    for dH_field, V_field in volume_fields:
+        dH = deltaH[dH_field][object_ids]  # NaN where a watershed has no statistics
+        volume = dH * area
+        columns += [(dH_field, dH), (V_field, volume)]
+        sum_volume[V_field] = float(np.nansum(volume))
+    attribute_io.write_columns(watersheds_output, object_ids, columns)
+    sum_volume_extr = sum_volume['V_extr']
+    sum_volume_mean = sum_volume['V_mean']
+    sum_volume_watershed = sum_volume['V_watershed']
+    dH_extr = sum_volume_extr / sum_area
     dH_mean = sum_volume_mean / sum_area
-    # arcpy.AddMessage('dH_mean is: ' + str(dH_mean))  # DEBUG
-
-    # 3: watershed thickness
-    arcpy.AddMessage('3: watershed thickness...')
-    # Extract watersheds
-    # Create inner buffer from watersheds
-    buffer_distance = math.sqrt(cell_x**2 + cell_y**2) * (-1)
-    arcpy.Buffer_analysis(watersheds_output, 'watersheds_buffer', buffer_distance)
-    # Erase watershed polygons with buffer
-    arcpy.Erase_analysis(watersheds_output, 'watersheds_buffer', 'watersheds_mask')
-    # Calculate zonal statistics for watershed lines
-    ZonalStatisticsAsTable('watersheds_mask', 'OBJECTID', DEM, 'stat_table_watershed_lines')
-    # Join zonal statistics with output watersheds
-    arcpy.AddJoin_management('watersheds_layer', "OBJECTID", 'stat_table_watershed_lines', "OBJECTID")
-    # Compute 'watershed elevation difference'
-    arcpy.AddField_management(watersheds_output, 'deltaH_watershed', 'Double')
-    expression = '!stat_table_watershed_lines.mean! - !stat_table_streams.mean!'
-    arcpy.CalculateField_management('watersheds_layer', "deltaH_watershed", expression, "PYTHON_9.3")
-    # Compute 'watershed elevation volume'
-    arcpy.AddField_management(watersheds_output, 'V_watershed', 'Double')
-    expression = '!deltaH_watershed! * !%s.Shape_Area!' % (watersheds_output.split('\\')[-1])
-    arcpy.CalculateField_management('watersheds_layer', "V_watershed", expression, "PYTHON_9.3")
-    # Calculate watershed 'watershed thickness'
-    sum_volume_watershed = 0
-    with arcpy.da.SearchCursor(watersheds_output, "V_watershed") as cursor:
-        for row in cursor:
-            if row[0] is None:
-                continue
-            sum_volume_watershed = sum_volume_watershed + row[0]
     dH_watershed = sum_volume_watershed / sum_area
-    # arcpy.AddMessage('dH_watershed is: ' + str(dH_watershed))  # DEBUG
 
     # Mean elevation, mean erosion cut
+    steps.next('Continual parameters')
     arcpy.AddMessage('4: continual parameters...')
     sum_elevation_downstream_raw = FlowAccumulation(flow_directions, DEM_fill)
     sum_elevation_downstream = sum_elevation_downstream_raw + DEM_fill
@@ -149,22 +163,18 @@ def Basin_parameters(DEM,
     # TODO: сделать вывод: величина вреза в замыкающем створе (сложно!)
     
     # Saving stats
+    steps.next('Save statistics to the text file')
     arcpy.AddMessage('Save statistics to the text file')
+    totals = dict(sum_volume, dH_extr=dH_extr, dH_mean=dH_mean, dH_watershed=dH_watershed)
     with open(text_output, 'w') as out:
-        out.write('Total volume by extrema: ' + str(sum_volume_extr) + ' m^3\n')
-        out.write('dH by extrema: ' + str(dH_extr) + ' m\n')
-        out.write('Total volume by mean: ' + str(sum_volume_mean) + ' m^3\n')
-        out.write('dH by mean: ' + str(dH_mean) + ' m\n')
-        out.write('Total volume by watershed lines: ' + str(sum_volume_watershed) + ' m^3\n')
-        out.write('dH by watershed lines: ' + str(dH_watershed) + ' m\n')
-        out.write('Max erosion cut value: ' + str(max_erosion_cut_value) + ' m')
+        watershed_thickness_numpy.write_statistics(out, totals, max_erosion_cut_value)
 
     # Delete intermediate data
+    steps.next('Delete intermediate data')
     if arcpy.Exists('flowdir'): arcpy.Delete_management('flowdir')
     if arcpy.Exists('flow_accumulation'): arcpy.Delete_management('flow_accumulation')
-    if arcpy.Exists('stat_table_streams'): arcpy.Delete_management('stat_table_streams')
-    if arcpy.Exists('stat_table_watershed_lines'): arcpy.Delete_management('stat_table_watershed_lines')
-    if arcpy.Exists('stat_table_watersheds'): arcpy.Delete_management('stat_table_watersheds')
+    if arcpy.Exists('watershed_zones'): arcpy.Delete_management('watershed_zones')
+    if arcpy.Exists('watershed_line_zones'): arcpy.Delete_management('watershed_line_zones')
     if arcpy.Exists('watersheds_buffer'): arcpy.Delete_management('watersheds_buffer')
     if arcpy.Exists('watersheds_mask'): arcpy.Delete_management('watersheds_mask')
 
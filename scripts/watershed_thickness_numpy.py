@@ -0,0 +1,66 @@
+import numpy as np
+import parallel_hydrology as ph
+import zonal_statistics
+
+
+# NumPy counterpart of watershed_thickness_metrics.Basin_parameters. The
+# watersheds are an integer zone raster on the DEM grid (0 is NoData), the
+# volumes use the watershed areas given by the caller (polygon areas in the
+# ArcGIS tool) or the cell count times the cell area. Watershed lines are
+# the boundary cells of every zone ('RASTER_4' or 'RASTER_8' connectivity;
+# 'BUFFER', the inner buffer of one cell diagonal of the ArcGIS tool, is
+# the 'RASTER_8' ring on the raster).
+
+VOLUME_FIELDS = (('deltaH_extr', 'V_extr'), ('deltaH_mean', 'V_mean'), ('deltaH_watershed', 'V_watershed'))
+
+
+def thickness_metrics(DEM, zones, stream_cells, cell_area=1.0, areas=None, n_zones=None,
+                      divide_lines='RASTER_8'):
+    # Per-zone arrays (indexed by zone value) of deltaH_* and V_* and the
+    # totals: sum_area, sum of every V_* and the area-weighted dH_extr,
+    # dH_mean and dH_watershed. Returns (columns, totals)
+    index = zonal_statistics.ZoneIndex(zones, n_zones)
+    stat_watersheds = index.statistics(DEM)
+    stat_streams = index.statistics(np.where(stream_cells, DEM, np.nan))
+    connectivity = 4 if divide_lines == 'RASTER_4' else 8
+    line_zones = zonal_statistics.zone_boundaries(np.reshape(zones, np.shape(DEM)), connectivity)
+    stat_lines = zonal_statistics.zonal_statistics(line_zones, [DEM], index.n_zones)[0]
+    if areas is None:
+        areas = stat_watersheds['count'] * cell_area
+    # 1: Extrema thickness: elevation range
+    # 2: Mean thickness: mean elevation above the mean stream elevation
+    # 3: Watershed thickness: mean elevation of watershed lines above the
+    #    mean stream elevation
+    deltaH = {'deltaH_extr': stat_watersheds['range'],
+              'deltaH_mean': stat_watersheds['mean'] - stat_streams['mean'],
+              'deltaH_watershed': stat_lines['mean'] - stat_streams['mean']}
+    sum_area = float(np.sum(areas))
+    columns = {}
+    totals = {'sum_area': sum_area}
+    for dH_field, V_field in VOLUME_FIELDS:
+        columns[dH_field] = deltaH[dH_field]
+        columns[V_field] = deltaH[dH_field] * areas  # NaN where a watershed has no statistics
+        totals[V_field] = float(np.nansum(columns[V_field]))
+        totals[dH_field.replace('deltaH', 'dH')] = totals[V_field] / sum_area if sum_area else np.nan
+    return columns, totals
+
+
+def erosion_cut(DEM_fill, flow_directions):
+    # Mean elevation of the watershed of every cell and the mean erosion cut
+    # (that elevation above the cell)
+    flow_accumulation, sum_elevation = ph.multi_flow_accumulation(flow_directions, [None, DEM_fill])
+    flow_accumulation = flow_accumulation + 1.0
+    sum_elevation = sum_elevation + DEM_fill
+    mean_watershed_elevation = sum_elevation / flow_accumulation
+    return mean_watershed_elevation, mean_watershed_elevation - DEM_fill
+
+
+def write_statistics(out, totals, max_erosion_cut):
+    # Write thickness metrics in the text_output format
+    out.write('Total volume by extrema: ' + str(totals['V_extr']) + ' m^3\n')
+    out.write('dH by extrema: ' + str(totals['dH_extr']) + ' m\n')
+    out.write('Total volume by mean: ' + str(totals['V_mean']) + ' m^3\n')
+    out.write('dH by mean: ' + str(totals['dH_mean']) + ' m\n')
+    out.write('Total volume by watershed lines: ' + str(totals['V_watershed']) + ' m^3\n')
+    out.write('dH by watershed lines: ' + str(totals['dH_watershed']) + ' m\n')
+    out.write('Max erosion cut value: ' + str(max_erosion_cut) + ' m')
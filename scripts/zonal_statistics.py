@@ -0,0 +1,87 @@
+import numpy as np
+
+
+# Zonal statistics of value rasters over an integer zone raster, computed in
+# memory. Zone 0 (and NaN) is NoData. Cells are sorted by zone once and all
+# value rasters are reduced over the same ordering: count and sum with
+# bincount, minimum and maximum with reduceat over the runs of equal zone.
+# Results are arrays indexed by zone value; zones without valid values get
+# count 0 and NaN for the other statistics, as they would be missing from
+# the table of ZonalStatisticsAsTable
+
+STATISTICS = ('count', 'min', 'max', 'range', 'mean', 'sum')
+
+
+def as_zones(zones):
+    # Integer zone array with 0 for NoData
+    zones = np.asarray(zones)
+    if zones.dtype.kind == 'f':
+        zones = np.where(np.isnan(zones), 0, zones)
+    return zones.astype(np.int64).ravel()
+
+
+class ZoneIndex(object):
+    # Cells of every zone as runs of a single ordering of the raster
+
+    def __init__(self, zones, n_zones=None):
+        zones = as_zones(zones)
+        self.size = zones.size
+        self.n_zones = int(zones.max()) + 1 if n_zones is None and zones.size else (n_zones or 1)
+        order = np.argsort(zones, kind='mergesort')
+        sorted_zones = zones[order]
+        inside = (sorted_zones > 0) & (sorted_zones < self.n_zones)
+        self.order = order[inside]
+        self.zones = sorted_zones[inside]
+        self.starts = np.flatnonzero(np.r_[True, self.zones[1:] != self.zones[:-1]]) \
+            if self.zones.size else np.zeros(0, dtype=np.intp)
+        self.present = self.zones[self.starts]
+
+    def statistics(self, value):
+        # Dictionary of STATISTICS for one value raster
+        value = np.asarray(value, dtype=np.float64).ravel()[self.order]
+        valid = ~np.isnan(value)
+        count = np.bincount(self.zones[valid], minlength=self.n_zones)
+        # bincount of no values gives integers even with weights
+        total = np.bincount(self.zones[valid], weights=value[valid], minlength=self.n_zones).astype(np.float64)
+        low = np.full(self.n_zones, np.nan)
+        high = np.full(self.n_zones, np.nan)
+        if self.starts.size:
+            low[self.present] = np.minimum.reduceat(np.where(valid, value, np.inf), self.starts)
+            high[self.present] = np.maximum.reduceat(np.where(valid, value, -np.inf), self.starts)
+        empty = count == 0
+        low[empty] = np.nan
+        high[empty] = np.nan
+        total[empty] = np.nan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+        return {'count': count,
+                'min': low,
+                'max': high,
+                'range': high - low,
+                'mean': mean,
+                'sum': total}
+
+
+def zonal_statistics(zones, values, n_zones=None):
+    # Statistics of several value rasters over the same zones; returns a list
+    # of dictionaries (see ZoneIndex.statistics) in the order of values
+    index = ZoneIndex(zones, n_zones)
+    return [index.statistics(value) for value in values]
+
+
+def zone_boundaries(zones, connectivity=8):
+    # Boundary cells of every zone: cells with a 4- or 8-neighbour in another
+    # zone, in NoData or outside the raster. Returns the zone raster with
+    # inner cells set to 0
+    shape = np.shape(zones)
+    zones = as_zones(zones).reshape(shape)
+    padded = np.pad(zones, 1, mode='constant')
+    if connectivity == 4:
+        offsets = ((0, 1), (1, 0), (0, -1), (-1, 0))
+    else:
+        offsets = tuple((dr, dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc)
+    boundary = np.zeros(shape, dtype=bool)
+    for dr, dc in offsets:
+        neighbour = padded[1 + dr:1 + dr + shape[0], 1 + dc:1 + dc + shape[1]]
+        boundary |= neighbour != zones
+    return np.where(boundary, zones, 0)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tool modules are flat scripts imported from the scripts directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
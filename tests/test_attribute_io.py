@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+import attribute_io
+
+
+class Field(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeTable(object):
+    # The part of arcpy.da write_columns uses, on a dict of columns
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.da = self
+        self.OIDFieldName = 'OBJECTID'
+
+    def ListFields(self, table):
+        return [Field(name) for name in self.columns]
+
+    def Describe(self, table):
+        return self
+
+    def ExtendTable(self, table, table_field, array, array_field, append_only):
+        for name in array.dtype.names:
+            if name == array_field:
+                continue
+            assert name not in self.columns, 'ExtendTable only adds fields'
+            values = dict(zip(array[array_field].tolist(), array[name].tolist()))
+            self.columns[name] = [values.get(i) for i in self.columns[table_field]]
+
+    def UpdateCursor(self, table, fields):
+        return Cursor(self.columns, fields)
+
+
+class Cursor(object):
+
+    def __init__(self, columns, fields):
+        # Field names are not case sensitive
+        assert fields[0] == 'OID@'
+        names = dict((name.lower(), name) for name in columns)
+        self.columns, self.fields = columns, [names[name.lower()] for name in fields[1:]]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        for self.row, oid in enumerate(self.columns['OBJECTID']):
+            yield [oid] + [self.columns[name][self.row] for name in self.fields]
+
+    def updateRow(self, row):
+        for name, value in zip(self.fields, row[1:]):
+            self.columns[name][self.row] = value
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeTable({'OBJECTID': [1, 2, 3], 'deltaH_extr': [9.0, 9.0, 9.0]})
+    monkeypatch.setattr(attribute_io, 'arcpy', table)
+    return table
+
+
+def test_new_fields_are_added(table):
+    attribute_io.write_columns('watersheds', np.array([3, 1, 2]), [('V_extr', np.array([30.0, 10.0, 20.0])),
+                                                                    ('count', np.array([3, 1, 2]))])
+    assert table.columns['V_extr'] == [10.0, 20.0, 30.0]
+    assert table.columns['count'] == [1, 2, 3]
+
+
+def test_existing_fields_are_updated(table):
+    attribute_io.write_columns('watersheds', np.array([3, 1]), [('DELTAH_EXTR', np.array([5.0, 4.0]))])
+    assert table.columns['deltaH_extr'] == [4.0, 9.0, 5.0]
+
+
+def test_nan_is_written_as_null(table):
+    attribute_io.write_columns('watersheds', np.array([1, 2, 3]), [('deltaH_extr', np.array([np.nan, 1.0, 2.0])),
+                                                                    ('V_extr', np.array([1.0, np.nan, 3.0]))])
+    assert table.columns['deltaH_extr'] == [None, 1.0, 2.0]
+    assert table.columns['V_extr'] == [1.0, None, 3.0]
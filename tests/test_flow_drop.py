@@ -0,0 +1,52 @@
+import numpy as np
+import numpy_hydrology as nh
+
+
+def reference_drop(DEM_fill, flow_dir, cell_x, cell_y):
+    # Walk the flow path of every cell to its first lower cell
+    rcv = nh.receivers(flow_dir)
+    codes = np.asarray(flow_dir).ravel()
+    z = np.asarray(DEM_fill, dtype=np.float64).ravel()
+    cols = np.shape(flow_dir)[1]
+    drop = np.zeros(z.size)
+    for cell in range(z.size):
+        if codes[cell] == nh.FLOW_DIR_NODATA:
+            drop[cell] = np.nan
+            continue
+        current, length = cell, 0.0
+        while rcv[current] >= 0:
+            nxt = rcv[current]
+            length += np.hypot((nxt // cols - current // cols) * cell_y, (nxt % cols - current % cols) * cell_x)
+            current = nxt
+            if z[current] < z[cell]:
+                drop[cell] = (z[cell] - z[current]) / length * 100.0
+                break
+    return drop.reshape(np.shape(flow_dir))
+
+
+def test_drop_along_flow_and_across_flats():
+    DEM_fill = np.array([[3.0, 2.0, 2.0, 1.0, np.nan]])
+    flow_dir = np.array([[1, 1, 1, 1, nh.FLOW_DIR_NODATA]], dtype=np.uint8)
+    drop = nh.flow_drop(DEM_fill, flow_dir, 10.0, 10.0)
+    # The flat cell at column 1 drains over two steps; the last cell leaves the grid
+    np.testing.assert_allclose(drop[0, :4], [10.0, 5.0, 10.0, 0.0])
+    assert np.isnan(drop[0, 4])
+
+
+def test_drop_matches_flow_path_walk():
+    rng = np.random.RandomState(3)
+    DEM = np.round(rng.rand(60, 50) * 10 + np.linspace(20, 0, 50)[None, :])
+    DEM[rng.rand(60, 50) < 0.02] = np.nan
+    DEM_fill, flow_dir = nh.condition(DEM, 2.0, 3.0)
+    drop = nh.flow_drop(DEM_fill, nh.FlowGraph(flow_dir), 2.0, 3.0)
+    np.testing.assert_allclose(drop, reference_drop(DEM_fill, flow_dir, 2.0, 3.0))
+    # Off flats the drop is the steepest descent to a neighbour
+    steepest = np.zeros(DEM_fill.shape)
+    for k in range(8):
+        neighbour = nh._shifted(DEM_fill, nh.ROW_OFFSETS[k], nh.COL_OFFSETS[k], np.nan)
+        distance = np.hypot(nh.ROW_OFFSETS[k] * 3.0, nh.COL_OFFSETS[k] * 2.0)
+        with np.errstate(invalid='ignore'):
+            steepest = np.fmax(steepest, (DEM_fill - neighbour) / distance * 100.0)
+    rcv = nh.receivers(flow_dir)
+    downhill = (rcv >= 0) & (DEM_fill.ravel()[np.maximum(rcv, 0)] < DEM_fill.ravel())
+    np.testing.assert_allclose(drop.ravel()[downhill], steepest.ravel()[downhill])
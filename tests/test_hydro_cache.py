@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import hydro_cache
+import numpy_hydrology as nh
+
+
+def surface(size=60, seed=7):
+    rng = np.random.RandomState(seed)
+    return np.round(rng.rand(size, size) * 20 + np.linspace(40, 0, size)[:, None])
+
+
+def test_key_depends_on_values_and_parameters():
+    DEM = surface()
+    key = hydro_cache.HydroCache.key(DEM, cell_x=1.0, cell_y=1.0)
+    assert key == hydro_cache.HydroCache.key(DEM.copy(), cell_x=1.0, cell_y=1.0)
+    changed = DEM.copy()
+    changed[10, 10] += 1
+    assert key != hydro_cache.HydroCache.key(changed, cell_x=1.0, cell_y=1.0)
+    assert key != hydro_cache.HydroCache.key(DEM, cell_x=2.0, cell_y=1.0)
+    assert key != hydro_cache.HydroCache.key(DEM, cell_x=1.0, cell_y=1.0, backend='ARCGIS')
+    assert key != hydro_cache.HydroCache.key(DEM.reshape(30, 120), cell_x=1.0, cell_y=1.0)
+
+
+def test_cached_products_match_uncached(tmp_path):
+    DEM = surface()
+    cache = hydro_cache.HydroCache(str(tmp_path))
+    computed = hydro_cache.conditioned_dem(DEM, 1.0, 1.0, cache)
+    cached = hydro_cache.conditioned_dem(DEM, 1.0, 1.0, cache)
+    assert isinstance(cached['flow_directions'], np.memmap)
+    for name, array in hydro_cache.conditioned_dem(DEM, 1.0, 1.0).items():
+        np.testing.assert_array_equal(computed[name], array)
+        np.testing.assert_array_equal(cached[name], array)
+    np.testing.assert_array_equal(cached['flow_directions'], nh.condition(DEM, 1.0, 1.0)[1])
+
+
+def test_put_of_an_existing_entry_keeps_it(tmp_path):
+    # A concurrent run that stores the same entry does not fail
+    cache = hydro_cache.HydroCache(str(tmp_path))
+    cache.put('entry', {'a': np.arange(4)})
+    cache.put('entry', {'a': np.arange(4)})
+    np.testing.assert_array_equal(cache.get('entry', ('a',))['a'], np.arange(4))
+    assert os.listdir(str(tmp_path)) == ['entry']
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    array = np.zeros(1000)
+    cache = hydro_cache.HydroCache(str(tmp_path), max_bytes=int(2.5 * array.nbytes))
+    for n, key in enumerate(('first', 'second')):
+        cache.put(key, {'a': array})
+        os.utime(os.path.join(str(tmp_path), key), (n, n))
+    assert cache.get('first', ('a',)) is not None  # now the most recent
+    cache.put('third', {'a': array})
+    assert cache.get('second', ('a',)) is None
+    assert cache.get('first', ('a',)) is not None
+    assert cache.get('third', ('a',)) is not None
+    assert cache.get('first', ('missing',)) is None
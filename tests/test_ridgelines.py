@@ -0,0 +1,123 @@
+import re
+import numpy as np
+import pytest
+import ridgeline_numpy
+import stream_network_numpy
+
+
+def corner(r, c, cols=4):
+    return r * (cols + 1) + c
+
+
+def as_tuples(lines):
+    return [(mask, rows.tolist(), cols.tolist()) for mask, rows, cols in lines]
+
+
+def test_ridge_lines_chains_paths_and_rings():
+    # A closed ring around two cells, a line that turns, a mask change and
+    # an edge on its own
+    edges = [((1, 1), (1, 2)), ((1, 2), (1, 3)), ((1, 3), (2, 3)), ((2, 3), (2, 2)), ((2, 2), (2, 1)),
+             ((2, 1), (1, 1)), ((3, 0), (3, 1)), ((3, 1), (3, 2)), ((3, 2), (4, 2)), ((0, 4), (1, 4)),
+             ((1, 4), (2, 4))]
+    starts = np.array([corner(*a) for a, _ in edges])
+    ends = np.array([corner(*b) for _, b in edges])
+    masks = np.array([1, 1, 1, 1, 1, 1, 2, 2, 4, 1, 3])
+    lines = ridgeline_numpy.ridge_lines(starts, ends, masks, (4, 4), simplify=False)
+    assert as_tuples(lines) == [(1, [0, 1], [4, 4]),
+                                (3, [1, 2], [4, 4]),
+                                (2, [3, 3, 3], [0, 1, 2]),
+                                (4, [3, 4], [2, 2]),
+                                (1, [1, 1, 1, 2, 2, 2, 1], [1, 2, 3, 3, 2, 1, 1])]
+    simplified = ridgeline_numpy.ridge_lines(starts, ends, masks, (4, 4))
+    assert as_tuples(simplified)[2] == (2, [3, 3], [0, 2])
+    assert as_tuples(simplified)[4] == (1, [1, 1, 2, 2, 1], [1, 3, 3, 1, 1])
+
+
+def test_ridge_lines_use_every_edge_once():
+    rng = np.random.RandomState(3)
+    DEM = np.round(rng.rand(80, 80) * 20 + np.linspace(40, 0, 80)[:, None])
+    results = stream_network_numpy.CEI_extraction(DEM, 1.0, 1.0, None, None, 'CATCHMENT_AREA', '30')
+    entry, table, values = ridgeline_numpy.order_watersheds(results['stream_orders'], results['flow_directions'])
+    starts, ends, masks = ridgeline_numpy.ridge_edges(entry, table)
+    lines = ridgeline_numpy.ridge_lines(starts, ends, masks, entry.shape, simplify=False)
+    cols = entry.shape[1] + 1
+    edge_mask = dict((frozenset(edge), mask) for edge, mask in zip(zip(starts.tolist(), ends.tolist()),
+                                                                   masks.tolist()))
+    walked = []
+    for mask, rows, line_cols in lines:
+        vertices = (rows * cols + line_cols).tolist()
+        for edge in zip(vertices[:-1], vertices[1:]):
+            assert edge_mask[frozenset(edge)] == mask
+            walked.append(frozenset(edge))
+    assert sorted(walked, key=sorted) == sorted(edge_mask, key=sorted)
+
+
+def like(pattern, text):
+    # SQL LIKE with % as the only wildcard used by the patterns
+    return re.match('^' + '.*'.join(re.escape(part) for part in pattern.split('%')) + '$', text) is not None
+
+
+def baseline_classes(orders, values):
+    # Filosofov_order, Full_sequence and Highest_triplet as the selections
+    # by LIKE patterns of the original ordered_ridgelines set them, for
+    # watershed_order texts of the orders bounded (highest first)
+    values = list(reversed(values))
+    filosofov = [int(max(text)) for text in orders]
+    list_full_sequence = []
+    temp_string0 = ''
+    values_temp = values[:]
+    for i in range(len(values)):
+        temp_string0 = str(values_temp.pop(-1)) + temp_string0
+        temp_string1 = "%0" + temp_string0
+        if len(temp_string1) > len(values):
+            temp_string1 = temp_string1[-(len(values)):]
+        list_full_sequence.append(temp_string1)
+    list_full_sequence.reverse()
+    full_sequence = [0] * len(orders)
+    for i in range(len(values)):
+        for n, text in enumerate(orders):
+            if like(list_full_sequence[i], text):
+                full_sequence[n] = values[i]
+    list_triplets = []
+    for i in range(len(values)):
+        if i == len(values) - 1:
+            temp_string0 = str(values[-1])
+        elif i == len(values) - 2:
+            temp_string0 = str(values[-2]) + str(values[-1])
+        elif i == len(values) - 3:
+            temp_string0 = str(values[-3]) + str(values[-2]) + str(values[-1])
+        else:
+            temp_string0 = str(values[i]) + str(values[i+1]) + str(values[i+2])
+            temp_string0 = temp_string0 + '%'
+        if i == 0:
+            temp_string1 = temp_string0
+        elif i == 1:
+            temp_string1 = "0" + temp_string0
+        else:
+            temp_string1 = "%0" + temp_string0
+        if len(temp_string1) > len(values):
+            temp_string1 = temp_string1[-(len(values)):]
+        list_triplets.append(temp_string1)
+    highest_triplet = [0] * len(orders)
+    for i in range(len(values)):
+        for n, text in enumerate(orders):
+            if not highest_triplet[n] and like(list_triplets[i], text):
+                highest_triplet[n] = values[i]
+    return filosofov, full_sequence, highest_triplet
+
+
+@pytest.mark.parametrize('n_orders', [1, 2, 3, 4, 5, 6, 7])
+def test_classify_matches_baseline_patterns(n_orders):
+    values = list(range(1, n_orders + 1))
+    masks = np.arange(1, 2 ** n_orders)
+    orders = [ridgeline_numpy.watershed_order(mask, values) for mask in masks.tolist()]
+    classes = ridgeline_numpy.classify(masks, n_orders)
+    for computed, expected in zip(classes, baseline_classes(orders, values)):
+        assert computed.tolist() == expected
+
+
+def test_classify_examples():
+    # Bounds orders 1, 2, 3 and 5 of 5: watershed_order '50321'
+    filosofov, full_sequence, highest_triplet = ridgeline_numpy.classify([0b10111], 5)
+    assert (filosofov[0], full_sequence[0], highest_triplet[0]) == (5, 3, 3)
+    assert ridgeline_numpy.watershed_order(0b10111, [1, 2, 3, 4, 5]) == '50321'
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import numpy_hydrology as nh
+import stream_graph
+
+
+def network(size=100, seed=11, threshold=30):
+    # Flow directions of a rough surface with NoData holes and the stream
+    # cells draining more than threshold cells
+    rng = np.random.RandomState(seed)
+    DEM = np.round(rng.rand(size, size) * 20 + np.linspace(40, 0, size)[:, None])
+    DEM[rng.rand(size, size) < 0.01] = np.nan
+    flow_directions = nh.condition(DEM)[1]
+    return flow_directions, nh.flow_accumulation(flow_directions)
+
+
+def links(graph):
+    # Links as comparable tuples, independent of their numbering
+    return sorted((int(graph.head[k]), int(graph.outlet[k]), int(graph.order[k]), round(float(graph.length[k]), 6),
+                   tuple(graph.cell_index[graph.indptr[k]:graph.indptr[k + 1]].tolist()))
+                  for k in range(graph.size))
+
+
+def assert_same_graph(graph, expected):
+    assert links(graph) == links(expected)
+    np.testing.assert_array_equal(graph.order_raster(), expected.order_raster())
+    # Same cells in the same links
+    pairs = set(zip(graph.link_raster().ravel().tolist(), expected.link_raster().ravel().tolist()))
+    assert len(pairs) == len(set(a for a, _ in pairs)) == len(set(b for _, b in pairs))
+
+
+def test_build_matches_stream_link_and_order():
+    flow_directions, accumulation = network()
+    stream_cells = accumulation > 30
+    graph = stream_graph.build(stream_cells, flow_directions)
+    np.testing.assert_array_equal(graph.link_raster(), nh.stream_link(stream_cells, flow_directions))
+    np.testing.assert_array_equal(graph.order_raster(), nh.stream_order(stream_cells, flow_directions))
+
+
+@pytest.mark.parametrize('before, after', [(30, 10), (10, 30), (30, 30)])
+def test_update_matches_build(before, after):
+    flow_directions, accumulation = network()
+    graph = stream_graph.build(accumulation > before, flow_directions, 2.0, 3.0)
+    stream_cells = accumulation > after
+    # Cells that leave and enter the network at once
+    stream_cells[40:45, :] = ~stream_cells[40:45, :] & (accumulation[40:45, :] > 5)
+    updated = stream_graph.update(graph, stream_cells, flow_directions, 2.0, 3.0)
+    assert_same_graph(updated, stream_graph.build(stream_cells, flow_directions, 2.0, 3.0))
+
+
+def test_update_with_changed_cells():
+    flow_directions, accumulation = network()
+    graph = stream_graph.build(accumulation > 40, flow_directions)
+    stream_cells = accumulation > 20
+    changed = np.flatnonzero((accumulation > 20) & ~(accumulation > 40))
+    updated = stream_graph.update(graph, stream_cells, flow_directions, changed=changed)
+    assert_same_graph(updated, stream_graph.build(stream_cells, flow_directions))
+
+
+@pytest.mark.parametrize('iterative', [False, True])
+def test_pruning_matches_build_of_remaining_cells(iterative):
+    flow_directions, accumulation = network()
+    stream_cells = accumulation > 10
+    graph = stream_graph.build(stream_cells, flow_directions)
+    removed = stream_graph.short_sources(graph, 3, iterative)
+    assert removed.any()
+    if not iterative:
+        # Iterative rounds also remove links that became 1st order
+        assert (graph.order[removed] == 1).all()
+    remaining = stream_cells.copy()
+    remaining.flat[graph.cells_of(removed)] = False
+    pruned = stream_graph.remove_links(graph, removed)
+    assert_same_graph(pruned, stream_graph.build(remaining, flow_directions))
+
+
+def test_iterative_pruning_leaves_no_short_source():
+    flow_directions, accumulation = network()
+    stream_cells = accumulation > 10
+    graph = stream_graph.build(stream_cells, flow_directions)
+    pruned = stream_graph.remove_links(graph, stream_graph.short_sources(graph, 3, iterative=True))
+    assert not stream_graph.short_sources(pruned, 3).any()
+    # Pruning one round at a time reaches the same network
+    stepwise = graph
+    while True:
+        removed = stream_graph.short_sources(stepwise, 3)
+        if not removed.any():
+            break
+        stepwise = stream_graph.remove_links(stepwise, removed)
+    assert_same_graph(pruned, stepwise)
+
+
+def test_save_and_load(tmp_path):
+    flow_directions, accumulation = network()
+    graph = stream_graph.build(accumulation > 30, flow_directions)
+    graph.source = stream_graph.source_key(flow_directions, 1.0, 1.0)
+    path = str(tmp_path / 'graph.npz')
+    stream_graph.save(graph, path)
+    loaded = stream_graph.load(path)
+    assert loaded.source == graph.source
+    assert_same_graph(loaded, graph)
+    assert stream_graph.source_key(flow_directions, 2.0, 1.0) != graph.source
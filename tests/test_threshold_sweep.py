@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import order_report
+import stream_network_numpy
+
+
+def surface(size=120, seed=5):
+    # Rough tilted surface with pits, flats and NoData holes
+    rng = np.random.RandomState(seed)
+    DEM = np.round(rng.rand(size, size) * 20 + np.linspace(40, 0, size)[:, None])
+    DEM[rng.rand(size, size) < 0.01] = np.nan
+    return DEM
+
+
+def climate(DEM):
+    return 600.0 + 2.0 * DEM, np.full(DEM.shape, 100.0)
+
+
+@pytest.mark.parametrize('initiation_function_type, thresholds', [
+    ('CATCHMENT_AREA', ['50', '200', '1000']),
+    ('CLIMATIC_RUNOFF', ['20', '100']),
+    ('SLOPE_POWER_INDEX', ['20', '100']),
+    ('MEAN_EROSION_CUT', ['2', '5']),
+    ('DRAINAGE_NETWORK_STRAHLER_ORDER', ['3', '4'])])
+def test_sweep_matches_text_output(tmp_path, initiation_function_type, thresholds):
+    DEM = surface()
+    precipitation, evapotranspiration = climate(DEM)
+    sweep = stream_network_numpy.threshold_sweep(DEM, 1.0, 1.0, precipitation, evapotranspiration,
+                                                 initiation_function_type, thresholds, '3')
+    for threshold, statistics in sweep:
+        results = stream_network_numpy.CEI_extraction(DEM, 1.0, 1.0, precipitation, evapotranspiration,
+                                                      initiation_function_type, threshold, '3')
+        table = stream_network_numpy.segment_table(results['stream_orders'], results['flow_directions'],
+                                                   1.0, 1.0)[1]
+        text_output = str(tmp_path / ('%s.txt' % threshold))
+        order_report.write_stream_statistics(text_output, table)
+        written = order_report.read_statistics(text_output)
+        assert statistics['total_count'] == written['total_count']
+        assert statistics['order_count'] == [written['order_count'][i] for i in statistics['values']]
+        assert statistics['values'] == sorted(written['order_count'])
+        assert statistics['total_length'] == pytest.approx(written['total_length'])
+        assert statistics['order_length'] == pytest.approx([written['order_length'][i]
+                                                            for i in statistics['values']])
+
+
+def test_single_vertex_segments_are_not_counted():
+    # Streams ending next to NoData make segments of one vertex
+    DEM = surface()
+    results = stream_network_numpy.CEI_extraction(DEM, 1.0, 1.0, None, None, 'CATCHMENT_AREA', '50')
+    segments = stream_network_numpy.stream_segments(results['stream_orders'], results['flow_directions'])
+    kept = stream_network_numpy.polyline_segments(segments)
+    assert 0 < kept.size < len(segments)
+    statistics = stream_network_numpy.network_statistics(results['stream_orders'], results['flow_directions'],
+                                                         1.0, 1.0)
+    assert statistics['total_count'] == kept.size
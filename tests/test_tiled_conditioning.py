@@ -0,0 +1,77 @@
+import os
+import tracemalloc
+import numpy as np
+import pytest
+import numpy_hydrology as nh
+import scratch_store
+import stream_network_numpy
+import streamscape
+
+
+def surface(size=150, seed=3):
+    # Rough tilted surface with pits, flats and NoData holes
+    rng = np.random.RandomState(seed)
+    DEM = np.round(rng.rand(size, size) * 20 + np.linspace(40, 0, size)[:, None])
+    DEM[rng.rand(size, size) < 0.01] = np.nan
+    return DEM
+
+
+def test_condition_dem_tiled_matches_whole_raster(tmp_path):
+    DEM = surface()
+    slope, DEM_fill, flow_directions, flow_accumulation = \
+        stream_network_numpy.condition_dem(DEM, 2.0, 2.0, tile_size=40, directory=str(tmp_path))
+    assert isinstance(slope, np.memmap) and isinstance(flow_directions, np.memmap)
+    expected_fill, expected_directions = nh.condition(DEM, 2.0, 2.0)
+    np.testing.assert_array_equal(DEM_fill, expected_fill)
+    np.testing.assert_array_equal(flow_directions, expected_directions)
+    np.testing.assert_array_equal(flow_accumulation, nh.flow_accumulation(expected_directions))
+    np.testing.assert_array_equal(slope, nh.slope(DEM, 2.0, 2.0))
+
+
+def test_condition_dem_tiled_memory(tmp_path):
+    # The four outputs alone take over three times the DEM; tiled, they stay
+    # on disk and only tiles and boundary data are held
+    rows, cols = np.mgrid[0:400, 0:400]
+    DEM = np.round(40 * np.sin(rows / 37.0) * np.cos(cols / 53.0) + 0.05 * (rows + cols), 1)
+    path = str(tmp_path / 'DEM.npy')
+    np.save(path, DEM)
+    DEM = np.load(path, mmap_mode='r')
+    directory = str(tmp_path / 'tiled')
+    os.makedirs(directory)
+    # Warm up first, so lazily created module state is not counted
+    stream_network_numpy.condition_dem(DEM[:50, :50], 1.0, 1.0, tile_size=20, directory=directory)
+    tracemalloc.start()
+    try:
+        stream_network_numpy.condition_dem(DEM, 1.0, 1.0, tile_size=100, directory=directory)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 1.5 * DEM.nbytes
+
+
+def test_condition_dem_tiled_needs_directory():
+    with pytest.raises(ValueError):
+        stream_network_numpy.condition_dem(surface(), 1.0, 1.0, tile_size=40)
+
+
+def test_cei_extraction_tiled_matches_whole_raster():
+    DEM = surface()
+    expected = stream_network_numpy.CEI_extraction(DEM, 1.0, 1.0, None, None, 'CATCHMENT_AREA', 100)
+    with scratch_store.ScratchStore() as store:
+        tiled = stream_network_numpy.CEI_extraction(DEM, 1.0, 1.0, None, None, 'CATCHMENT_AREA', 100,
+                                                    store=store, tile_size=40)
+        for name in ('flow_directions', 'stream_links', 'stream_orders', 'watersheds'):
+            np.testing.assert_array_equal(tiled[name], expected[name])
+
+
+def test_streamscape_tile_size(tmp_path):
+    DEM = tmp_path / 'DEM.npy'
+    np.save(str(DEM), surface())
+    outputs = {}
+    for name, extra in (('whole', []), ('tiled', ['--tile-size', '40'])):
+        orders = tmp_path / (name + '_orders.npy')
+        streamscape.main(['streams', str(DEM), str(tmp_path / (name + '.geojson')), '--threshold', '100',
+                          '--stream-orders', str(orders)] + extra)
+        outputs[name] = np.load(str(orders))
+    np.testing.assert_array_equal(outputs['tiled'], outputs['whole'])
+    assert (outputs['tiled'] > 0).any()